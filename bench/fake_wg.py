@@ -0,0 +1,141 @@
+"""A stand-in for the ``wg`` binary that keeps interfaces in JSON files.
+
+Understands the commands the service runs: ``show interfaces``,
+``show <iface> dump``, ``set <iface> peer ...`` (several peers and
+``remove`` included), ``syncconf <iface> <file>``, ``genkey`` and
+``pubkey``. State lives in ``$FAKE_WG_STATE/<iface>.json``.
+"""
+
+import fcntl
+import json
+import os
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+
+def state_dir() -> Path:
+    return Path(os.environ.get("FAKE_WG_STATE", "/tmp/fake-wg"))
+
+
+def create_interface(
+    name: str, private_key: str, public_key: str, listen_port: int = 51820
+) -> None:
+    state_dir().mkdir(parents=True, exist_ok=True)
+    state = {
+        "private_key": private_key,
+        "public_key": public_key,
+        "listen_port": listen_port,
+        "peers": {},
+    }
+    (state_dir() / f"{name}.json").write_text(json.dumps(state))
+
+
+@contextmanager
+def _interface(name: str, write: bool = False) -> Iterator[Dict[str, Any]]:
+    path = state_dir() / f"{name}.json"
+    if not path.exists():
+        sys.stderr.write("Unable to access interface: No such device\n")
+        sys.exit(1)
+    with open(path, "r+") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        state = json.load(handle)
+        yield state
+        if write:
+            handle.seek(0)
+            handle.truncate()
+            json.dump(state, handle)
+
+
+def _dump(name: str) -> None:
+    with _interface(name) as state:
+        lines = [
+            f"{state['private_key']}\t{state['public_key']}\t{state['listen_port']}\toff"
+        ]
+        for public_key, peer in state["peers"].items():
+            lines.append(
+                "\t".join(
+                    [
+                        public_key,
+                        "(none)",
+                        peer.get("endpoint") or "(none)",
+                        peer.get("allowed_ips") or "(none)",
+                        "0",
+                        "0",
+                        "0",
+                        str(peer.get("persistent_keepalive") or "off"),
+                    ]
+                )
+            )
+    print("\n".join(lines))
+
+
+def _set(name: str, args: List[str]) -> None:
+    with _interface(name, write=True) as state:
+        peer = current = None
+        index = 0
+        while index < len(args):
+            arg = args[index]
+            if arg == "peer":
+                current = args[index + 1]
+                peer = state["peers"].setdefault(current, {})
+                index += 2
+            elif arg == "remove":
+                state["peers"].pop(current, None)
+                index += 1
+            elif arg in ("allowed-ips", "endpoint", "persistent-keepalive"):
+                if peer is None:
+                    sys.exit(1)
+                peer[arg.replace("-", "_")] = args[index + 1]
+                index += 2
+            elif arg == "listen-port":
+                state["listen_port"] = int(args[index + 1])
+                index += 2
+            else:
+                index += 2
+
+
+def _syncconf(name: str, path: str) -> None:
+    peers: Dict[str, Dict[str, str]] = {}
+    peer = None
+    for line in Path(path).read_text().splitlines():
+        key, _, value = (part.strip() for part in line.partition("="))
+        if key == "[Peer]":
+            peer = None
+        elif key == "PublicKey":
+            peer = peers.setdefault(value, {})
+        elif peer is not None and key == "AllowedIPs":
+            peer["allowed_ips"] = value.replace(" ", "")
+        elif peer is not None and key == "Endpoint":
+            peer["endpoint"] = value
+        elif peer is not None and key == "PersistentKeepalive":
+            peer["persistent_keepalive"] = value
+    with _interface(name, write=True) as state:
+        state["peers"] = peers
+
+
+def main(argv: List[str]) -> None:
+    if argv[:2] == ["show", "interfaces"]:
+        names = sorted(path.stem for path in state_dir().glob("*.json"))
+        print(" ".join(names))
+    elif argv[:1] == ["show"] and argv[2:3] == ["dump"]:
+        _dump(argv[1])
+    elif argv[:1] == ["set"]:
+        _set(argv[1], argv[2:])
+    elif argv[:1] == ["syncconf"]:
+        _syncconf(argv[1], argv[2])
+    elif argv[:1] in (["genkey"], ["pubkey"]):
+        from service_layer.wireguard.keys import generate_private_key, public_key
+
+        if argv[0] == "genkey":
+            print(generate_private_key())
+        else:
+            print(public_key(sys.stdin.read().strip()))
+    else:
+        sys.stderr.write(f"Unsupported command: wg {' '.join(argv)}\n")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
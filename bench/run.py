@@ -0,0 +1,368 @@
+"""Drive the API through a weighted mix of requests and report latencies.
+
+The app runs in-process against ``MemoryStorage`` and the fake ``wg`` in
+``bench/fake_wg.py``, so no etcd or WireGuard is needed. ``--save`` writes
+the report as a baseline and ``--compare`` fails when an operation got
+slower than its baseline by more than ``--tolerance``.
+"""
+
+import asyncio
+import json
+import math
+import os
+import random
+import stat
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+import httpx
+import typer
+from bench.fake_wg import create_interface
+from dependencies import Services
+from main import app as api
+from service_layer.etcd.memory import MemoryStorage
+from service_layer.wireguard.keys import generate_keypair, key_pool
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# relative weight of each operation in the default mix
+DEFAULT_MIX = {
+    "login": 5,
+    "me": 30,
+    "config_create": 10,
+    "config_get": 25,
+    "config_update": 8,
+    "config_delete": 4,
+    "config_list": 8,
+    "peer_add": 5,
+    "peer_remove": 5,
+}
+BENCH_INTERFACE = "bench0"
+FAKE_WG_ENVIRON = ("PATH", "FAKE_WG_STATE", "PYTHONPATH")
+# p50/p99 differences below this are noise, whatever the ratio
+REGRESSION_MIN_MS = 0.5
+
+app = typer.Typer()
+
+
+def install_fake_wg(directory: Path) -> None:
+    """Put the fake ``wg`` first on PATH for every subprocess of this run"""
+    state = directory / "state"
+    state.mkdir(parents=True, exist_ok=True)
+    wrapper = directory / "wg"
+    wrapper.write_text(
+        f'#!/bin/sh\nexec "{sys.executable}" "{ROOT / "bench" / "fake_wg.py"}" "$@"\n'
+    )
+    wrapper.chmod(wrapper.stat().st_mode | stat.S_IXUSR)
+    os.environ["FAKE_WG_STATE"] = str(state)
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(ROOT), os.environ.get("PYTHONPATH")])
+    )
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+
+
+@contextmanager
+def fake_wg(directory: Path) -> Iterator[None]:
+    """``install_fake_wg`` for the duration of the block, then restore the environment"""
+    saved = {name: os.environ.get(name) for name in FAKE_WG_ENVIRON}
+    try:
+        install_fake_wg(directory)
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted ``samples``"""
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples), math.ceil(fraction * len(samples))) - 1)
+    return samples[index]
+
+
+class Workload:
+    """Shared state of the simulated clients: tokens, config ids, peers"""
+
+    def __init__(self, client: httpx.AsyncClient, seed: int):
+        self.client = client
+        self.random = random.Random(seed)
+        self.users: List[Dict[str, str]] = []
+        self.tokens: List[str] = []
+        self.config_ids: List[int] = []
+        self.peers: List[str] = []
+        self._serial = 0
+
+    def _next(self) -> int:
+        self._serial += 1
+        return self._serial
+
+    def _config(self) -> Dict[str, Any]:
+        return {
+            "server": f"vpn{self.random.randrange(16)}.example.com",
+            "port": self.random.choice([443, 1194, 51820]),
+            "protocol": self.random.choice(["udp", "tcp"]),
+        }
+
+    async def setup(self, users: int, configs: int) -> None:
+        self.users = [
+            {"username": f"bench{i}", "password": f"secret-{i}"} for i in range(users)
+        ]
+        await self._check(self.client.post("/api/v1/users/batch", json=self.users))
+        for user in self.users:
+            await self.login(user)
+        response = await self._check(
+            self.client.post(
+                "/api/v1/config/batch",
+                json=[{"config_data": self._config()} for _ in range(configs)],
+            )
+        )
+        self.config_ids = [
+            result["config_id"]
+            for result in response.json()["results"]
+            if "config_id" in result
+        ]
+        keypair = generate_keypair()
+        create_interface(BENCH_INTERFACE, keypair["private_key"], keypair["public_key"])
+
+    @staticmethod
+    async def _check(request: Awaitable[httpx.Response]) -> httpx.Response:
+        response = await request
+        response.raise_for_status()
+        return response
+
+    async def login(self, user: Optional[Dict[str, str]] = None) -> httpx.Response:
+        user = user or self.random.choice(self.users)
+        response = await self.client.post("/api/v1/users/auth", json=user)
+        if response.status_code == 200:
+            self.tokens.append(response.json()["access_token"])
+            del self.tokens[: -len(self.users) * 4]
+        return response
+
+    async def me(self) -> httpx.Response:
+        token = self.random.choice(self.tokens)
+        return await self.client.get(
+            "/api/v1/users/me", headers={"Authorization": f"Bearer {token}"}
+        )
+
+    async def config_create(self) -> httpx.Response:
+        response = await self.client.post(
+            "/api/v1/config/", json={"config_data": self._config()}
+        )
+        if response.status_code == 200:
+            self.config_ids.append(response.json()["config_id"])
+        return response
+
+    async def config_get(self) -> httpx.Response:
+        if not self.config_ids:
+            return await self.config_create()
+        return await self.client.get(
+            f"/api/v1/config/{self.random.choice(self.config_ids)}"
+        )
+
+    async def config_update(self) -> httpx.Response:
+        if not self.config_ids:
+            return await self.config_create()
+        return await self.client.put(
+            f"/api/v1/config/{self.random.choice(self.config_ids)}",
+            json={"config_data": self._config()},
+        )
+
+    async def config_delete(self) -> httpx.Response:
+        if not self.config_ids:
+            return await self.config_create()
+        config_id = self.config_ids.pop(self.random.randrange(len(self.config_ids)))
+        return await self.client.delete(f"/api/v1/config/{config_id}")
+
+    async def config_list(self) -> httpx.Response:
+        return await self.client.get("/api/v1/config/", params={"limit": 100})
+
+    async def peer_add(self) -> httpx.Response:
+        public_key = "/"
+        # a key with "/" cannot be passed in the DELETE path
+        while "/" in public_key:
+            public_key = key_pool.take()[0]["public_key"]
+        serial = self._next()
+        response = await self.client.post(
+            f"/api/v1/wireguard/interface/{BENCH_INTERFACE}/peer",
+            json={
+                "public_key": public_key,
+                "allowed_ips": f"10.{serial >> 16 & 255}.{serial >> 8 & 255}.{serial & 255}/32",
+            },
+        )
+        if response.status_code == 200:
+            self.peers.append(public_key)
+        return response
+
+    async def peer_remove(self) -> httpx.Response:
+        if not self.peers:
+            return await self.peer_add()
+        public_key = self.peers.pop(self.random.randrange(len(self.peers)))
+        return await self.client.delete(
+            f"/api/v1/wireguard/interface/{BENCH_INTERFACE}/peer/{public_key}"
+        )
+
+
+async def run_benchmark(
+    requests: int = 2000,
+    concurrency: int = 16,
+    mix: Optional[Dict[str, int]] = None,
+    users: int = 8,
+    configs: int = 500,
+    seed: int = 1,
+) -> Dict[str, Any]:
+    """Run ``requests`` operations from ``concurrency`` clients and report them"""
+    mix = mix or DEFAULT_MIX
+    with tempfile.TemporaryDirectory(prefix="vpn-bench-") as directory, fake_wg(
+        Path(directory)
+    ):
+        services = api.state.services = Services(MemoryStorage())
+        await services.warm_up()
+        # let the key pool fill up before measuring, not while
+        await asyncio.get_running_loop().run_in_executor(None, key_pool.refill)
+        transport = httpx.ASGITransport(app=api)
+        try:
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench"
+            ) as client:
+                workload = Workload(client, seed)
+                await workload.setup(users, configs)
+                operations: Dict[str, Callable[[], Awaitable[httpx.Response]]] = {
+                    name: getattr(workload, name) for name in mix
+                }
+                names = [name for name in mix if mix[name] > 0]
+                plan = workload.random.choices(
+                    names, weights=[mix[name] for name in names], k=requests
+                )
+                latencies: Dict[str, List[float]] = {name: [] for name in names}
+                errors: Dict[str, int] = dict.fromkeys(names, 0)
+                queue = iter(plan)
+
+                async def worker() -> None:
+                    for name in queue:
+                        start = time.perf_counter()
+                        response = await operations[name]()
+                        latencies[name].append(time.perf_counter() - start)
+                        if response.status_code >= 400:
+                            errors[name] += 1
+
+                started = time.perf_counter()
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+                elapsed = time.perf_counter() - started
+        finally:
+            services.close()
+            del api.state.services
+
+    report: Dict[str, Any] = {
+        "settings": {
+            "requests": requests,
+            "concurrency": concurrency,
+            "users": users,
+            "configs": configs,
+            "seed": seed,
+            "mix": mix,
+        },
+        "elapsed": elapsed,
+        "throughput": requests / elapsed,
+        "operations": {},
+    }
+    for name in names:
+        samples = sorted(latencies[name])
+        report["operations"][name] = {
+            "count": len(samples),
+            "errors": errors[name],
+            "throughput": len(samples) / elapsed,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+        }
+    return report
+
+
+def find_regressions(
+    report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2
+) -> List[str]:
+    """Operations whose p50 or p99 grew more than ``tolerance`` over the baseline"""
+    regressions = []
+    for name, current in report["operations"].items():
+        previous = baseline.get("operations", {}).get(name)
+        if previous is None:
+            continue
+        for stat_name in ("p50_ms", "p99_ms"):
+            before, after = previous[stat_name], current[stat_name]
+            if after > before * (1 + tolerance) and after - before > REGRESSION_MIN_MS:
+                regressions.append(
+                    f"{name} {stat_name[:3]}: {before:.2f}ms -> {after:.2f}ms "
+                    f"(+{(after / before - 1) * 100 if before else float('inf'):.0f}%)"
+                )
+    return regressions
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [
+        f"{report['settings']['requests']} requests, "
+        f"{report['settings']['concurrency']} clients, "
+        f"{report['elapsed']:.2f}s, {report['throughput']:.0f} req/s",
+        f"{'operation':<16}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}",
+    ]
+    for name, stats in report["operations"].items():
+        lines.append(
+            f"{name:<16}{stats['count']:>8}{stats['errors']:>8}"
+            f"{stats['throughput']:>10.0f}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+@app.command()
+def main(
+    requests: int = 2000,
+    concurrency: int = 16,
+    users: int = 8,
+    configs: int = 500,
+    seed: int = 1,
+    mix: Optional[str] = typer.Option(
+        None, help="Comma separated name=weight pairs, e.g. me=10,config_get=5"
+    ),
+    save: Optional[Path] = typer.Option(None, help="Write the report as a baseline"),
+    compare: Optional[Path] = typer.Option(None, help="Baseline to check against"),
+    tolerance: float = 0.2,
+) -> None:
+    """Benchmark the API in-process and optionally check it against a baseline"""
+    weights = None
+    if mix:
+        weights = {
+            name.strip(): int(weight)
+            for name, _, weight in (pair.partition("=") for pair in mix.split(","))
+        }
+        unknown = set(weights) - set(DEFAULT_MIX)
+        if unknown:
+            raise typer.BadParameter(
+                f"Unknown operations: {', '.join(sorted(unknown))}"
+            )
+    report = asyncio.run(
+        run_benchmark(requests, concurrency, weights, users, configs, seed)
+    )
+    print(format_report(report))
+    if save:
+        save.write_text(json.dumps(report, indent=2))
+        print(f"Baseline saved to {save}")
+    if compare:
+        regressions = find_regressions(
+            report, json.loads(compare.read_text()), tolerance
+        )
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            raise typer.Exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    app()
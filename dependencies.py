@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+from fastapi import Request
+from query_sets.users import USERS_KEY, UsersQuerySets
+from query_sets.vpn_config import CONFIGS_KEY, COUNTER_KEY, VpnConfigQuerySets
+from query_sets.wireguard import WireGuardQuerySets
+from service_layer.etcd.backend import Storage, create_storage
+from service_layer.etcd.cache import WatchCache
+from service_layer.etcd.id_allocator import IdAllocator
+from service_layer.metrics import registry
+from service_layer.token_cache import TokenCache
+from service_layer.wireguard.keys import key_pool
+
+WARMUP_RETRY_DELAY = float(os.getenv("WARMUP_RETRY_DELAY", "0.5"))
+WARMUP_MAX_DELAY = float(os.getenv("WARMUP_MAX_DELAY", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class Services:
+    """Storage, caches and query sets of one running app.
+
+    The watch caches and the id allocator live here and are handed to the
+    query sets, so they go away with the app. Building it only creates
+    objects. ``warm_up`` connects to storage and
+    loads the caches concurrently, retrying with backoff until every check
+    passes, and the app serves requests meanwhile; ``ready`` reports when
+    it is done.
+    """
+
+    def __init__(self, storage: Optional[Storage] = None):
+        # STORAGE_BACKEND picks etcd, memory or sqlite
+        self.storage = storage if storage is not None else create_storage()
+        self.caches = [
+            WatchCache(self.storage, USERS_KEY),
+            WatchCache(self.storage, CONFIGS_KEY),
+        ]
+        self.id_allocator = IdAllocator(self.storage, COUNTER_KEY)
+        self.users = UsersQuerySets(self.storage, cache=self.caches[0])
+        self.configs = VpnConfigQuerySets(
+            self.storage, cache=self.caches[1], id_allocator=self.id_allocator
+        )
+        self.wireguard = WireGuardQuerySets(self.storage)
+        self.token_cache = TokenCache()
+        self.users.on_user_changed(self.token_cache.invalidate_user)
+
+        self._checks: Dict[str, Callable[[], Awaitable[Any]]] = {
+            "storage": self.storage.ping,
+            **{f"cache:{cache.prefix}": cache.start for cache in self.caches},
+        }
+        self.checks: Dict[str, str] = dict.fromkeys(self._checks, "pending")
+        registry.add_collector(self.collect_metrics)
+
+    @property
+    def ready(self) -> bool:
+        return all(status == "ok" for status in self.checks.values())
+
+    async def warm_up(self) -> None:
+        key_pool.refill_soon()
+        delay = WARMUP_RETRY_DELAY
+        while True:
+            pending = [name for name, status in self.checks.items() if status != "ok"]
+            results = await asyncio.gather(
+                *(self._checks[name]() for name in pending), return_exceptions=True
+            )
+            for name, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    self.checks[name] = str(result) or type(result).__name__
+                    logger.warning("Warm-up check %s failed: %s", name, result)
+                else:
+                    self.checks[name] = "ok"
+            if self.ready:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_MAX_DELAY)
+
+    def collect_metrics(self) -> list:
+        caches = [(f"etcd:{cache.prefix}", cache.stats()) for cache in self.caches]
+        caches.append(("token", self.token_cache.stats()))
+        metrics = []
+        for stat, kind in (
+            ("entries", "gauge"),
+            ("hits", "counter"),
+            ("misses", "counter"),
+            ("evictions", "counter"),
+        ):
+            samples = [({"cache": name}, stats[stat]) for name, stats in caches]
+            name = f"cache_{stat}" if kind == "gauge" else f"cache_{stat}_total"
+            metrics.append((name, f"Cache {stat}", kind, samples))
+        metrics.append(
+            (
+                "ready_check",
+                "1 once a warm-up check passed",
+                "gauge",
+                [
+                    ({"check": name}, int(status == "ok"))
+                    for name, status in self.checks.items()
+                ],
+            )
+        )
+        return metrics
+
+    def close(self) -> None:
+        registry.remove_collector(self.collect_metrics)
+        for cache in self.caches:
+            cache.stop()
+        self.storage.close()
+
+
+def get_services(request: Request) -> Services:
+    return request.app.state.services
+
+
+def get_users_query_set(request: Request) -> UsersQuerySets:
+    return get_services(request).users
+
+
+def get_config_query_set(request: Request) -> VpnConfigQuerySets:
+    return get_services(request).configs
+
+
+def get_wireguard_query_set(request: Request) -> WireGuardQuerySets:
+    return get_services(request).wireguard
+
+
+def get_token_cache(request: Request) -> TokenCache:
+    return get_services(request).token_cache
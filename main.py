@@ -1,6 +1,23 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from dependencies import Services
+from service_layer.metrics import MetricsMiddleware, registry
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # nothing connects before this point; warm-up runs alongside requests
+    services = app.state.services = Services()
+    warm_up = asyncio.create_task(services.warm_up())
+    yield
+    warm_up.cancel()
+    services.close()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(MetricsMiddleware)
 
 from routers.vpn_config import router as config_router
 from routers.users import router as user_router
@@ -10,6 +27,21 @@ app.include_router(user_router)
 app.include_router(config_router)
 app.include_router(wireguard_router)
 
+
+@app.get("/ready")
+async def ready():
+    services = getattr(app.state, "services", None)
+    checks = services.checks if services is not None else {}
+    if services is None or not services.ready:
+        return ORJSONResponse({"ready": False, "checks": checks}, status_code=503)
+    return {"ready": True, "checks": checks}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     import uvicorn
 
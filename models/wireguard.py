@@ -15,3 +15,14 @@ class WireGuardPeer(BaseModel):
     allowed_ips: str
     endpoint: Optional[str] = None
     persistent_keepalive: Optional[int] = None
+
+
+class WireGuardPeerBatch(BaseModel):
+    upsert: List[WireGuardPeer] = []
+    remove: List[str] = []
+
+
+class WireGuardProvision(BaseModel):
+    username: str
+    public_key: Optional[str] = None
+    persistent_keepalive: Optional[int] = None
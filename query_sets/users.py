@@ -1,31 +1,61 @@
-import json
-from typing import Dict, Any, Optional
+import asyncio
+from typing import Callable, Dict, Any, List, Optional
 from fastapi import APIRouter, HTTPException
-from service_layer.etcd.etcd_client import EtcdClient, pwd_context
+from service_layer.etcd.cache import WatchCache
+from service_layer.etcd.backend import Storage, get_storage
+from service_layer.etcd.codec import Codec, codec
+from service_layer.etcd.storage import chunks
+from service_layer.passwords import password_hasher
+from service_layer.metrics import etcd_query_seconds, timed
 
+USERS_KEY = "/vpn/users/"
 
-class UsersQuerySets(EtcdClient):
-    def __init__(self):
-        super().__init__()
-        self.users_key = "/vpn/users/"
+
+class UsersQuerySets:
+    def __init__(
+        self,
+        storage: Optional[Storage] = None,
+        value_codec: Optional[Codec] = None,
+        cache: Optional[WatchCache] = None,
+    ):
+        self.storage = storage if storage is not None else get_storage()
+        self.codec = value_codec or codec
+        self.users_key = USERS_KEY
+        # an unstarted cache misses every lookup
+        self.cache = cache or WatchCache(self.storage, self.users_key)
 
     def _get_user_key(self, username: str) -> str:
         return f"{self.users_key}{username}"
 
-    def create_user(
+    def on_user_changed(self, callback: Callable[[Optional[str]], None]) -> None:
+        """Call ``callback(username)`` whenever a user record changes.
+
+        ``callback(None)`` means changes may have been missed.
+        """
+        prefix_length = len(self.users_key)
+        self.cache.add_listener(
+            lambda key: callback(key[prefix_length:] if key is not None else None)
+        )
+
+    @timed(etcd_query_seconds)
+    async def create_user(
         self, username: str, password: str, vpn_config: Optional[Dict[str, Any]] = None
     ) -> None:
         try:
             user_key = self._get_user_key(username)
-            if self.client.get(user_key)[0] is not None:
-                raise HTTPException(status_code=400, detail="User already exists")
-
             user_data = {
                 "username": username,
-                "password": pwd_context.hash(password),
+                "password": await password_hasher.hash(password),
                 "vpn_config": vpn_config,
             }
-            self.client.put(user_key, json.dumps(user_data).encode("utf-8"))
+            transactions = self.storage.transactions
+            created, _ = await self.storage.txn(
+                compare=[transactions.version(user_key) == 0],
+                success=[transactions.put(user_key, self.codec.encode(user_data))],
+            )
+            if not created:
+                raise HTTPException(status_code=400, detail="User already exists")
+            self.cache.discard(user_key)
         except HTTPException:
             raise
         except Exception as e:
@@ -33,18 +63,84 @@ class UsersQuerySets(EtcdClient):
                 status_code=503, detail=f"Failed to create user: {str(e)}"
             )
 
-    def get_user(self, username: str) -> Optional[Dict[str, Any]]:
+    @timed(etcd_query_seconds)
+    async def create_users(self, users: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Create many users in chunked transactions; taken names are skipped"""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(users)
+        unique: Dict[str, int] = {}
+        for index, user in enumerate(users):
+            user_key = self._get_user_key(user["username"])
+            if user_key in unique:
+                results[index] = {"username": user["username"], "status": "exists"}
+                continue
+            unique[user_key] = index
+
+        hashes = await password_hasher.hash_many(
+            [users[index]["password"] for index in unique.values()]
+        )
+        pending: Dict[str, tuple] = {}
+        for (user_key, index), password in zip(unique.items(), hashes):
+            user_data = {
+                "username": users[index]["username"],
+                "password": password,
+                "vpn_config": users[index].get("vpn_config"),
+            }
+            pending[user_key] = (index, self.codec.encode(user_data))
+
+        batches = chunks(list(pending.items()))
+        statuses = await asyncio.gather(*(self._put_users(batch) for batch in batches))
+        for batch_statuses in statuses:
+            for index, status in batch_statuses.items():
+                results[index] = {"username": users[index]["username"], **status}
+        return results
+
+    async def _put_users(self, batch) -> Dict[int, Dict[str, str]]:
+        # all-or-nothing per attempt; on conflict the failure branch reports
+        # which names are taken and the rest of the chunk is retried
+        transactions = self.storage.transactions
+        statuses: Dict[int, Dict[str, str]] = {}
+        remaining = list(batch)
+        try:
+            while remaining:
+                created, responses = await self.storage.txn(
+                    compare=[transactions.version(key) == 0 for key, _ in remaining],
+                    success=[
+                        transactions.put(key, value) for key, (_, value) in remaining
+                    ],
+                    failure=[transactions.get(key) for key, _ in remaining],
+                )
+                if created:
+                    for key, (index, _) in remaining:
+                        statuses[index] = {"status": "created"}
+                        self.cache.discard(key)
+                    break
+                taken = {items[0].key for items in responses if items}
+                for key, (index, _) in remaining:
+                    if key in taken:
+                        statuses[index] = {"status": "exists"}
+                remaining = [item for item in remaining if item[0] not in taken]
+        except Exception as e:
+            for _, (index, _) in remaining:
+                statuses[index] = {"status": "failed", "detail": str(e)}
+        return statuses
+
+    @timed(etcd_query_seconds)
+    async def get_user(self, username: str) -> Optional[Dict[str, Any]]:
         try:
             user_key = self._get_user_key(username)
-            result = self.client.get(user_key)[0]
+            found, result = self.cache.get(user_key)
+            if not found:
+                result, revision = await self.storage.get_with_revision(user_key)
+                self.cache.store(user_key, result, revision)
             if result is None:
                 return None
-            return json.loads(result.decode("utf-8"))
+            return self.codec.decode(result)
         except Exception as e:
             raise HTTPException(status_code=503, detail=f"Failed to get user: {str(e)}")
 
-    def verify_password(self, username: str, password: str) -> bool:
-        user = self.get_user(username)
+    @timed(etcd_query_seconds)
+    async def verify_password(self, username: str, password: str) -> bool:
+        user = await self.get_user(username)
         if not user:
             return False
-        return pwd_context.verify(password, user["password"])
+        return await password_hasher.verify(password, user["password"])
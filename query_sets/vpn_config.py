@@ -1,70 +1,475 @@
-import json
-from typing import Dict, Any, Optional
+import asyncio
+from typing import Dict, Any, AsyncIterator, Callable, List, Optional, Tuple
+from urllib.parse import quote
 from fastapi import APIRouter, HTTPException
-from service_layer.etcd.etcd_client import EtcdClient
+from service_layer.etcd.cache import WatchCache
+from service_layer.etcd.backend import Storage, get_storage
+from service_layer.etcd.codec import Codec, codec
+from service_layer.etcd.id_allocator import IdAllocator
+from service_layer.etcd.storage import ETCD_TXN_MAX_OPS, prefix_end
+from service_layer.metrics import etcd_query_seconds, timed
 
 
-class VpnConfigQuerySets(EtcdClient):
-    def __init__(self):
-        super().__init__()
-        self.config = "/vpn/users/"
+COUNTER_KEY = "/vpn/counter"
+CONFIGS_KEY = "/vpn/configs/"
+# config fields with an index key per value, most selective first
+INDEXED_FIELDS = ("owner", "server", "protocol")
+CONFIG_WRITE_MAX_ATTEMPTS = 16
 
-    def create_config(self, config_data: Dict[str, Any]) -> int:
+
+class VpnConfigQuerySets:
+    def __init__(
+        self,
+        storage: Optional[Storage] = None,
+        value_codec: Optional[Codec] = None,
+        cache: Optional[WatchCache] = None,
+        id_allocator: Optional[IdAllocator] = None,
+    ):
+        self.storage = storage if storage is not None else get_storage()
+        self.codec = value_codec or codec
+        self.base_key = CONFIGS_KEY
+        self.index_key = "/vpn/config_index/"
+        self.id_allocator = id_allocator or IdAllocator(self.storage, COUNTER_KEY)
+        self.cache = cache or WatchCache(self.storage, self.base_key)
+
+    def _get_full_key(self, config_id: int) -> str:
+        return f"{self.base_key}{config_id}"
+
+    def _index_prefix(self, field: str, value: str) -> str:
+        return f"{self.index_key}{field}/{quote(value, safe='')}/"
+
+    def _index_ops(
+        self,
+        config_id: int,
+        old: Optional[Dict[str, Any]],
+        new: Optional[Dict[str, Any]],
+    ) -> list:
+        """Index deletes and puts that take config ``config_id`` from ``old`` to ``new``"""
+        transactions = self.storage.transactions
+
+        def keys(config_data):
+            return {
+                f"{self._index_prefix(field, value)}{config_id}"
+                for field, value in _index_values(config_data or {}).items()
+            }
+
+        old_keys, new_keys = keys(old), keys(new)
+        return [transactions.delete(key) for key in sorted(old_keys - new_keys)] + [
+            transactions.put(key, b"") for key in sorted(new_keys - old_keys)
+        ]
+
+    async def _get_next_id(self) -> int:
+        try:
+            return await self.id_allocator.next_id()
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to get next ID: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def create_config(self, config_data: Dict[str, Any]) -> int:
         try:
-            config_id = self._get_next_id()
+            config_id = await self._get_next_id()
             full_key = self._get_full_key(config_id)
-            self.client.put(full_key, json.dumps(config_data).encode("utf-8"))
+            await self.storage.txn(
+                compare=[],
+                success=[
+                    self.storage.transactions.put(
+                        full_key, self.codec.encode(config_data)
+                    ),
+                    *self._index_ops(config_id, None, config_data),
+                ],
+            )
+            self.cache.discard(full_key)
             return config_id
         except Exception as e:
             raise HTTPException(
                 status_code=503, detail=f"Failed to create config: {str(e)}"
             )
 
-    def get_config(self, config_id: int) -> Optional[Dict[str, Any]]:
+    @timed(etcd_query_seconds)
+    async def create_configs(
+        self, configs: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """Create many configs with one id lease and chunked transactions
+
+        Every row carries the id it was given. Rows of a chunk whose
+        transaction failed report ``status: failed`` with that id, which
+        stays unused: ids are never handed out twice, so resubmitting
+        those configs creates them under new ids.
+        """
         try:
-            full_key = self._get_full_key(config_id)
-            result = self.client.get(full_key)[0]
+            config_ids = await self.id_allocator.next_ids(len(configs))
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to get next ID: {str(e)}"
+            )
+        # a config and its index keys always land in the same transaction
+        batches: List[list] = [[]]
+        ops = 0
+        for config_id, config_data in zip(config_ids, configs):
+            size = 1 + len(_index_values(config_data))
+            if batches[-1] and ops + size > ETCD_TXN_MAX_OPS:
+                batches.append([])
+                ops = 0
+            batches[-1].append((config_id, config_data))
+            ops += size
+        results = await asyncio.gather(*(self._put_configs(batch) for batch in batches))
+        return [result for batch in results for result in batch]
+
+    async def _put_configs(self, batch) -> List[Dict[str, Any]]:
+        transactions = self.storage.transactions
+        try:
+            await self.storage.txn(
+                compare=[],
+                success=[
+                    op
+                    for config_id, config_data in batch
+                    for op in (
+                        transactions.put(
+                            self._get_full_key(config_id),
+                            self.codec.encode(config_data),
+                        ),
+                        *self._index_ops(config_id, None, config_data),
+                    )
+                ],
+            )
+        except Exception as e:
+            return [
+                {"config_id": config_id, "status": "failed", "detail": str(e)}
+                for config_id, _ in batch
+            ]
+        for config_id, _ in batch:
+            self.cache.discard(self._get_full_key(config_id))
+        return [{"config_id": config_id, "status": "created"} for config_id, _ in batch]
+
+    async def _get_value(self, config_id: int) -> Optional[bytes]:
+        full_key = self._get_full_key(config_id)
+        found, result = self.cache.get(full_key)
+        if not found:
+            result, revision = await self.storage.get_with_revision(full_key)
+            self.cache.store(full_key, result, revision)
+        return result
+
+    @timed(etcd_query_seconds)
+    async def get_config(self, config_id: int) -> Optional[Dict[str, Any]]:
+        try:
+            result = await self._get_value(config_id)
             if result is None:
                 return None
-            return json.loads(result.decode("utf-8"))
+            return self.codec.decode(result)
         except Exception as e:
             raise HTTPException(
                 status_code=503, detail=f"Failed to get config: {str(e)}"
             )
 
-    def update_config(self, config_id: int, config_data: Dict[str, Any]) -> bool:
+    @timed(etcd_query_seconds)
+    async def get_config_json(self, config_id: int) -> Optional[bytes]:
+        """The stored config as JSON bytes, ready to send as is"""
         try:
-            full_key = self._get_full_key(config_id)
-            if self.client.get(full_key)[0] is None:
-                return False
-            self.client.put(full_key, json.dumps(config_data).encode("utf-8"))
-            return True
+            result = await self._get_value(config_id)
+            if result is None:
+                return None
+            return self.codec.raw_json(result)
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to get config: {str(e)}"
+            )
+
+    async def _swap(
+        self, config_id: int, write: Callable[[Dict[str, Any]], list]
+    ) -> bool:
+        """Apply the ops ``write(config)`` if the config is still ``config``.
+
+        The ops are built from the cached value and guarded by it, so a warm
+        cache makes this one round trip; on a conflict the failure branch
+        returns the current value to retry with. False if there is no config.
+        """
+        full_key = self._get_full_key(config_id)
+        transactions = self.storage.transactions
+        current = await self._get_value(config_id)
+        for _ in range(CONFIG_WRITE_MAX_ATTEMPTS):
+            if current is None:
+                # make sure it is gone rather than trusting the cache
+                compare, success = [transactions.version(full_key) == 0], []
+            else:
+                compare = [transactions.value(full_key) == current]
+                success = write(self.codec.decode(current))
+            swapped, responses = await self.storage.txn(
+                compare=compare,
+                success=success,
+                failure=[transactions.get(full_key)],
+            )
+            self.cache.discard(full_key)
+            if swapped:
+                return current is not None
+            items = responses[0]
+            current = items[0].value if items else None
+        raise HTTPException(status_code=503, detail="Config kept changing, retry later")
+
+    @timed(etcd_query_seconds)
+    async def update_config(self, config_id: int, config_data: Dict[str, Any]) -> bool:
+        full_key = self._get_full_key(config_id)
+        value = self.codec.encode(config_data)
+
+        def write(current):
+            return [
+                self.storage.transactions.put(full_key, value),
+                *self._index_ops(config_id, current, config_data),
+            ]
+
+        try:
+            return await self._swap(config_id, write)
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(
                 status_code=503, detail=f"Failed to update config: {str(e)}"
             )
 
-    def delete_config(self, config_id: int) -> bool:
+    @timed(etcd_query_seconds)
+    async def delete_config(self, config_id: int) -> bool:
+        full_key = self._get_full_key(config_id)
+
+        def write(current):
+            return [
+                self.storage.transactions.delete(full_key),
+                *self._index_ops(config_id, current, None),
+            ]
+
         try:
-            full_key = self._get_full_key(config_id)
-            if self.client.get(full_key)[0] is None:
-                return False
-            self.client.delete(full_key)
-            return True
+            return await self._swap(config_id, write)
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(
                 status_code=503, detail=f"Failed to delete config: {str(e)}"
             )
 
-    def list_configs(self) -> Dict[int, Dict[str, Any]]:
+    def _config_range(self, after: Optional[int]) -> tuple:
+        # keys sort as strings, so pages follow key order rather than id order
+        start = self._get_full_key(after) + "\0" if after is not None else self.base_key
+        return start, prefix_end(self.base_key)
+
+    async def _find(
+        self,
+        where: Dict[str, str],
+        limit: Optional[int],
+        after: Optional[int],
+        keys_only: bool = False,
+    ) -> List[Tuple[int, Optional[bytes], Optional[Dict[str, Any]]]]:
+        """Configs with every ``where`` field equal to its value, in key order.
+
+        Walks the index of the most selective field and reads only the
+        configs it lists, through the cache. Each one is checked against
+        all of ``where``, so a value the cache has not caught up with yet
+        is skipped rather than returned. ``keys_only`` with one field needs
+        only the index.
+        """
+        unknown = set(where) - set(INDEXED_FIELDS)
+        if unknown:
+            raise ValueError(f"Not indexed: {', '.join(sorted(unknown))}")
+        field = next(name for name in INDEXED_FIELDS if name in where)
+        prefix = self._index_prefix(field, where[field])
+        start = prefix if after is None else f"{prefix}{after}\0"
+        index_only = keys_only and len(where) == 1
+        found: List[Tuple[int, Optional[bytes], Optional[Dict[str, Any]]]] = []
+        while limit is None or len(found) < limit:
+            page_size = None if limit is None else limit - len(found)
+            items = await self.storage.range(
+                start, prefix_end(prefix), limit=page_size, keys_only=True
+            )
+            config_ids = [_config_id(item.key) for item in items]
+            if index_only:
+                found.extend((config_id, None, None) for config_id in config_ids)
+            else:
+                values = await asyncio.gather(
+                    *(self._get_value(config_id) for config_id in config_ids)
+                )
+                for config_id, value in zip(config_ids, values):
+                    if value is None:
+                        continue
+                    config_data = self.codec.decode(value)
+                    if _matches(config_data, where):
+                        found.append((config_id, value, config_data))
+            if page_size is None or len(items) < page_size:
+                break
+            start = items[-1].key + "\0"
+        return found
+
+    @timed(etcd_query_seconds)
+    async def list_configs(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+        where: Optional[Dict[str, str]] = None,
+    ) -> Dict[int, Dict[str, Any]]:
+        """Return up to ``limit`` configs stored after config ``after``.
+
+        ``fields`` keeps only those top-level keys of each config and
+        ``where`` keeps only configs whose indexed fields have those values.
+        """
         try:
+            if where:
+                return {
+                    config_id: _project(config_data, fields)
+                    for config_id, _, config_data in await self._find(
+                        where, limit, after
+                    )
+                }
+            start, end = self._config_range(after)
             configs = {}
-            for item in self.client.get_prefix(self.base_key):
-                key = item[1].key.decode("utf-8")
-                config_id = int(key.split("/")[-1])
-                configs[config_id] = json.loads(item[0].decode("utf-8"))
+            for item in await self.storage.range(start, end, limit=limit):
+                configs[_config_id(item.key)] = _project(
+                    self.codec.decode(item.value), fields
+                )
             return configs
         except Exception as e:
             raise HTTPException(
                 status_code=503, detail=f"Failed to list configs: {str(e)}"
-            )
\ No newline at end of file
+            )
+
+    @timed(etcd_query_seconds)
+    async def list_configs_json(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[int] = None,
+        where: Optional[Dict[str, str]] = None,
+    ) -> List[Tuple[int, bytes]]:
+        """Like ``list_configs`` but with each config as JSON bytes"""
+        try:
+            if where:
+                return [
+                    (config_id, self.codec.raw_json(value))
+                    for config_id, value, _ in await self._find(where, limit, after)
+                ]
+            start, end = self._config_range(after)
+            return [
+                (_config_id(item.key), self.codec.raw_json(item.value))
+                for item in await self.storage.range(start, end, limit=limit)
+            ]
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to list configs: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def list_config_ids(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[int] = None,
+        where: Optional[Dict[str, str]] = None,
+    ) -> List[int]:
+        try:
+            if where:
+                found = await self._find(where, limit, after, keys_only=True)
+                return [config_id for config_id, _, _ in found]
+            start, end = self._config_range(after)
+            items = await self.storage.range(start, end, limit=limit, keys_only=True)
+            return [_config_id(item.key) for item in items]
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to list configs: {str(e)}"
+            )
+
+    async def iter_configs(
+        self,
+        page_size: int,
+        after: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+        keys_only: bool = False,
+        as_json: bool = False,
+        where: Optional[Dict[str, str]] = None,
+    ) -> AsyncIterator[Tuple[int, Any]]:
+        """Walk every config page by page, holding one page in memory.
+
+        With ``as_json`` each config comes as JSON bytes instead of a dict.
+        """
+        while True:
+            if keys_only:
+                page = dict.fromkeys(
+                    await self.list_config_ids(page_size, after, where)
+                )
+            elif as_json:
+                page = dict(await self.list_configs_json(page_size, after, where))
+            else:
+                page = await self.list_configs(page_size, after, fields, where)
+            for config_id, config_data in page.items():
+                yield config_id, config_data
+                after = config_id
+            if len(page) < page_size:
+                return
+
+    async def reindex_configs(
+        self, chunk_size: int = ETCD_TXN_MAX_OPS
+    ) -> Dict[str, int]:
+        """Write the index keys of configs stored before they were indexed.
+
+        Like ``migrate_prefix``, each chunk is guarded by the revisions it
+        was read at; a config changed meanwhile was indexed by its writer.
+        """
+        transactions = self.storage.transactions
+        counts = {"indexed": 0, "conflicts": 0}
+        start, end = self._config_range(None)
+        while True:
+            page = await self.storage.range(start, end, limit=chunk_size)
+            pending = [
+                (
+                    item,
+                    self._index_ops(
+                        _config_id(item.key), None, self.codec.decode(item.value)
+                    ),
+                )
+                for item in page
+            ]
+            # rewriting an existing index key is harmless; a chunk with more
+            # index keys than one transaction allows goes config by config
+            size = sum(len(ops) for _, ops in pending)
+            indexed = False
+            if pending and size <= ETCD_TXN_MAX_OPS:
+                indexed, _ = await self.storage.txn(
+                    compare=[
+                        transactions.mod(item.key) == item.mod_revision
+                        for item, _ in pending
+                    ],
+                    success=[op for _, ops in pending for op in ops],
+                )
+            if indexed:
+                counts["indexed"] += len(pending)
+            else:
+                for item, ops in pending:
+                    indexed, _ = await self.storage.txn(
+                        compare=[transactions.mod(item.key) == item.mod_revision],
+                        success=ops,
+                    )
+                    counts["indexed" if indexed else "conflicts"] += 1
+            if len(page) < chunk_size:
+                return counts
+            start = page[-1].key + "\0"
+
+
+def _config_id(key: str) -> int:
+    return int(key.split("/")[-1])
+
+
+def _index_values(config_data: Dict[str, Any]) -> Dict[str, str]:
+    # only scalar values are indexed, as strings like query parameters
+    return {
+        field: str(config_data[field])
+        for field in INDEXED_FIELDS
+        if isinstance(config_data.get(field), (str, int, float))
+    }
+
+
+def _matches(config_data: Dict[str, Any], where: Dict[str, str]) -> bool:
+    values = _index_values(config_data)
+    return all(values.get(field) == value for field, value in where.items())
+
+
+def _project(
+    config_data: Dict[str, Any], fields: Optional[List[str]]
+) -> Dict[str, Any]:
+    if fields is None:
+        return config_data
+    return {field: config_data[field] for field in fields if field in config_data}
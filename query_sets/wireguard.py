@@ -0,0 +1,300 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+from fastapi import HTTPException
+from service_layer.etcd.backend import Storage, get_storage
+from service_layer.etcd.codec import Codec, codec
+from service_layer.wireguard.addresses import AddressPool, AddressPoolExhausted
+from service_layer.metrics import etcd_query_seconds, timed
+
+# a claim lost to another instance marks that address taken and tries the next
+PROVISION_MAX_ATTEMPTS = 16
+
+
+def _key_part(public_key: str) -> str:
+    # base64 keys may contain "/", keep them to a single key segment
+    return public_key.replace("/", "_").replace("+", "-")
+
+
+class WireGuardQuerySets:
+    """Interfaces, provisioned peers and their tunnel addresses.
+
+    Every address is claimed under ``ips/<interface>/<address>`` in the same
+    transaction that writes the peer record and the ``users/<username>/``
+    index entry, so an address is never handed out twice and a user's peers
+    are one prefix read away. Each instance allocates from an address pool
+    built from those claims and rebuilds it when the pool runs out or loses
+    a claim, which is how it sees addresses freed by other instances.
+    """
+
+    def __init__(
+        self, storage: Optional[Storage] = None, value_codec: Optional[Codec] = None
+    ):
+        self.storage = storage if storage is not None else get_storage()
+        self.codec = value_codec or codec
+        self.base_key = "/vpn/wireguard/"
+        self.users_key = "/vpn/users/"
+        self._pools: Dict[str, AddressPool] = {}
+        self._pool_locks: Dict[str, asyncio.Lock] = {}
+
+    def _interface_key(self, interface: str) -> str:
+        return f"{self.base_key}interfaces/{interface}"
+
+    def _address_key(self, interface: str, address: str) -> str:
+        return f"{self.base_key}ips/{interface}/{address}"
+
+    def _peer_key(self, interface: str, public_key: str) -> str:
+        return f"{self.base_key}peers/{interface}/{_key_part(public_key)}"
+
+    def _user_peers_key(self, username: str) -> str:
+        return f"{self.base_key}users/{username}/"
+
+    def _user_peer_key(self, username: str, interface: str, public_key: str) -> str:
+        return f"{self._user_peers_key(username)}{interface}/{_key_part(public_key)}"
+
+    @timed(etcd_query_seconds)
+    async def register_interface(
+        self,
+        name: str,
+        address: str,
+        public_key: Optional[str] = None,
+        listen_port: Optional[int] = None,
+        dns: Optional[str] = None,
+    ) -> None:
+        """Record an interface so peers can be provisioned on it.
+
+        The private key stays in the config file on the host.
+        """
+        try:
+            record = {
+                "name": name,
+                "address": address,
+                "public_key": public_key,
+                "listen_port": listen_port,
+                "dns": dns,
+            }
+            await self.storage.put(self._interface_key(name), self.codec.encode(record))
+            self._pools.pop(name, None)
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to register interface: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def get_interface(self, name: str) -> Optional[Dict[str, Any]]:
+        try:
+            result = await self.storage.get(self._interface_key(name))
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to get interface: {str(e)}"
+            )
+        if result is None:
+            return None
+        return self.codec.decode(result)
+
+    async def _pool(
+        self, interface: str, stale: Optional[AddressPool] = None
+    ) -> AddressPool:
+        """The address pool of ``interface``, built from its etcd claims.
+
+        Pass the pool in use as ``stale`` to rebuild it from the claims,
+        e.g. to pick up addresses released by another instance.
+        """
+        pool = self._pools.get(interface)
+        if pool is not None and pool is not stale:
+            return pool
+        lock = self._pool_locks.setdefault(interface, asyncio.Lock())
+        async with lock:
+            pool = self._pools.get(interface)
+            if pool is None or pool is stale:
+                pool = await self._load_pool(interface)
+                self._pools[interface] = pool
+        return pool
+
+    async def _load_pool(self, interface: str) -> AddressPool:
+        record = await self.get_interface(interface)
+        if record is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Interface {interface} is not registered",
+            )
+        host = record["address"].split("/")[0]
+        pool = AddressPool(record["address"], reserved=[host])
+        claims = await self.storage.get_prefix(
+            self._address_key(interface, ""), keys_only=True
+        )
+        for item in claims:
+            pool.claim(item.key.rsplit("/", 1)[-1])
+        return pool
+
+    @timed(etcd_query_seconds)
+    async def provision_peer(
+        self,
+        interface: str,
+        username: str,
+        public_key: str,
+        persistent_keepalive: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Allocate a tunnel address for a new peer of ``username``"""
+        try:
+            pool = await self._pool(interface)
+            user_key = f"{self.users_key}{username}"
+            peer_key = self._peer_key(interface, public_key)
+            transactions = self.storage.transactions
+            rebuilt = False
+            for _ in range(PROVISION_MAX_ATTEMPTS):
+                try:
+                    address = pool.allocate()
+                except AddressPoolExhausted:
+                    # releases made by other instances only show up in etcd
+                    if rebuilt:
+                        raise
+                    pool, rebuilt = await self._pool(interface, stale=pool), True
+                    continue
+                address_key = self._address_key(interface, address)
+                record = {
+                    "interface": interface,
+                    "username": username,
+                    "public_key": public_key,
+                    "address": address,
+                    "persistent_keepalive": persistent_keepalive,
+                }
+                value = self.codec.encode(record)
+                created, responses = await self.storage.txn(
+                    compare=[
+                        transactions.version(user_key) > 0,
+                        transactions.version(peer_key) == 0,
+                        transactions.version(address_key) == 0,
+                    ],
+                    success=[
+                        transactions.put(address_key, public_key.encode("utf-8")),
+                        transactions.put(peer_key, value),
+                        transactions.put(
+                            self._user_peer_key(username, interface, public_key), value
+                        ),
+                    ],
+                    failure=[
+                        transactions.get(user_key),
+                        transactions.get(peer_key),
+                        transactions.get(address_key),
+                    ],
+                )
+                if created:
+                    return record
+                user, peer, _ = responses
+                if not user or peer:
+                    pool.release(address)
+                    if not user:
+                        raise HTTPException(
+                            status_code=404, detail=f"User {username} not found"
+                        )
+                    raise HTTPException(
+                        status_code=409, detail="Peer is already provisioned"
+                    )
+                # taken by another instance, so this pool is out of date
+                pool, rebuilt = await self._pool(interface, stale=pool), True
+                pool.claim(address)
+            raise HTTPException(
+                status_code=503, detail="Could not claim a free address, retry later"
+            )
+        except AddressPoolExhausted as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to provision peer: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def get_peer(
+        self, interface: str, public_key: str
+    ) -> Optional[Dict[str, Any]]:
+        try:
+            result = await self.storage.get(self._peer_key(interface, public_key))
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Failed to get peer: {str(e)}")
+        if result is None:
+            return None
+        return self.codec.decode(result)
+
+    @timed(etcd_query_seconds)
+    async def release_peer(
+        self, interface: str, public_key: str
+    ) -> Optional[Dict[str, Any]]:
+        """Forget a provisioned peer and free its address"""
+        try:
+            peer_key = self._peer_key(interface, public_key)
+            result = await self.storage.get(peer_key)
+            if result is None:
+                return None
+            record = self.codec.decode(result)
+            transactions = self.storage.transactions
+            released, _ = await self.storage.txn(
+                compare=[transactions.value(peer_key) == result],
+                success=[
+                    transactions.delete(peer_key),
+                    transactions.delete(
+                        self._address_key(interface, record["address"])
+                    ),
+                    transactions.delete(
+                        self._user_peer_key(record["username"], interface, public_key)
+                    ),
+                ],
+            )
+            if not released:
+                return None
+            pool = self._pools.get(interface)
+            if pool is not None:
+                pool.release(record["address"])
+            return record
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to release peer: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def list_user_peers(self, username: str) -> List[Dict[str, Any]]:
+        try:
+            items = await self.storage.get_prefix(self._user_peers_key(username))
+            return [self.codec.decode(item.value) for item in items]
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to list peers: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def list_user_peers_json(self, username: str) -> List[bytes]:
+        """Like ``list_user_peers`` but with each record as JSON bytes"""
+        try:
+            items = await self.storage.get_prefix(self._user_peers_key(username))
+            return [self.codec.raw_json(item.value) for item in items]
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to list peers: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def list_interfaces(self) -> List[Dict[str, Any]]:
+        try:
+            items = await self.storage.get_prefix(self._interface_key(""))
+            return [self.codec.decode(item.value) for item in items]
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to list interfaces: {str(e)}"
+            )
+
+    @timed(etcd_query_seconds)
+    async def list_interface_peers(
+        self, interface: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Provisioned peers of ``interface``, or of every interface"""
+        try:
+            prefix = f"{self.base_key}peers/"
+            if interface is not None:
+                prefix = f"{prefix}{interface}/"
+            items = await self.storage.get_prefix(prefix)
+            return [self.codec.decode(item.value) for item in items]
+        except Exception as e:
+            raise HTTPException(
+                status_code=503, detail=f"Failed to list peers: {str(e)}"
+            )
@@ -1,23 +1,25 @@
 from datetime import datetime, timedelta
-from typing import Optional
-from fastapi import  HTTPException, Depends, APIRouter
+from typing import List, Optional
+from fastapi import HTTPException, Depends, APIRouter, Body
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
+from dependencies import get_token_cache, get_users_query_set
 from models.users import User, UserAuth, Token
 from query_sets.users import UsersQuerySets
+from service_layer.metrics import jwt_seconds
+from service_layer.token_cache import TokenCache
 
 SECRET_KEY = (
     "your-secret-key-keep-it-secret"  # В продакшене использовать безопасный ключ
 )
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+BATCH_MAX_ITEMS = 10000
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 router = APIRouter(prefix="/api/v1/users", tags=["Users"])
 
-query_set = UsersQuerySets()
-
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -26,40 +28,56 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with jwt_seconds.time("encode"):
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    query_set: UsersQuerySets = Depends(get_users_query_set),
+    token_cache: TokenCache = Depends(get_token_cache),
+):
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with jwt_seconds.time("decode"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
 
-    user = query_set.get_user(username)
+    generation = token_cache.generation()
+    user = await query_set.get_user(username)
     if user is None:
         raise credentials_exception
+    # without a live watch a changed user would never be invalidated
+    if query_set.cache.live and "exp" in payload:
+        token_cache.put(token, payload["exp"], username, user, generation)
     return user
 
 
 @router.post("/auth")
-async def authenticate_user(user_auth: UserAuth):
-    if not query_set.verify_password(user_auth.username, user_auth.password):
+async def authenticate_user(
+    user_auth: UserAuth, query_set: UsersQuerySets = Depends(get_users_query_set)
+):
+    if not await query_set.verify_password(user_auth.username, user_auth.password):
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    user = query_set.get_user(user_auth.username)
+    user = await query_set.get_user(user_auth.username)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user["username"]}, expires_delta=access_token_expires
@@ -69,9 +87,11 @@ async def authenticate_user(user_auth: UserAuth):
 
 
 @router.post("/")
-async def create_user(user: User):
+async def create_user(
+    user: User, query_set: UsersQuerySets = Depends(get_users_query_set)
+):
     try:
-        query_set.create_user(user.username, user.password, user.vpn_config)
+        await query_set.create_user(user.username, user.password, user.vpn_config)
         return {"message": "User created successfully"}
     except HTTPException as e:
         raise e
@@ -79,6 +99,15 @@ async def create_user(user: User):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/batch")
+async def create_users_batch(
+    users: List[User] = Body(..., max_length=BATCH_MAX_ITEMS),
+    query_set: UsersQuerySets = Depends(get_users_query_set),
+):
+    results = await query_set.create_users([user.model_dump() for user in users])
+    return {"results": results}
+
+
 @router.get("/me")
 async def read_users_me(current_user=Depends(get_current_user)):
     return current_user
@@ -1,18 +1,25 @@
-from fastapi import APIRouter, HTTPException
+from typing import List, Optional
+import orjson
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 
+from dependencies import get_config_query_set
 from models.vpn_config import VPNConfigRequest
 from query_sets.vpn_config import VpnConfigQuerySets
 
 router = APIRouter(prefix="/api/v1/config", tags=["Config"])
 
-
-query_set = VpnConfigQuerySets()
+BATCH_MAX_ITEMS = 10000
+LIST_PAGE_SIZE = 1000
 
 
 @router.post("/")
-def create_vpn_config(config_request: VPNConfigRequest):
+async def create_vpn_config(
+    config_request: VPNConfigRequest,
+    query_set: VpnConfigQuerySets = Depends(get_config_query_set),
+):
     try:
-        config_id = query_set.create_config(config_request.config_data)
+        config_id = await query_set.create_config(config_request.config_data)
         return {"message": "VPN configuration created", "config_id": config_id}
     except HTTPException as e:
         raise e
@@ -20,28 +27,110 @@ def create_vpn_config(config_request: VPNConfigRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/batch")
+async def create_vpn_configs_batch(
+    config_requests: List[VPNConfigRequest] = Body(..., max_length=BATCH_MAX_ITEMS),
+    query_set: VpnConfigQuerySets = Depends(get_config_query_set),
+):
+    results = await query_set.create_configs(
+        [config_request.config_data for config_request in config_requests]
+    )
+    return {"results": results}
+
+
 @router.get("/{config_id}")
-def read_vpn_config(config_id: int):
-    config = query_set.get_config(config_id)
+async def read_vpn_config(
+    config_id: int, query_set: VpnConfigQuerySets = Depends(get_config_query_set)
+):
+    # the stored JSON is passed through without decoding it
+    config = await query_set.get_config_json(config_id)
     if config is None:
         raise HTTPException(status_code=404, detail="VPN configuration not found")
-    return config
+    return Response(config, media_type="application/json")
 
 
 @router.get("/")
-def list_vpn_configs():
-    return query_set.list_configs()
+async def list_vpn_configs(
+    response: Response,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_SIZE),
+    after: Optional[int] = None,
+    fields: Optional[str] = None,
+    keys_only: bool = False,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    owner: Optional[str] = None,
+    server: Optional[str] = None,
+    protocol: Optional[str] = None,
+    query_set: VpnConfigQuerySets = Depends(get_config_query_set),
+):
+    """List configs a page at a time, as ``{id: config}``.
+
+    Pages follow the storage key order, where ids compare as strings
+    (``1, 10, 11, 2, ...``), and the id to pass as ``after`` for the next
+    page is returned in the ``X-Next-After`` header. ``keys_only`` gives
+    ``null`` for every config. ``format=ndjson`` streams every config after
+    ``after`` as one JSON object per line instead. ``owner``, ``server``
+    and ``protocol`` filter through their index keys.
+    """
+    projection = fields.split(",") if fields else None
+    filters = {"owner": owner, "server": server, "protocol": protocol}
+    where = {field: value for field, value in filters.items() if value is not None}
+    if format == "ndjson":
+        return StreamingResponse(
+            _stream_configs(query_set, after, projection, keys_only, where),
+            media_type="application/x-ndjson",
+        )
+
+    if keys_only or projection is None:
+        if keys_only:
+            ids = await query_set.list_config_ids(limit, after, where)
+            items = [(config_id, b"null") for config_id in ids]
+        else:
+            items = await query_set.list_configs_json(limit, after, where)
+        last_id = items[-1][0] if items else None
+        headers = {"X-Next-After": str(last_id)} if len(items) == limit else None
+        return Response(
+            _json_object(items), media_type="application/json", headers=headers
+        )
+    page = await query_set.list_configs(limit, after, projection, where)
+    last_id = next(reversed(page), None)
+    if len(page) == limit:
+        response.headers["X-Next-After"] = str(last_id)
+    return page
+
+
+def _json_object(items) -> bytes:
+    return b"{" + b",".join(b'"%d":%s' % (key, value) for key, value in items) + b"}"
+
+
+async def _stream_configs(query_set, after, fields, keys_only, where):
+    as_json = fields is None
+    async for config_id, config_data in query_set.iter_configs(
+        LIST_PAGE_SIZE, after, fields, keys_only, as_json, where
+    ):
+        if keys_only:
+            yield b'{"config_id":%d}\n' % config_id
+        elif as_json:
+            yield b'{"config_id":%d,"config_data":%s}\n' % (config_id, config_data)
+        else:
+            line = {"config_id": config_id, "config_data": config_data}
+            yield orjson.dumps(line) + b"\n"
 
 
 @router.put("/{config_id}")
-def update_vpn_config(config_id: int, config_request: VPNConfigRequest):
-    if query_set.update_config(config_id, config_request.config_data):
+async def update_vpn_config(
+    config_id: int,
+    config_request: VPNConfigRequest,
+    query_set: VpnConfigQuerySets = Depends(get_config_query_set),
+):
+    if await query_set.update_config(config_id, config_request.config_data):
         return {"message": "VPN configuration updated", "config_id": config_id}
     raise HTTPException(status_code=404, detail="VPN configuration not found")
 
 
 @router.delete("/{config_id}")
-def delete_vpn_config(config_id: int):
-    if query_set.delete_config(config_id):
+async def delete_vpn_config(
+    config_id: int, query_set: VpnConfigQuerySets = Depends(get_config_query_set)
+):
+    if await query_set.delete_config(config_id):
         return {"message": "VPN configuration deleted", "config_id": config_id}
     raise HTTPException(status_code=404, detail="VPN configuration not found")
@@ -1,62 +1,262 @@
-from fastapi import APIRouter, HTTPException
-from models.wireguard import WireGuardInterface, WireGuardPeer
-from service_layer.wireguard.cli import (
-    generate_keys,
-    create_interface,
+import asyncio
+import logging
+import orjson
+from contextlib import aclosing
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from models.wireguard import (
+    WireGuardInterface,
+    WireGuardPeer,
+    WireGuardPeerBatch,
+    WireGuardProvision,
+)
+from dependencies import get_wireguard_query_set
+from query_sets.wireguard import WireGuardQuerySets
+from service_layer.wireguard.peers import make_peer
+from service_layer.wireguard.keys import key_pool, public_key as derive_public_key
+from service_layer.wireguard.service import (
     add_peer,
     remove_peer,
-    get_interface_info,
+    apply_peer_batch,
 )
-from typing import Dict
+from service_layer.wireguard.status import status_cache
+from service_layer.wireguard.feed import traffic_feeds
+from service_layer.wireguard.lookup import peer_index
+from service_layer.wireguard.configs import config_renderer
+from typing import Dict, Optional
 
 router = APIRouter(prefix="/api/v1/wireguard", tags=["WireGuard"])
 
+KEYS_MAX_COUNT = 1000
+FEED_HEARTBEAT = 15
+
+logger = logging.getLogger(__name__)
+
+
+async def _take_keys(count: int) -> list:
+    if count > len(key_pool):
+        # generating keys is CPU work, keep it off the event loop
+        keys = await run_in_threadpool(key_pool.take, count)
+    else:
+        keys = key_pool.take(count)
+    key_pool.refill_soon()
+    return keys
+
+
+async def _render(query_set: WireGuardQuerySets, name: str) -> None:
+    # the peer is already live, a stale config file is only logged
+    try:
+        await config_renderer.sync_interface(query_set, name)
+    except Exception as e:
+        logger.warning("Failed to render %s config: %s", name, e)
+
+
 @router.post("/interface", response_model=Dict[str, str])
-async def create_wg_interface(interface: WireGuardInterface):
+async def create_wg_interface(
+    interface: WireGuardInterface,
+    query_set: WireGuardQuerySets = Depends(get_wireguard_query_set),
+):
     try:
         if not interface.private_key:
-            keys = generate_keys()
-            interface.private_key = keys["private_key"]
-        
-        create_interface(
-            name=interface.name,
-            private_key=interface.private_key,
-            listen_port=interface.listen_port,
-            address=interface.address,
-            dns=interface.dns
+            interface.private_key = (await _take_keys(1))[0]["private_key"]
+        await query_set.register_interface(
+            interface.name,
+            interface.address,
+            await run_in_threadpool(derive_public_key, interface.private_key),
+            interface.listen_port,
+            interface.dns,
+        )
+        # the one write of the config file, with any peers already provisioned
+        await config_renderer.sync_interface(
+            query_set, interface.name, interface.private_key
         )
         return {
             "message": "Interface configuration created successfully",
-            "note": "To activate the interface, you need to run 'sudo wg-quick up <config_path>' with the generated configuration file"
+            "note": "To activate the interface, you need to run 'sudo wg-quick up <config_path>' with the generated configuration file",
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@router.post("/keys")
+async def generate_wg_keys(count: int = Query(1, ge=1, le=KEYS_MAX_COUNT)):
+    return await _take_keys(count)
+
+
 @router.post("/interface/{name}/peer")
 async def add_wg_peer(name: str, peer: WireGuardPeer):
     try:
-        add_peer(
+        await add_peer(
             interface=name,
             public_key=peer.public_key,
             allowed_ips=peer.allowed_ips,
             endpoint=peer.endpoint,
-            persistent_keepalive=peer.persistent_keepalive
+            persistent_keepalive=peer.persistent_keepalive,
         )
         return {"message": "Peer configuration added successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@router.post("/interface/{name}/peers:batch")
+async def batch_wg_peers(
+    name: str,
+    batch: WireGuardPeerBatch,
+    query_set: WireGuardQuerySets = Depends(get_wireguard_query_set),
+):
+    try:
+        counts = await apply_peer_batch(
+            interface=name,
+            upsert=[
+                make_peer(
+                    public_key=peer.public_key,
+                    allowed_ips=peer.allowed_ips,
+                    endpoint=peer.endpoint,
+                    persistent_keepalive=peer.persistent_keepalive,
+                )
+                for peer in batch.upsert
+            ],
+            remove=batch.remove,
+        )
+        released = await asyncio.gather(
+            *(query_set.release_peer(name, public_key) for public_key in batch.remove)
+        )
+        if any(released):
+            await _render(query_set, name)
+        return {"message": "Peers updated successfully", **counts}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.delete("/interface/{name}/peer/{public_key}")
-async def remove_wg_peer(name: str, public_key: str):
+async def remove_wg_peer(
+    name: str,
+    public_key: str,
+    query_set: WireGuardQuerySets = Depends(get_wireguard_query_set),
+):
     try:
-        remove_peer(interface=name, public_key=public_key)
+        await remove_peer(interface=name, public_key=public_key)
+        if await query_set.release_peer(name, public_key):
+            await _render(query_set, name)
         return {"message": "Peer removed successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@router.post("/interface/{name}/provision")
+async def provision_wg_peer(
+    name: str,
+    request: WireGuardProvision,
+    query_set: WireGuardQuerySets = Depends(get_wireguard_query_set),
+):
+    keypair = None
+    public_key = request.public_key
+    if not public_key:
+        keypair = (await _take_keys(1))[0]
+        public_key = keypair["public_key"]
+
+    record = await query_set.provision_peer(
+        name, request.username, public_key, request.persistent_keepalive
+    )
+    try:
+        await add_peer(
+            interface=name,
+            public_key=public_key,
+            allowed_ips=f"{record['address']}/32",
+            persistent_keepalive=request.persistent_keepalive,
+        )
+    except Exception as e:
+        await query_set.release_peer(name, public_key)
+        raise HTTPException(status_code=500, detail=str(e))
+    await _render(query_set, name)
+    if keypair is not None:
+        record["private_key"] = keypair["private_key"]
+    return record
+
+
+@router.get("/users/{username}/peers")
+async def list_wg_user_peers(
+    username: str, query_set: WireGuardQuerySets = Depends(get_wireguard_query_set)
+):
+    peers = await query_set.list_user_peers_json(username)
+    return Response(b"[" + b",".join(peers) + b"]", media_type="application/json")
+
+
+@router.get("/lookup")
+async def lookup_wg_peers(ip: Optional[str] = None, endpoint: Optional[str] = None):
+    if not ip and not endpoint:
+        raise HTTPException(status_code=400, detail="Pass ip or endpoint")
+    try:
+        await peer_index.watch()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if ip:
+        try:
+            return peer_index.lookup_ip(ip)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return peer_index.lookup_endpoint(endpoint)
+
+
 @router.get("/interface/{name}")
-async def get_wg_interface(name: str):
+async def get_wg_interface(
+    name: str,
+    since_handshake: Optional[int] = None,
+    public_key: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    offset: int = Query(0, ge=0),
+    since_revision: Optional[str] = None,
+):
     try:
-        return get_interface_info(name)
+        return await status_cache.query(
+            name,
+            since_handshake=since_handshake,
+            public_key=public_key,
+            limit=limit,
+            offset=offset,
+            since_revision=since_revision,
+        )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/interface/{name}/traffic")
+async def stream_wg_traffic(name: str):
+    return StreamingResponse(
+        _traffic_events(name),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _traffic_events(name: str):
+    async for event in traffic_feeds.subscribe(name, heartbeat=FEED_HEARTBEAT):
+        if event is None:
+            yield ": keepalive\n\n"
+        else:
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+
+
+@router.websocket("/interface/{name}/traffic/ws")
+async def websocket_wg_traffic(websocket: WebSocket, name: str):
+    await websocket.accept()
+    try:
+        async with aclosing(
+            traffic_feeds.subscribe(name, heartbeat=FEED_HEARTBEAT)
+        ) as events:
+            async for event in events:
+                # keepalives also surface a client that went away while idle
+                await websocket.send_json(event or {"name": name, "keepalive": True})
+    except WebSocketDisconnect:
+        pass
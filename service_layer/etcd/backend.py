@@ -0,0 +1,163 @@
+import itertools
+import os
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+)
+
+from etcd3 import etcdrpc, transactions
+from etcd3.client import Transactions
+
+from service_layer.etcd.storage import EtcdStorage, KeyValue, prefix_end
+
+# etcd, memory or sqlite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "etcd")
+
+
+class Storage(Protocol):
+    """What query sets need from a key-value store.
+
+    Keys sort as bytes, every write bumps one store-wide revision and
+    ``txn`` takes ``transactions`` compares and operations, applying either
+    ``success`` or ``failure`` atomically. Implemented by ``EtcdStorage``,
+    ``MemoryStorage`` and ``SQLiteStorage``.
+    """
+
+    transactions: Transactions
+
+    async def ping(self) -> dict: ...
+
+    async def get(self, key: str) -> Optional[bytes]: ...
+
+    async def get_with_revision(self, key: str) -> Tuple[Optional[bytes], int]: ...
+
+    async def put(self, key: str, value: bytes) -> None: ...
+
+    async def delete(self, key: str) -> bool: ...
+
+    async def range(
+        self,
+        start: str,
+        end: bytes,
+        limit: Optional[int] = None,
+        keys_only: bool = False,
+    ) -> List[KeyValue]: ...
+
+    async def get_prefix(
+        self, prefix: str, keys_only: bool = False
+    ) -> List[KeyValue]: ...
+
+    async def snapshot(self, prefix: str) -> Tuple[List[KeyValue], int]: ...
+
+    async def watch_prefix(
+        self,
+        prefix: str,
+        callback: Callable[[Optional[List[KeyValue]]], None],
+        start_revision: Optional[int] = None,
+    ) -> Callable[[], None]: ...
+
+    async def txn(
+        self, compare: Sequence, success: Sequence = (), failure: Sequence = ()
+    ) -> Tuple[bool, list]: ...
+
+    def close(self) -> None: ...
+
+
+class Entry(NamedTuple):
+    value: bytes
+    create_revision: int
+    mod_revision: int
+    version: int
+
+
+_OPERATORS: Dict[int, Callable[[Any, Any], bool]] = {
+    etcdrpc.Compare.EQUAL: lambda a, b: a == b,
+    etcdrpc.Compare.NOT_EQUAL: lambda a, b: a != b,
+    etcdrpc.Compare.LESS: lambda a, b: a < b,
+    etcdrpc.Compare.GREATER: lambda a, b: a > b,
+}
+
+
+def to_bytes(key) -> bytes:
+    return key if isinstance(key, bytes) else key.encode("utf-8")
+
+
+def compare_entry(item, entry: Optional[Entry]) -> bool:
+    """Evaluate one ``transactions`` compare the way etcd does"""
+    if isinstance(item, transactions.Value):
+        # etcd fails a value compare on a missing key
+        if entry is None:
+            return False
+        actual, expected = entry.value, to_bytes(item.value)
+    elif isinstance(item, transactions.Version):
+        actual, expected = entry.version if entry else 0, int(item.value)
+    elif isinstance(item, transactions.Create):
+        actual, expected = entry.create_revision if entry else 0, int(item.value)
+    elif isinstance(item, transactions.Mod):
+        actual, expected = entry.mod_revision if entry else 0, int(item.value)
+    else:
+        raise TypeError(f"Unsupported compare {item!r}")
+    return _OPERATORS[item.op](actual, expected)
+
+
+class Watchers:
+    """Prefix watches of a store that sees every write itself.
+
+    ``notify`` is called after each commit, so watchers get events in
+    revision order without a replay log.
+    """
+
+    def __init__(self):
+        self._watches: Dict[int, Tuple[bytes, bytes, Callable]] = {}
+        self._ids = itertools.count()
+
+    def add(
+        self, prefix: str, callback: Callable[[Optional[List[KeyValue]]], None]
+    ) -> Callable[[], None]:
+        watch_id = next(self._ids)
+        self._watches[watch_id] = (to_bytes(prefix), prefix_end(prefix), callback)
+        return lambda: self._watches.pop(watch_id, None)
+
+    def notify(self, events: List[KeyValue]) -> None:
+        if not events:
+            return
+        for start, end, callback in list(self._watches.values()):
+            matching = [event for event in events if start <= to_bytes(event.key) < end]
+            if matching:
+                callback(matching)
+
+    def clear(self) -> None:
+        self._watches.clear()
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    """Build the storage named by ``STORAGE_BACKEND``"""
+    if backend == "etcd":
+        return EtcdStorage()
+    if backend == "memory":
+        from service_layer.etcd.memory import MemoryStorage
+
+        return MemoryStorage()
+    if backend == "sqlite":
+        from service_layer.etcd.sqlite import SQLiteStorage
+
+        return SQLiteStorage()
+    raise ValueError(f"Unknown storage backend {backend}")
+
+
+_storage: Optional[Storage] = None
+
+
+def get_storage() -> Storage:
+    """The storage shared by query sets built without one, e.g. in CLI commands"""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from service_layer.etcd.storage import KeyValue
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_RESTART_DELAY = float(os.getenv("CACHE_RESTART_DELAY", "1.0"))
+
+logger = logging.getLogger(__name__)
+
+
+class WatchCache:
+    """Bounded in-process copy of one etcd prefix.
+
+    The cache is filled with a single prefix range on ``start`` and then kept
+    fresh by a watch on the same prefix, so a hit never needs a gRPC call.
+    Entries remember the revision they were read at and older data never
+    overwrites newer data, whichever of a read-through or a watch event lands
+    first. Deleted keys stay cached as ``None`` until evicted. While the
+    watch is down every lookup is a miss.
+
+    Listeners are called with each key that changed, or with ``None`` when
+    the watch broke and any key may have changed.
+    """
+
+    def __init__(self, storage, prefix: str, max_entries: int = CACHE_MAX_ENTRIES):
+        self.storage = storage
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.live = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[Optional[bytes], int]]" = OrderedDict()
+        # newest revision the watch delivered, reads from a lagging member are older
+        self.revision = 0
+        self._lock = threading.Lock()
+        self._cancel: Optional[Callable[[], None]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._listeners: List[Callable[[Optional[str]], None]] = []
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        items, revision = await self.storage.snapshot(self.prefix)
+        with self._lock:
+            self._entries.clear()
+            self.revision = revision
+            for item in items[: self.max_entries]:
+                self._entries[item.key] = (item.value, revision)
+        self._cancel = await self.storage.watch_prefix(
+            self.prefix, self._on_events, start_revision=revision + 1
+        )
+        self.live = True
+
+    def stop(self) -> None:
+        self.live = False
+        if self._cancel is not None:
+            self._cancel()
+            self._cancel = None
+
+    def get(self, key: str) -> Tuple[bool, Optional[bytes]]:
+        """Return ``(found, value)``; a cached delete is ``(True, None)``"""
+        with self._lock:
+            entry = self._entries.get(key) if self.live else None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def store(self, key: str, value: Optional[bytes], revision: int) -> None:
+        """Remember a value read through from etcd at ``revision``"""
+        if self.live and revision >= self.revision:
+            with self._lock:
+                self._apply(key, value, revision)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+        self._notify(key)
+
+    def add_listener(self, callback: Callable[[Optional[str]], None]) -> None:
+        self._listeners.append(callback)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _apply(self, key: str, value: Optional[bytes], revision: int) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] >= revision:
+            return
+        self._entries[key] = (value, revision)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _on_events(self, events: Optional[List[KeyValue]]) -> None:
+        # runs on the etcd3 watch thread
+        if events is None:
+            logger.warning("Watch on %s broke, restarting", self.prefix)
+            self.live = False
+            with self._lock:
+                self._entries.clear()
+            self._notify(None)
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(
+                    lambda: asyncio.ensure_future(self._restart())
+                )
+            return
+        with self._lock:
+            for event in events:
+                self._apply(event.key, event.value, event.mod_revision)
+                self.revision = max(self.revision, event.mod_revision)
+        for event in events:
+            self._notify(event.key)
+
+    def _notify(self, key: Optional[str]) -> None:
+        for callback in self._listeners:
+            callback(key)
+
+    async def _restart(self) -> None:
+        self.stop()
+        while not self.live:
+            await asyncio.sleep(CACHE_RESTART_DELAY)
+            try:
+                await self.start()
+            except Exception:
+                logger.exception("Failed to restart watch on %s", self.prefix)
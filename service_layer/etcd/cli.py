@@ -0,0 +1,46 @@
+import asyncio
+from typing import List, Optional
+import typer
+from query_sets.vpn_config import VpnConfigQuerySets
+from service_layer.etcd.codec import MIGRATE_PREFIXES, Codec, migrate_prefix
+from service_layer.etcd.backend import get_storage
+from service_layer.etcd.storage import ETCD_TXN_MAX_OPS
+
+app = typer.Typer()
+
+
+@app.command()
+def migrate_values(
+    codec: Optional[str] = None,
+    prefix: Optional[List[str]] = None,
+    chunk_size: int = ETCD_TXN_MAX_OPS,
+) -> dict:
+    """Rewrite stored values in the configured codec, chunk by chunk"""
+    target = Codec(codec) if codec else Codec()
+    storage = get_storage()
+
+    async def migrate() -> dict:
+        return {
+            name: await migrate_prefix(storage, name, target, chunk_size)
+            for name in prefix or MIGRATE_PREFIXES
+        }
+
+    results = asyncio.run(migrate())
+    for name, counts in results.items():
+        print(
+            f"{name}: {counts['migrated']} migrated, {counts['current']} current, "
+            f"{counts['conflicts']} changed meanwhile"
+        )
+    return results
+
+
+@app.command()
+def reindex_configs(chunk_size: int = ETCD_TXN_MAX_OPS) -> dict:
+    """Write the owner, server and protocol index keys of existing configs"""
+    counts = asyncio.run(VpnConfigQuerySets(get_storage()).reindex_configs(chunk_size))
+    print(f"{counts['indexed']} indexed, {counts['conflicts']} changed meanwhile")
+    return counts
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,166 @@
+import json
+import os
+from typing import Any, Dict, Iterable, Optional
+
+import orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from service_layer.etcd.storage import ETCD_TXN_MAX_OPS, prefix_end
+
+ETCD_CODEC = os.getenv("ETCD_CODEC", "orjson")
+# values at least this large are zstd compressed when zstandard is installed, 0 disables
+ETCD_COMPRESS_MIN_BYTES = int(os.getenv("ETCD_COMPRESS_MIN_BYTES", "4096"))
+ETCD_COMPRESS_LEVEL = int(os.getenv("ETCD_COMPRESS_LEVEL", "3"))
+
+# JSON text never starts with a control byte, so these cannot clash with
+# values written before the codec existed
+ORJSON = 0x01
+MSGPACK = 0x02
+ZSTD = 0x03
+
+# keys holding codec values, claim keys under /vpn/wireguard/ips/ are raw
+MIGRATE_PREFIXES = (
+    "/vpn/users/",
+    "/vpn/configs/",
+    "/vpn/wireguard/interfaces/",
+    "/vpn/wireguard/peers/",
+    "/vpn/wireguard/users/",
+)
+
+
+class Codec:
+    """Encodes values stored in etcd behind a one byte format header.
+
+    ``name`` picks the format new values are written in: ``orjson``,
+    ``msgpack`` or ``json`` (plain JSON without a header, readable by older
+    releases). Every format, and headerless JSON from before the codec, is
+    always readable. Large values are zstd compressed when zstandard is
+    installed.
+    """
+
+    def __init__(
+        self,
+        name: str = ETCD_CODEC,
+        compress_min_bytes: int = ETCD_COMPRESS_MIN_BYTES,
+        compress_level: int = ETCD_COMPRESS_LEVEL,
+    ):
+        if name not in ("orjson", "msgpack", "json"):
+            raise ValueError(f"Unknown codec {name}")
+        if name == "msgpack" and msgpack is None:
+            raise ValueError("The msgpack codec needs the msgpack package")
+        self.name = name
+        self.compress_min_bytes = compress_min_bytes if zstandard is not None else 0
+        if self.compress_min_bytes:
+            self._compressor = zstandard.ZstdCompressor(level=compress_level)
+        if zstandard is not None:
+            self._decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, value: Any) -> bytes:
+        if self.name == "json":
+            return json.dumps(value).encode("utf-8")
+        if self.name == "msgpack":
+            data = bytes((MSGPACK,)) + msgpack.packb(value)
+        else:
+            data = bytes((ORJSON,)) + orjson.dumps(
+                value, option=orjson.OPT_NON_STR_KEYS
+            )
+        if self.compress_min_bytes and len(data) >= self.compress_min_bytes:
+            return bytes((ZSTD,)) + self._compressor.compress(data)
+        return data
+
+    def decode(self, data: bytes) -> Any:
+        header = data[0] if data else None
+        if header == ZSTD:
+            if zstandard is None:
+                raise ValueError(
+                    "Value is zstd compressed but zstandard is not installed"
+                )
+            return self.decode(self._decompressor.decompress(data[1:]))
+        if header == ORJSON:
+            return orjson.loads(data[1:])
+        if header == MSGPACK:
+            if msgpack is None:
+                raise ValueError(
+                    "Value is msgpack encoded but msgpack is not installed"
+                )
+            return msgpack.unpackb(data[1:])
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity written by json.dumps
+            return json.loads(data)
+
+    def raw_json(self, data: bytes) -> bytes:
+        """The value as JSON text, sliced out of orjson values without
+        decoding them"""
+        if data[:1] == bytes((ORJSON,)):
+            return data[1:]
+        # headerless JSON from json.dumps may hold NaN or Infinity, which
+        # are not JSON; orjson writes them as null
+        return orjson.dumps(self.decode(data), option=orjson.OPT_NON_STR_KEYS)
+
+
+codec = Codec()
+
+
+async def migrate_prefix(
+    storage,
+    prefix: str,
+    target: Optional[Codec] = None,
+    chunk_size: int = ETCD_TXN_MAX_OPS,
+) -> Dict[str, int]:
+    """Rewrite every value under ``prefix`` in the ``target`` format.
+
+    Keys are read and rewritten ``chunk_size`` at a time, each chunk in one
+    transaction guarded by the revisions it was read at. A key changed in
+    the meantime was rewritten by a current writer and is left alone.
+    """
+    target = target or codec
+    transactions = storage.transactions
+    counts = {"migrated": 0, "current": 0, "conflicts": 0}
+    start, end = prefix, prefix_end(prefix)
+    while True:
+        page = await storage.range(start, end, limit=chunk_size)
+        pending = []
+        for item in page:
+            data = target.encode(target.decode(item.value))
+            if data == item.value:
+                counts["current"] += 1
+            else:
+                pending.append((item, data))
+        if pending:
+            migrated, _ = await storage.txn(
+                compare=[
+                    transactions.mod(item.key) == item.mod_revision
+                    for item, _ in pending
+                ],
+                success=[transactions.put(item.key, data) for item, data in pending],
+            )
+            if migrated:
+                counts["migrated"] += len(pending)
+            else:
+                await _migrate_one_by_one(storage, pending, counts)
+        if len(page) < chunk_size:
+            return counts
+        start = page[-1].key + "\0"
+
+
+async def _migrate_one_by_one(
+    storage, pending: Iterable, counts: Dict[str, int]
+) -> None:
+    transactions = storage.transactions
+    for item, data in pending:
+        migrated, _ = await storage.txn(
+            compare=[transactions.mod(item.key) == item.mod_revision],
+            success=[transactions.put(item.key, data)],
+        )
+        counts["migrated" if migrated else "conflicts"] += 1
@@ -0,0 +1,67 @@
+import asyncio
+import os
+from typing import List, Optional
+
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "1000"))
+
+
+class IdAllocator:
+    """Unique ids served from blocks leased off a shared etcd counter.
+
+    The counter holds the highest id leased by any process. A block is taken
+    with one compare-and-swap transaction on the counter, so workers on any
+    node never get overlapping blocks, and ids inside a block are handed out
+    from memory without an etcd call. Ids stay unique but are not dense:
+    whatever is left of a block when the process exits is skipped.
+    """
+
+    def __init__(self, storage, counter_key: str, block_size: int = ID_BLOCK_SIZE):
+        self.storage = storage
+        self.counter_key = counter_key
+        self.block_size = block_size
+        self._next = 1
+        self._end = 0
+        self._seen: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def available(self) -> int:
+        return self._end - self._next + 1
+
+    async def next_id(self) -> int:
+        return (await self.next_ids(1))[0]
+
+    async def next_ids(self, count: int) -> List[int]:
+        if self.available < count:
+            async with self._lock:
+                if self.available < count:
+                    await self._lease(max(self.block_size, count))
+        ids = list(range(self._next, self._next + count))
+        self._next += count
+        return ids
+
+    async def _lease(self, size: int) -> None:
+        transactions = self.storage.transactions
+        guess = self._seen
+        while True:
+            if guess is None:
+                compare = [transactions.version(self.counter_key) == 0]
+            else:
+                compare = [transactions.value(self.counter_key) == str(guess)]
+            start = guess or 0
+            end = start + size
+            succeeded, responses = await self.storage.txn(
+                compare,
+                success=[transactions.put(self.counter_key, str(end).encode("utf-8"))],
+                failure=[transactions.get(self.counter_key)],
+            )
+            if succeeded:
+                break
+            current = responses[0]
+            guess = int(current[0].value.decode("utf-8")) if current else None
+
+        self._seen = end
+        if self._end != start:
+            # another process leased in between, drop what is left of ours
+            self._next = start + 1
+        self._end = end
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+from bisect import bisect_left, insort
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from etcd3 import transactions
+from etcd3.client import Transactions
+
+from service_layer.etcd.backend import Entry, Watchers, compare_entry, to_bytes
+from service_layer.etcd.storage import KeyValue, prefix_end
+
+
+class MemoryStorage:
+    """An in-process stand-in for ``EtcdStorage``.
+
+    It keeps one revision counter like etcd: every write or write
+    transaction bumps it once, keys remember their create and mod revisions
+    and their version, and transactions compare and apply atomically with
+    the same ``Transactions`` operations. Watches are called right after
+    each write instead of from a watch thread.
+    """
+
+    transactions = Transactions()
+
+    def __init__(self):
+        self.revision = 1
+        self._data: Dict[bytes, Entry] = {}
+        self._keys: List[bytes] = []
+        self._watchers = Watchers()
+        self._lock = threading.Lock()
+
+    async def ping(self) -> dict:
+        return {"memory": "ok"}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        await asyncio.sleep(0)
+        entry = self._data.get(to_bytes(key))
+        return entry.value if entry is not None else None
+
+    async def get_with_revision(self, key: str) -> Tuple[Optional[bytes], int]:
+        await asyncio.sleep(0)
+        with self._lock:
+            entry = self._data.get(to_bytes(key))
+            return (entry.value if entry is not None else None), self.revision
+
+    async def put(self, key: str, value: bytes) -> None:
+        await self.txn([], [self.transactions.put(key, value)])
+
+    async def delete(self, key: str) -> bool:
+        _, (deleted,) = await self.txn([], [self.transactions.delete(key)])
+        return deleted > 0
+
+    async def range(
+        self,
+        start: str,
+        end: bytes,
+        limit: Optional[int] = None,
+        keys_only: bool = False,
+    ) -> List[KeyValue]:
+        await asyncio.sleep(0)
+        with self._lock:
+            return self._range(to_bytes(start), to_bytes(end), limit, keys_only)
+
+    async def get_prefix(self, prefix: str, keys_only: bool = False) -> List[KeyValue]:
+        return await self.range(prefix, prefix_end(prefix), keys_only=keys_only)
+
+    async def snapshot(self, prefix: str) -> Tuple[List[KeyValue], int]:
+        await asyncio.sleep(0)
+        with self._lock:
+            start = to_bytes(prefix)
+            return self._range(start, prefix_end(prefix), None, False), self.revision
+
+    async def watch_prefix(
+        self,
+        prefix: str,
+        callback: Callable[[Optional[List[KeyValue]]], None],
+        start_revision: Optional[int] = None,
+    ) -> Callable[[], None]:
+        # nothing is kept to replay, every write up to now is in the snapshot
+        return self._watchers.add(prefix, callback)
+
+    async def txn(
+        self, compare: Sequence, success: Sequence = (), failure: Sequence = ()
+    ) -> Tuple[bool, list]:
+        await asyncio.sleep(0)
+        with self._lock:
+            succeeded = all(
+                compare_entry(item, self._data.get(to_bytes(item.key)))
+                for item in compare
+            )
+            ops = success if succeeded else failure
+            revision = self.revision + 1
+            responses, events = [], []
+            for op in ops:
+                responses.append(self._apply(op, revision, events))
+            if events:
+                self.revision = revision
+        self._watchers.notify(events)
+        return succeeded, responses
+
+    def close(self) -> None:
+        self._watchers.clear()
+
+    def _range(
+        self, start: bytes, end: Optional[bytes], limit: Optional[int], keys_only: bool
+    ) -> List[KeyValue]:
+        if end is None:
+            entry = self._data.get(start)
+            return [self._key_value(start, entry, keys_only)] if entry else []
+        items = []
+        for key in self._keys[
+            bisect_left(self._keys, start) : bisect_left(self._keys, end)
+        ]:
+            items.append(self._key_value(key, self._data[key], keys_only))
+            if limit and len(items) == limit:
+                break
+        return items
+
+    @staticmethod
+    def _key_value(key: bytes, entry: Entry, keys_only: bool) -> KeyValue:
+        return KeyValue(
+            key.decode("utf-8"), b"" if keys_only else entry.value, entry.mod_revision
+        )
+
+    def _apply(self, op, revision: int, events: List[KeyValue]) -> Any:
+        key = to_bytes(op.key)
+        if isinstance(op, transactions.Put):
+            entry = self._data.get(key)
+            if entry is None:
+                insort(self._keys, key)
+                entry = Entry(to_bytes(op.value), revision, revision, 1)
+            else:
+                entry = Entry(
+                    to_bytes(op.value),
+                    entry.create_revision,
+                    revision,
+                    entry.version + 1,
+                )
+            self._data[key] = entry
+            events.append(KeyValue(key.decode("utf-8"), entry.value, revision))
+            return None
+        if isinstance(op, transactions.Get):
+            end = to_bytes(op.range_end) if op.range_end is not None else None
+            return self._range(key, end, None, False)
+        if isinstance(op, transactions.Delete):
+            if op.range_end is None:
+                keys = [key] if key in self._data else []
+            else:
+                end = to_bytes(op.range_end)
+                keys = self._keys[
+                    bisect_left(self._keys, key) : bisect_left(self._keys, end)
+                ]
+            for deleted in keys:
+                del self._data[deleted]
+                del self._keys[bisect_left(self._keys, deleted)]
+                events.append(KeyValue(deleted.decode("utf-8"), None, revision))
+            return len(keys)
+        raise TypeError(f"Unsupported transaction operation {op!r}")
@@ -0,0 +1,230 @@
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from etcd3 import transactions
+from etcd3.client import Transactions
+
+from service_layer.etcd.backend import Entry, Watchers, compare_entry, to_bytes
+from service_layer.etcd.storage import KeyValue, prefix_end
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "vpn.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL,
+    create_revision INTEGER NOT NULL,
+    mod_revision INTEGER NOT NULL,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta VALUES ('revision', 1);
+"""
+
+
+class SQLiteStorage:
+    """The storage interface on an embedded SQLite file, for single-node installs.
+
+    Keys are BLOBs, which SQLite orders bytewise like etcd. Every call runs
+    on one dedicated thread, so a transaction's compares and writes happen
+    in one ``BEGIN IMMEDIATE`` block and bump the stored revision once, the
+    same as etcd. Watches only see writes made through this instance, so
+    one process should own the file.
+    """
+
+    transactions = Transactions()
+
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._connection: Optional[sqlite3.Connection] = None
+        self._watchers = Watchers()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    async def _call(self, func, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def ping(self) -> dict:
+        await self._call(self._db)
+        return {self.path: "ok"}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value, _ = await self.get_with_revision(key)
+        return value
+
+    async def get_with_revision(self, key: str) -> Tuple[Optional[bytes], int]:
+        return await self._call(self._get_with_revision, to_bytes(key))
+
+    async def put(self, key: str, value: bytes) -> None:
+        await self.txn([], [self.transactions.put(key, value)])
+
+    async def delete(self, key: str) -> bool:
+        _, (deleted,) = await self.txn([], [self.transactions.delete(key)])
+        return deleted > 0
+
+    async def range(
+        self,
+        start: str,
+        end: bytes,
+        limit: Optional[int] = None,
+        keys_only: bool = False,
+    ) -> List[KeyValue]:
+        return await self._call(
+            self._range, to_bytes(start), to_bytes(end), limit, keys_only
+        )
+
+    async def get_prefix(self, prefix: str, keys_only: bool = False) -> List[KeyValue]:
+        return await self.range(prefix, prefix_end(prefix), keys_only=keys_only)
+
+    async def snapshot(self, prefix: str) -> Tuple[List[KeyValue], int]:
+        return await self._call(self._snapshot, to_bytes(prefix), prefix_end(prefix))
+
+    async def watch_prefix(
+        self,
+        prefix: str,
+        callback: Callable[[Optional[List[KeyValue]]], None],
+        start_revision: Optional[int] = None,
+    ) -> Callable[[], None]:
+        return self._watchers.add(prefix, callback)
+
+    async def txn(
+        self, compare: Sequence, success: Sequence = (), failure: Sequence = ()
+    ) -> Tuple[bool, list]:
+        succeeded, responses, events = await self._call(
+            self._txn, list(compare), list(success), list(failure)
+        )
+        self._watchers.notify(events)
+        return succeeded, responses
+
+    def close(self) -> None:
+        self._watchers.clear()
+        if self._connection is not None:
+            self._executor.submit(self._connection.close).result()
+            self._connection = None
+        self._executor.shutdown(wait=False)
+
+    # everything below runs on the storage thread
+
+    def _revision(self) -> int:
+        (revision,) = (
+            self._db()
+            .execute("SELECT value FROM meta WHERE name = 'revision'")
+            .fetchone()
+        )
+        return revision
+
+    def _entry(self, key: bytes) -> Optional[Entry]:
+        row = (
+            self._db()
+            .execute(
+                "SELECT value, create_revision, mod_revision, version FROM kv WHERE key = ?",
+                (key,),
+            )
+            .fetchone()
+        )
+        return Entry(*row) if row is not None else None
+
+    def _get_with_revision(self, key: bytes) -> Tuple[Optional[bytes], int]:
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            entry = self._entry(key)
+            return (entry.value if entry else None), self._revision()
+        finally:
+            db.execute("COMMIT")
+
+    def _range(
+        self, start: bytes, end: Optional[bytes], limit: Optional[int], keys_only: bool
+    ) -> List[KeyValue]:
+        column = "x''" if keys_only else "value"
+        if end is None:
+            query = f"SELECT key, {column}, mod_revision FROM kv WHERE key = ?"
+            params: tuple = (start,)
+        else:
+            query = (
+                f"SELECT key, {column}, mod_revision FROM kv "
+                "WHERE key >= ? AND key < ? ORDER BY key"
+            )
+            params = (start, end)
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return [
+            KeyValue(key.decode("utf-8"), value, mod_revision)
+            for key, value, mod_revision in self._db().execute(query, params)
+        ]
+
+    def _snapshot(self, start: bytes, end: bytes) -> Tuple[List[KeyValue], int]:
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            return self._range(start, end, None, False), self._revision()
+        finally:
+            db.execute("COMMIT")
+
+    def _txn(
+        self, compare: list, success: list, failure: list
+    ) -> Tuple[bool, list, List[KeyValue]]:
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            succeeded = all(
+                compare_entry(item, self._entry(to_bytes(item.key))) for item in compare
+            )
+            revision = self._revision() + 1
+            responses, events = [], []
+            for op in success if succeeded else failure:
+                responses.append(self._apply(op, revision, events))
+            if events:
+                db.execute(
+                    "UPDATE meta SET value = ? WHERE name = 'revision'", (revision,)
+                )
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return succeeded, responses, events
+
+    def _apply(self, op, revision: int, events: List[KeyValue]) -> Any:
+        db = self._db()
+        key = to_bytes(op.key)
+        if isinstance(op, transactions.Put):
+            value = to_bytes(op.value)
+            db.execute(
+                "INSERT INTO kv VALUES (?, ?, ?, ?, 1) ON CONFLICT (key) DO UPDATE "
+                "SET value = excluded.value, mod_revision = excluded.mod_revision, "
+                "version = version + 1",
+                (key, value, revision, revision),
+            )
+            events.append(KeyValue(key.decode("utf-8"), value, revision))
+            return None
+        if isinstance(op, transactions.Get):
+            end = to_bytes(op.range_end) if op.range_end is not None else None
+            return self._range(key, end, None, False)
+        if isinstance(op, transactions.Delete):
+            if op.range_end is None:
+                where, params = "key = ?", (key,)
+            else:
+                where, params = "key >= ? AND key < ?", (key, to_bytes(op.range_end))
+            deleted = [
+                row[0]
+                for row in db.execute(f"SELECT key FROM kv WHERE {where}", params)
+            ]
+            db.execute(f"DELETE FROM kv WHERE {where}", params)
+            for deleted_key in deleted:
+                events.append(KeyValue(deleted_key.decode("utf-8"), None, revision))
+            return len(deleted)
+        raise TypeError(f"Unsupported transaction operation {op!r}")
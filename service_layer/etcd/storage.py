@@ -0,0 +1,362 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import etcd3
+import grpc
+from etcd3 import events, utils
+from etcd3.client import Etcd3Client, Transactions
+from etcd3.exceptions import ConnectionFailedError, ConnectionTimeoutError
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from service_layer.metrics import etcd_call_seconds
+
+# comma separated host:port list, ETCD_HOST/ETCD_PORT name a single member
+ETCD_ENDPOINTS = os.getenv("ETCD_ENDPOINTS", "")
+ETCD_HOST = os.getenv("ETCD_HOST", "localhost")
+ETCD_PORT = int(os.getenv("ETCD_PORT", "2379"))
+ETCD_POOL_SIZE = int(os.getenv("ETCD_POOL_SIZE", "4"))
+ETCD_MAX_CONCURRENCY = int(os.getenv("ETCD_MAX_CONCURRENCY", "32"))
+ETCD_RETRY_ATTEMPTS = int(os.getenv("ETCD_RETRY_ATTEMPTS", "4"))
+# how long a member that failed is skipped while others are healthy
+ETCD_MEMBER_COOLDOWN = float(os.getenv("ETCD_MEMBER_COOLDOWN", "5"))
+# etcd rejects transactions with more operations than --max-txn-ops (128)
+ETCD_TXN_MAX_OPS = int(os.getenv("ETCD_TXN_MAX_OPS", "128"))
+
+logger = logging.getLogger(__name__)
+
+
+class KeyValue(NamedTuple):
+    key: str
+    value: Optional[bytes]
+    mod_revision: int
+
+
+def _to_key_values(kvs) -> List[KeyValue]:
+    return [KeyValue(kv.key.decode("utf-8"), kv.value, kv.mod_revision) for kv in kvs]
+
+
+def _range(
+    client: Etcd3Client,
+    start: str,
+    end: bytes,
+    limit: Optional[int],
+    keys_only: bool,
+) -> Tuple[List[KeyValue], int]:
+    # etcd3 accepts ``limit`` but never puts it on the request, so build it here
+    request = client._build_get_range_request(
+        start,
+        range_end=end,
+        sort_order="ascend",
+        keys_only=keys_only,
+        serializable=True,
+    )
+    if limit:
+        request.limit = limit
+    response = client.kvstub.Range(
+        request,
+        client.timeout,
+        credentials=client.call_credentials,
+        metadata=client.metadata,
+    )
+    return _to_key_values(response.kvs), response.header.revision
+
+
+def _get_with_revision(client: Etcd3Client, key: str) -> Tuple[Optional[bytes], int]:
+    response = client.get_response(key, serializable=True)
+    value = response.kvs[0].value if response.count else None
+    return value, response.header.revision
+
+
+def chunks(items: Sequence, size: int = ETCD_TXN_MAX_OPS) -> List[Sequence]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def prefix_end(prefix: str) -> bytes:
+    """Return the first key after every key that starts with ``prefix``"""
+    return utils.increment_last_byte(utils.to_bytes(prefix))
+
+
+def parse_endpoints(value: str = ETCD_ENDPOINTS) -> List[Tuple[str, int]]:
+    """``host:port,host:port`` to a list of members, ETCD_HOST/ETCD_PORT if empty"""
+    endpoints = []
+    for endpoint in value.split(","):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        if "://" in endpoint:
+            endpoint = endpoint.split("://", 1)[1]
+        host, _, port = endpoint.rpartition(":")
+        if not host:
+            host, port = port, str(ETCD_PORT)
+        endpoints.append((host, int(port)))
+    return endpoints or [(ETCD_HOST, ETCD_PORT)]
+
+
+def _retryable(error: BaseException, write: bool = False) -> bool:
+    # a write that timed out may still have been applied, only a refused
+    # connection is known not to have reached the cluster
+    if isinstance(error, ConnectionFailedError):
+        return True
+    if isinstance(error, ConnectionTimeoutError):
+        return not write
+    if isinstance(error, grpc.RpcError):
+        code = error.code()
+        if code == grpc.StatusCode.UNAVAILABLE:
+            return True
+        return code == grpc.StatusCode.DEADLINE_EXCEEDED and not write
+    return False
+
+
+class Member:
+    def __init__(self, host: str, port: int, pool_size: int):
+        self.endpoint = (host, port)
+        self.clients = [etcd3.client(host=host, port=port) for _ in range(pool_size)]
+        self._channels = itertools.cycle(self.clients)
+        self.failed_at = 0.0
+
+    def next_client(self) -> Etcd3Client:
+        return next(self._channels)
+
+    def healthy(self, cooldown: float) -> bool:
+        return time.monotonic() - self.failed_at >= cooldown
+
+
+class EtcdStorage:
+    """Non-blocking etcd access shared by every query set.
+
+    etcd3 only ships a blocking gRPC client, so each call is handed to a
+    bounded thread pool and the channels of the pool are used round-robin.
+    ``max_concurrency`` caps the number of etcd calls in flight per worker;
+    callers beyond the cap wait without holding the event loop.
+
+    With several ``endpoints`` reads are serializable and spread over the
+    members, while writes go to the leader. A member that fails is skipped
+    for ``cooldown`` seconds and the call is retried on another one with
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        endpoints: Optional[Sequence[Tuple[str, int]]] = None,
+        pool_size: int = ETCD_POOL_SIZE,
+        max_concurrency: int = ETCD_MAX_CONCURRENCY,
+        retry_attempts: int = ETCD_RETRY_ATTEMPTS,
+        cooldown: float = ETCD_MEMBER_COOLDOWN,
+    ):
+        endpoints = endpoints or parse_endpoints()
+        self.members = [Member(host, port, pool_size) for host, port in endpoints]
+        self._clients = [client for member in self.members for client in member.clients]
+        self._readers = itertools.cycle(self.members)
+        self._leader: Optional[Member] = None
+        self.retry_attempts = retry_attempts
+        self.cooldown = cooldown
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="etcd"
+        )
+        self.transactions = Transactions()
+
+    def _reader(self) -> Member:
+        for _ in self.members:
+            member = next(self._readers)
+            if member.healthy(self.cooldown):
+                return member
+        # every member failed recently, try the one that failed longest ago
+        return min(self.members, key=lambda member: member.failed_at)
+
+    async def _writer(self) -> Member:
+        if self._leader is None or not self._leader.healthy(self.cooldown):
+            self._leader = await self._find_leader()
+        return self._leader
+
+    async def _find_leader(self) -> Member:
+        if len(self.members) == 1:
+            return self.members[0]
+        member = self._reader()
+        loop = asyncio.get_running_loop()
+        try:
+            status = await loop.run_in_executor(
+                self._executor, member.next_client().status
+            )
+            urls = status.leader.client_urls if status.leader else []
+        except Exception as e:
+            logger.warning(
+                "Could not find the etcd leader via %s: %s", member.endpoint, e
+            )
+            return member
+        for url in urls:
+            parsed = urlparse(url)
+            for candidate in self.members:
+                if candidate.endpoint == (parsed.hostname, parsed.port):
+                    return candidate
+        # the leader advertises an address we were not given, any member
+        # forwards writes to it
+        return member
+
+    async def _run(self, func, *args, write: bool = False, **kwargs) -> Any:
+        """Call ``func(client, *args)`` on the next channel of a member.
+
+        Reads go to any healthy member and writes to the leader; calls that
+        fail because a member is unreachable are retried on another one.
+        """
+        loop = asyncio.get_running_loop()
+        with etcd_call_seconds.time(func.__name__.lstrip("_")):
+            async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(self.retry_attempts),
+                wait=wait_exponential_jitter(initial=0.05, max=1.0),
+                retry=retry_if_exception(partial(_retryable, write=write)),
+                reraise=True,
+            ):
+                with attempt:
+                    member = await self._writer() if write else self._reader()
+                    try:
+                        return await loop.run_in_executor(
+                            self._executor,
+                            partial(func, member.next_client(), *args, **kwargs),
+                        )
+                    except Exception as e:
+                        if _retryable(e):
+                            logger.warning(
+                                "etcd member %s failed: %s", member.endpoint, e
+                            )
+                            member.failed_at = time.monotonic()
+                            if member is self._leader:
+                                self._leader = None
+                        raise
+
+    async def ping(self) -> dict:
+        """Connect to every member at once; fails only if none answers"""
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, member.next_client().status)
+                for member in self.members
+            ),
+            return_exceptions=True,
+        )
+        status = {}
+        for member, result in zip(self.members, results):
+            host, port = member.endpoint
+            if isinstance(result, Exception):
+                member.failed_at = time.monotonic()
+                status[f"{host}:{port}"] = str(result) or type(result).__name__
+            else:
+                status[f"{host}:{port}"] = "ok"
+        if "ok" not in status.values():
+            raise ConnectionFailedError(f"No etcd member reachable: {status}")
+        return status
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value, _ = await self._run(Etcd3Client.get, key, serializable=True)
+        return value
+
+    async def put(self, key: str, value: bytes) -> None:
+        await self._run(Etcd3Client.put, key, value, write=True)
+
+    async def get_with_revision(self, key: str) -> Tuple[Optional[bytes], int]:
+        """Return the value of ``key`` and the store revision it was read at"""
+        return await self._run(_get_with_revision, key)
+
+    async def delete(self, key: str) -> bool:
+        return await self._run(Etcd3Client.delete, key, write=True)
+
+    async def range(
+        self,
+        start: str,
+        end: bytes,
+        limit: Optional[int] = None,
+        keys_only: bool = False,
+    ) -> List[KeyValue]:
+        """Read ``[start, end)`` in key order"""
+        items, _ = await self._run(_range, start, end, limit, keys_only)
+        return items
+
+    async def get_prefix(self, prefix: str, keys_only: bool = False) -> List[KeyValue]:
+        return await self.range(prefix, prefix_end(prefix), keys_only=keys_only)
+
+    async def snapshot(self, prefix: str) -> Tuple[List[KeyValue], int]:
+        """Read a whole prefix together with the store revision it was read at"""
+        return await self._run(_range, prefix, prefix_end(prefix), None, False)
+
+    async def watch_prefix(
+        self,
+        prefix: str,
+        callback: Callable[[Optional[List[KeyValue]]], None],
+        start_revision: Optional[int] = None,
+    ) -> Callable[[], None]:
+        """Stream changes under ``prefix`` to ``callback`` from the watch thread.
+
+        Deleted keys arrive with a ``None`` value. ``callback(None)`` means the
+        stream broke and events may have been lost. Returns a cancel function.
+        """
+        client = self._reader().clients[0]
+
+        def on_response(response):
+            if isinstance(response, Exception):
+                callback(None)
+                return
+            callback(
+                [
+                    KeyValue(
+                        event.key.decode("utf-8"),
+                        None if isinstance(event, events.DeleteEvent) else event.value,
+                        event.mod_revision,
+                    )
+                    for event in response.events
+                ]
+            )
+
+        loop = asyncio.get_running_loop()
+        watch_id = await loop.run_in_executor(
+            self._executor,
+            partial(
+                client.add_watch_prefix_callback,
+                prefix,
+                on_response,
+                start_revision=start_revision,
+            ),
+        )
+        return lambda: client.cancel_watch(watch_id)
+
+    async def txn(
+        self, compare: Sequence, success: Sequence = (), failure: Sequence = ()
+    ) -> Tuple[bool, list]:
+        """Run an etcd transaction built from ``self.transactions`` operations.
+
+        Responses are returned per operation: a list of ``KeyValue`` for gets,
+        the number of deleted keys for deletes and ``None`` for puts.
+        """
+        succeeded, responses = await self._run(
+            Etcd3Client.transaction,
+            list(compare),
+            list(success),
+            list(failure),
+            write=True,
+        )
+        return succeeded, [_normalize_response(response) for response in responses]
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        for client in self._clients:
+            client.close()
+
+
+def _normalize_response(response) -> Any:
+    if isinstance(response, list):
+        return [
+            KeyValue(meta.key.decode("utf-8"), value, meta.mod_revision)
+            for value, meta in response
+        ]
+    if response.WhichOneof("response") == "response_delete_range":
+        return response.response_delete_range.deleted
+    return None
@@ -0,0 +1,247 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# seconds, from a cached etcd read up to a slow bcrypt or wg call
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# returns (metric name, help, type, [(labels, value)]) for gauges read at scrape time
+Collector = Callable[[], List[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items())
+        + "}"
+    )
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """A latency histogram in the Prometheus text format.
+
+    Each label combination keeps per-bucket counts, a sum and a count;
+    buckets are made cumulative only when rendered, so ``observe`` is one
+    bisect and three additions.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                    0,
+                ]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values: str) -> int:
+        series = self._series.get(label_values)
+        return series[2] if series is not None else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in sorted(self._series.items())
+            ]
+        for key, counts, total, count in series:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(
+                    {**labels, "le": _format_value(float(bound))}
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}"
+            )
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._histograms: List[Histogram] = []
+        self._collectors: List[Collector] = []
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = ()) -> Histogram:
+        histogram = Histogram(name, help, labels)
+        self._histograms.append(histogram)
+        return histogram
+
+    def add_collector(self, collector: Collector) -> None:
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector: Collector) -> None:
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        for collector in list(self._collectors):
+            for name, help, kind, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(
+                        f"{name}{_format_labels(labels)} {_format_value(value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    "http_request_duration_seconds",
+    "Time until the response headers were sent, by route template",
+    ("method", "route", "status"),
+)
+etcd_query_seconds = registry.histogram(
+    "etcd_query_duration_seconds",
+    "Query set method latency, including decoding",
+    ("method",),
+)
+etcd_call_seconds = registry.histogram(
+    "etcd_call_duration_seconds",
+    "Single etcd round trip latency, including retries",
+    ("call",),
+)
+wg_command_seconds = registry.histogram(
+    "wg_command_duration_seconds", "wg subprocess latency", ("command",)
+)
+password_seconds = registry.histogram(
+    "password_hash_duration_seconds",
+    "bcrypt latency, including waiting for a hashing thread",
+    ("operation",),
+)
+jwt_seconds = registry.histogram(
+    "jwt_duration_seconds", "JWT encode and decode latency", ("operation",)
+)
+
+
+def timed(histogram: Histogram) -> Callable:
+    """Time a coroutine method, labelled with its name"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, func.__name__)
+
+        return wrapper
+
+    return decorator
+
+
+def wg_command(command: Sequence[str]) -> str:
+    # "wg show wg0 dump" -> "show", "wg-quick up ..." -> "wg-quick up"
+    if not command:
+        return ""
+    if command[0] == "wg" and len(command) > 1:
+        return command[1]
+    return " ".join(command[:2])
+
+
+class MetricsMiddleware:
+    """Observes every HTTP request in ``request_seconds``.
+
+    The route template rather than the raw path is the label, and time is
+    measured to the response start, so a streaming feed counts its time to
+    first byte instead of the life of the connection.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        observed = False
+
+        async def send_wrapper(message):
+            nonlocal observed
+            if message["type"] == "http.response.start" and not observed:
+                observed = True
+                self._observe(scope, start, message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not observed:
+                self._observe(scope, start, 500)
+
+    @staticmethod
+    def _observe(scope, start: float, status: int) -> None:
+        route = scope.get("route")
+        request_seconds.observe(
+            time.perf_counter() - start,
+            scope["method"],
+            getattr(route, "path", "<unmatched>"),
+            str(status),
+        )
@@ -0,0 +1,79 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from service_layer.metrics import password_seconds
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "64"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS
+)
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated thread pool instead of the event loop.
+
+    bcrypt releases the GIL, so ``workers`` threads hash in parallel. Once
+    ``queue_limit`` hashes are waiting or running, new requests are rejected
+    with 503 straight away instead of piling up behind a login burst.
+    """
+
+    def __init__(
+        self, workers: int = PASSWORD_WORKERS, queue_limit: int = PASSWORD_QUEUE_LIMIT
+    ):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt"
+        )
+
+    async def hash(self, password: str) -> str:
+        self._admit()
+        with password_seconds.time("hash"):
+            return await self._run(pwd_context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        self._admit()
+        with password_seconds.time("verify"):
+            return await self._run(pwd_context.verify, password, hashed)
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """Hash a bulk import one pool-sized wave at a time.
+
+        Waves are not subject to the queue limit, but interactive requests
+        only ever queue behind a single wave.
+        """
+        hashed: List[str] = []
+        for start in range(0, len(passwords), self.workers):
+            wave = passwords[start : start + self.workers]
+            hashed.extend(
+                await asyncio.gather(
+                    *(self._run(pwd_context.hash, password) for password in wave)
+                )
+            )
+        return hashed
+
+    def _admit(self) -> None:
+        if self.pending >= self.queue_limit:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many password checks in progress, retry later",
+                headers={"Retry-After": "1"},
+            )
+
+    async def _run(self, func, *args):
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+
+
+class TokenCache:
+    """Decoded access tokens and the user they resolve to, until ``exp``.
+
+    Entries are keyed by the SHA-256 of the token so raw tokens are never
+    held in memory, bounded with LRU eviction and dropped as soon as their
+    user changes. A lookup takes ``generation()`` before reading the user,
+    and ``put`` skips a user that changed since, so an invalidation that
+    lands during the read is not undone by a stale fill.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[bytes, Tuple[float, str, Dict[str, Any]]]" = (
+            OrderedDict()
+        )
+        self._by_user: Dict[str, Set[bytes]] = {}
+        # generation of each user's last change, users evicted from it
+        # count as changed at ``_floor``
+        self._generation = 0
+        self._changed: "OrderedDict[str, int]" = OrderedDict()
+        self._floor = 0
+        # invalidations arrive from the etcd watch thread
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def generation(self) -> int:
+        return self._generation
+
+    def put(
+        self,
+        token: str,
+        expires_at: float,
+        username: str,
+        user: Dict[str, Any],
+        generation: Optional[int] = None,
+    ) -> bool:
+        """Cache ``user`` for ``token`` unless it changed after ``generation``"""
+        key = self._key(token)
+        with self._lock:
+            if (
+                generation is not None
+                and self._changed.get(username, self._floor) > generation
+            ):
+                return False
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, username, user)
+            self._by_user.setdefault(username, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def invalidate_user(self, username: Optional[str]) -> None:
+        """Forget every token of ``username``, or every token for ``None``"""
+        with self._lock:
+            self._generation += 1
+            if username is None:
+                self._changed.clear()
+                self._floor = self._generation
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._by_user.clear()
+                return
+            self._changed[username] = self._generation
+            self._changed.move_to_end(username)
+            if len(self._changed) > self.max_entries:
+                _, generation = self._changed.popitem(last=False)
+                self._floor = max(self._floor, generation)
+            for key in self._by_user.pop(username, ()):
+                self._entries.pop(key, None)
+                self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _drop(self, key: bytes) -> None:
+        _, username, _ = self._entries.pop(key)
+        keys = self._by_user.get(username)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[username]
@@ -0,0 +1,82 @@
+import ipaddress
+from collections import deque
+from typing import Iterable, Optional, Union
+
+# one byte per address, so /8 (or an IPv6 /104) is the largest pool
+ADDRESS_POOL_MAX_SIZE = 2**24
+
+
+class AddressPoolExhausted(Exception):
+    pass
+
+
+class AddressPool:
+    """Free tunnel addresses of one interface subnet.
+
+    A bitmap marks taken host addresses. Allocation pops a released address
+    if there is one and otherwise moves a cursor over the never used part
+    of the subnet, so it is O(1) however full the subnet is. The pool is only
+    a hint: the etcd claim made with each address is what prevents two
+    instances from handing out the same one.
+    """
+
+    def __init__(self, subnet: str, reserved: Iterable[str] = ()):
+        self.network = ipaddress.ip_network(subnet, strict=False)
+        self.size = self.network.num_addresses
+        if self.size > ADDRESS_POOL_MAX_SIZE:
+            raise ValueError(f"Subnet {self.network} is too large for an address pool")
+        self._taken = bytearray(self.size)
+        self._released: deque = deque()
+        self._cursor = 0
+        self.used = 0
+        # the network and broadcast addresses are not usable by peers
+        self._fixed = {0, self.size - 1} if self.size > 2 else set()
+        for address in reserved:
+            offset = self._offset(address)
+            if offset is not None:
+                self._fixed.add(offset)
+        for offset in self._fixed:
+            self._mark(offset)
+
+    def _offset(self, address: Union[str, ipaddress.IPv4Address]) -> Optional[int]:
+        ip = ipaddress.ip_address(address)
+        if ip not in self.network:
+            return None
+        return int(ip) - int(self.network.network_address)
+
+    def _mark(self, offset: int) -> None:
+        if not self._taken[offset]:
+            self._taken[offset] = 1
+            self.used += 1
+
+    def claim(self, address: str) -> None:
+        """Mark ``address`` as taken, e.g. when it was claimed elsewhere"""
+        offset = self._offset(address)
+        if offset is not None:
+            self._mark(offset)
+
+    def allocate(self) -> str:
+        while self._released:
+            offset = self._released.popleft()
+            if not self._taken[offset]:
+                self._mark(offset)
+                return str(self.network.network_address + offset)
+        while self._cursor < self.size:
+            offset = self._cursor
+            self._cursor += 1
+            if not self._taken[offset]:
+                self._mark(offset)
+                return str(self.network.network_address + offset)
+        raise AddressPoolExhausted(f"No free addresses left in {self.network}")
+
+    def release(self, address: str) -> None:
+        offset = self._offset(address)
+        if offset is None or offset in self._fixed or not self._taken[offset]:
+            return
+        self._taken[offset] = 0
+        self.used -= 1
+        self._released.append(offset)
+
+    @property
+    def available(self) -> int:
+        return self.size - self.used
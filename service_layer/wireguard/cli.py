@@ -1,8 +1,29 @@
 import typer
 import subprocess
-from typing import Optional
+from typing import Annotated, Dict, Iterable, Optional
 from pathlib import Path
+import asyncio
 import json
+from service_layer.metrics import wg_command, wg_command_seconds
+from service_layer.wireguard.configs import (
+    config_renderer,
+    peers_from_records,
+    read_private_key,
+)
+from service_layer.wireguard.keys import generate_keypair, generate_keypairs
+from service_layer.wireguard.peers import (
+    WG_SET_MAX_PEERS,
+    Peer,
+    add_peer_command,
+    config_file,
+    describe_interface,
+    make_peer,
+    merge_peers,
+    parse_dump,
+    plan_peers,
+    remove_peer_command,
+    render_config,
+)
 
 app = typer.Typer()
 
@@ -10,7 +31,8 @@ app = typer.Typer()
 def run_command(command: list[str]) -> tuple[str, str]:
     """Run a shell command and return stdout and stderr"""
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        with wg_command_seconds.time(wg_command(command)):
+            result = subprocess.run(command, capture_output=True, text=True, check=True)
         return result.stdout, result.stderr
     except subprocess.CalledProcessError as e:
         raise typer.BadParameter(f"Command failed: {e.stderr}")
@@ -19,13 +41,13 @@ def run_command(command: list[str]) -> tuple[str, str]:
 @app.command()
 def generate_keys() -> dict:
     """Generate a new WireGuard private and public key pair"""
-    private_key, _ = run_command(["wg", "genkey"])
-    private_key = private_key.strip()
+    return generate_keypair()
 
-    public_key, _ = run_command(["echo", private_key, "|", "wg", "pubkey"])
-    public_key = public_key.strip()
 
-    return {"private_key": private_key, "public_key": public_key}
+@app.command()
+def generate_keys_batch(count: int) -> list:
+    """Generate several WireGuard key pairs at once"""
+    return generate_keypairs(count)
 
 
 @app.command()
@@ -37,23 +59,22 @@ def create_interface(
     dns: Optional[str] = None,
 ) -> None:
     """Create a new WireGuard interface"""
-    # Create config directory if it doesn't exist
-    config_dir = Path("wireguard_configs")
-    config_dir.mkdir(exist_ok=True)
-    
-    config = [
-        "[Interface]",
-        f"PrivateKey = {private_key}",
-        f"ListenPort = {listen_port}",
-        f"Address = {address}",
-    ]
-
-    if dns:
-        config.append(f"DNS = {dns}")
-
-    config_path = config_dir / f"{name}.conf"
-    config_path.write_text("\n".join(config))
-    
+    config_path = config_renderer.path(name)
+    if config_path.exists():
+        # the file may hold provisioned peers, an interface-only one drops them
+        raise typer.BadParameter(
+            f"{config_path} already exists, use sync-config or render-configs"
+        )
+    config_renderer.write(
+        name,
+        {
+            "private_key": private_key,
+            "listen_port": listen_port,
+            "address": address,
+            "dns": dns,
+        },
+    )
+
     # Note: wg-quick up requires root privileges
     # For testing/development, we'll just create the config file
     # In production, you would need to run this with sudo
@@ -71,78 +92,164 @@ def add_peer(
     persistent_keepalive: Optional[int] = None,
 ) -> None:
     """Add a peer to a WireGuard interface"""
-    command = ["wg", "set", interface, "peer", public_key, "allowed-ips", allowed_ips]
-
-    if endpoint:
-        command.extend(["endpoint", endpoint])
-
-    if persistent_keepalive:
-        command.extend(["persistent-keepalive", str(persistent_keepalive)])
-
-    run_command(command)
+    run_command(
+        add_peer_command(
+            interface, public_key, allowed_ips, endpoint, persistent_keepalive
+        )
+    )
 
 
 @app.command()
 def remove_peer(interface: str, public_key: str) -> None:
     """Remove a peer from a WireGuard interface"""
-    run_command(["wg", "set", interface, "peer", public_key, "remove"])
+    run_command(remove_peer_command(interface, public_key))
+
+
+def apply_peer_batch(
+    interface: str, upsert: Iterable[Peer] = (), remove: Iterable[str] = ()
+) -> Dict[str, int]:
+    """Add, update and remove many peers with a single ``wg syncconf``"""
+    stdout, _ = run_command(["wg", "show", interface, "dump"])
+    interface_info, live = parse_dump(stdout)
+    if interface_info is None:
+        raise typer.BadParameter(f"Interface {interface} not found")
+
+    desired, counts = merge_peers(live, upsert, remove)
+    if any(counts.values()):
+        syncconf(interface, render_config(interface_info, desired.values()))
+    return counts
+
+
+def syncconf(interface: str, config: str) -> None:
+    """Apply a full peer configuration without disturbing unchanged peers"""
+    with config_file(interface, config) as path:
+        run_command(["wg", "syncconf", interface, path])
 
 
 @app.command()
 def get_interface_info(interface: str) -> dict:
     """Get information about a WireGuard interface"""
     stdout, _ = run_command(["wg", "show", interface, "dump"])
-    lines = stdout.strip().split("\n")
+    return describe_interface(interface, stdout)
 
-    if not lines:
-        raise typer.BadParameter(f"Interface {interface} not found")
 
-    interface_info = {"name": interface, "peers": []}
-
-    for line in lines:
-        parts = line.split("\t")
-        if len(parts) >= 4:
-            peer = {
-                "public_key": parts[0],
-                "preshared_key": parts[1],
-                "endpoint": parts[2],
-                "allowed_ips": parts[3],
-                "latest_handshake": parts[4] if len(parts) > 4 else None,
-                "transfer_rx": parts[5] if len(parts) > 5 else None,
-                "transfer_tx": parts[6] if len(parts) > 6 else None,
-                "persistent_keepalive": parts[7] if len(parts) > 7 else None,
+def reconcile_interface(
+    interface: str, desired: Dict[str, Peer], dry_run: bool = False
+) -> dict:
+    """Bring the live peers of an interface to ``desired`` with one ``wg set``"""
+    stdout, _ = run_command(["wg", "show", interface, "dump"])
+    interface_info, live = parse_dump(stdout)
+    plan = plan_peers(live, desired)
+    if plan and not dry_run:
+        if len(plan) <= WG_SET_MAX_PEERS:
+            run_command(plan.command(interface))
+        else:
+            merged, _ = merge_peers(live, plan.added + plan.changed, plan.removed)
+            syncconf(interface, render_config(interface_info, merged.values()))
+    return plan.summary()
+
+
+def provisioned_interfaces(query_set=None) -> Dict[str, tuple]:
+    """Interfaces registered in etcd with the peers provisioned on them.
+
+    Maps each name to its interface settings and peers. The private key is
+    read from the local config file and is ``None`` for an interface that
+    lives on another host.
+    """
+    from query_sets.wireguard import WireGuardQuerySets
+
+    query_set = query_set or WireGuardQuerySets()
+
+    async def load():
+        return await asyncio.gather(
+            query_set.list_interfaces(), query_set.list_interface_peers()
+        )
+
+    records, peer_records = asyncio.run(load())
+    by_interface: Dict[str, list] = {}
+    for record in peer_records:
+        by_interface.setdefault(record["interface"], []).append(record)
+    return {
+        record["name"]: (
+            {
+                "private_key": read_private_key(config_renderer.path(record["name"])),
+                "listen_port": record.get("listen_port"),
+                "address": record["address"],
+                "dns": record.get("dns"),
+            },
+            peers_from_records(by_interface.get(record["name"], [])),
+        )
+        for record in records
+    }
+
+
+@app.command()
+def sync_config(
+    config_file: Annotated[Optional[Path], typer.Argument()] = None,
+    etcd: bool = False,
+    dry_run: bool = False,
+) -> dict:
+    """Sync WireGuard configuration from a JSON file, etcd or both.
+
+    With ``--etcd`` the peers provisioned through the API are desired too,
+    next to those from the JSON, and every interface registered in etcd
+    whose config file is on this host is synced.
+    """
+    if config_file is None and not etcd:
+        raise typer.BadParameter("Give a config file, --etcd or both")
+
+    interfaces: Dict[str, tuple] = {}
+    if config_file is not None:
+        if not config_file.exists():
+            raise typer.BadParameter(f"Config file {config_file} does not exist")
+        config = json.loads(config_file.read_text())
+        for interface in config.get("interfaces", []):
+            settings = {
+                "private_key": interface["private_key"],
+                "listen_port": interface["listen_port"],
+                "address": interface["address"],
+                "dns": interface.get("dns"),
+            }
+            desired = {
+                peer["public_key"]: make_peer(
+                    public_key=peer["public_key"],
+                    allowed_ips=peer["allowed_ips"],
+                    endpoint=peer.get("endpoint"),
+                    persistent_keepalive=peer.get("persistent_keepalive"),
+                )
+                for peer in interface.get("peers", [])
             }
-            interface_info["peers"].append(peer)
+            interfaces[interface["name"]] = (settings, desired)
+    if etcd:
+        for name, (settings, peers) in provisioned_interfaces().items():
+            if name in interfaces:
+                desired = interfaces[name][1]
+                for peer in peers:
+                    desired.setdefault(peer.public_key, peer)
+            elif settings["private_key"] is not None:
+                interfaces[name] = (settings, {peer.public_key: peer for peer in peers})
 
-    return interface_info
+    plans = {}
+    for name, (settings, desired) in interfaces.items():
+        if not dry_run:
+            # the file carries the peers too, so wg-quick up restores them
+            config_renderer.write(name, settings, desired.values())
+        plans[name] = reconcile_interface(name, desired, dry_run)
+
+    if dry_run:
+        print(json.dumps(plans, indent=2))
+    return plans
 
 
 @app.command()
-def sync_config(config_file: Path) -> None:
-    """Sync WireGuard configuration from a JSON file"""
-    if not config_file.exists():
-        raise typer.BadParameter(f"Config file {config_file} does not exist")
-
-    config = json.loads(config_file.read_text())
-
-    for interface in config.get("interfaces", []):
-        name = interface["name"]
-        create_interface(
-            name=name,
-            private_key=interface["private_key"],
-            listen_port=interface["listen_port"],
-            address=interface["address"],
-            dns=interface.get("dns"),
-        )
+def render_configs() -> dict:
+    """Regenerate the config files of every interface registered in etcd"""
+    from query_sets.wireguard import WireGuardQuerySets
 
-        for peer in interface.get("peers", []):
-            add_peer(
-                interface=name,
-                public_key=peer["public_key"],
-                allowed_ips=peer["allowed_ips"],
-                endpoint=peer.get("endpoint"),
-                persistent_keepalive=peer.get("persistent_keepalive"),
-            )
+    results = asyncio.run(config_renderer.sync_all(WireGuardQuerySets()))
+    for name, written in results.items():
+        print(f"{config_renderer.path(name)}: {'written' if written else 'unchanged'}")
+    return results
 
 
 if __name__ == "__main__":
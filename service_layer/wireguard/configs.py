@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import tempfile
+from dataclasses import astuple
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+from service_layer.wireguard.peers import Peer, render_config
+
+WG_CONFIG_DIR = os.getenv("WG_CONFIG_DIR", "wireguard_configs")
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path: Path, content: str) -> bool:
+    """Replace ``path`` with ``content`` unless it already holds exactly that.
+
+    The new file is written next to the old one, fsynced and renamed over
+    it, so readers see either the old or the new config, never a torn one.
+    Returns whether the file was written.
+    """
+    data = content.encode("utf-8")
+    try:
+        if path.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
+    # mkstemp creates the file 0600, configs hold the private key
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}-", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
+
+
+def read_private_key(path: Path) -> Optional[str]:
+    try:
+        for line in path.read_text().splitlines():
+            key, _, value = line.partition("=")
+            if key.strip() == "PrivateKey":
+                return value.strip()
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def peers_from_records(records: Iterable[Dict[str, Any]]) -> List[Peer]:
+    """Peers provisioned in etcd, each routed to its single tunnel address"""
+    return [
+        Peer(
+            public_key=record["public_key"],
+            allowed_ips=(f"{record['address']}/32",),
+            persistent_keepalive=record.get("persistent_keepalive"),
+        )
+        for record in sorted(
+            records, key=lambda record: ipaddress.ip_address(record["address"])
+        )
+    ]
+
+
+class ConfigRenderer:
+    """Keeps ``<config_dir>/<name>.conf`` in line with its interface and peers.
+
+    A fingerprint of each interface's inputs is remembered, so an interface
+    whose record and peers did not change is not even rendered again; one
+    that did is rendered and written atomically, and only if the resulting
+    file differs.
+    """
+
+    def __init__(self, config_dir: str = WG_CONFIG_DIR):
+        self.config_dir = Path(config_dir)
+        self.rendered = 0
+        self.written = 0
+        self._fingerprints: Dict[str, str] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def path(self, name: str) -> Path:
+        return self.config_dir / f"{name}.conf"
+
+    def write(
+        self, name: str, interface: Dict[str, Any], peers: Iterable[Peer] = ()
+    ) -> bool:
+        """Render and write one interface, returns whether the file changed"""
+        peers = list(peers)
+        fingerprint = hashlib.sha256(
+            json.dumps([interface, peers], sort_keys=True, default=astuple).encode(
+                "utf-8"
+            )
+        ).hexdigest()
+        if self._fingerprints.get(name) == fingerprint and self.path(name).exists():
+            return False
+        self.config_dir.mkdir(exist_ok=True)
+        self.rendered += 1
+        written = write_atomic(self.path(name), render_config(interface, peers))
+        self.written += written
+        self._fingerprints[name] = fingerprint
+        return written
+
+    def _write_record(
+        self,
+        record: Dict[str, Any],
+        peers: Iterable[Dict[str, Any]],
+        private_key: Optional[str] = None,
+    ) -> bool:
+        name = record["name"]
+        private_key = private_key or read_private_key(self.path(name))
+        if private_key is None:
+            raise FileNotFoundError(f"No private key for {name} in {self.path(name)}")
+        interface = {
+            "private_key": private_key,
+            "listen_port": record.get("listen_port"),
+            "address": record["address"],
+            "dns": record.get("dns"),
+        }
+        return self.write(name, interface, peers_from_records(peers))
+
+    async def sync_interface(
+        self, query_set, name: str, private_key: Optional[str] = None
+    ) -> bool:
+        """Regenerate ``name`` from its etcd record and provisioned peers.
+
+        The private key is taken from the existing config file unless it
+        is given, as it is for a new interface.
+        """
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            record, peers = await asyncio.gather(
+                query_set.get_interface(name), query_set.list_interface_peers(name)
+            )
+            if record is None:
+                return False
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, self._write_record, record, peers, private_key
+            )
+
+    async def sync_all(self, query_set) -> Dict[str, bool]:
+        """Regenerate every registered interface from two prefix reads"""
+        records, peers = await asyncio.gather(
+            query_set.list_interfaces(), query_set.list_interface_peers()
+        )
+        by_interface: Dict[str, List[Dict[str, Any]]] = {}
+        for peer in peers:
+            by_interface.setdefault(peer["interface"], []).append(peer)
+
+        loop = asyncio.get_running_loop()
+        results = {}
+        for record in records:
+            name = record["name"]
+            async with self._locks.setdefault(name, asyncio.Lock()):
+                try:
+                    results[name] = await loop.run_in_executor(
+                        None, self._write_record, record, by_interface.get(name, [])
+                    )
+                except FileNotFoundError as e:
+                    # registered by another host
+                    logger.info("Skipping %s: %s", name, e)
+        return results
+
+
+config_renderer = ConfigRenderer()
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Dict, Optional, Set
+from service_layer.wireguard.peers import PeerStatus
+from service_layer.wireguard.status import WG_STATUS_INTERVAL, StatusCache, status_cache
+
+WG_FEED_QUEUE_SIZE = int(os.getenv("WG_FEED_QUEUE_SIZE", "16"))
+
+logger = logging.getLogger(__name__)
+
+
+def _record(peer: PeerStatus, rx_rate: float, tx_rate: float) -> Dict[str, Any]:
+    return {
+        "public_key": peer.public_key,
+        "endpoint": peer.endpoint,
+        "latest_handshake": peer.latest_handshake,
+        "transfer_rx": peer.transfer_rx,
+        "transfer_tx": peer.transfer_tx,
+        "rx_rate": rx_rate,
+        "tx_rate": tx_rate,
+    }
+
+
+class InterfaceFeed:
+    """One sampler for an interface, fanned out to every subscriber.
+
+    The sampler runs while anyone is subscribed. Each sample is diffed
+    against the previous one, and only peers whose counters, handshake or
+    endpoint moved are sent, with their byte rates. A subscriber that falls
+    ``queue_size`` events behind loses its backlog and gets a full snapshot
+    instead.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        cache: StatusCache,
+        interval: float = WG_STATUS_INTERVAL,
+        queue_size: int = WG_FEED_QUEUE_SIZE,
+    ):
+        self.name = name
+        self.cache = cache
+        self.interval = interval
+        self.queue_size = queue_size
+        self.peers: Dict[str, Dict[str, Any]] = {}
+        self.sampled_at: Optional[float] = None
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        if self.sampled_at is not None:
+            queue.put_nowait(self.snapshot())
+        self._subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._sample())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+        if not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "time": time.time(),
+            "full": True,
+            "peers": list(self.peers.values()),
+            "removed": [],
+        }
+
+    def update(self, peers: Dict[str, PeerStatus], sampled_at: float) -> Dict[str, Any]:
+        """Fold a sample into the feed and return the delta event"""
+        first = self.sampled_at is None
+        elapsed = 0 if first else sampled_at - self.sampled_at
+        changed = []
+        for public_key, peer in peers.items():
+            previous = self.peers.get(public_key)
+            if previous is not None and (
+                previous["transfer_rx"] == peer.transfer_rx
+                and previous["transfer_tx"] == peer.transfer_tx
+                and previous["latest_handshake"] == peer.latest_handshake
+                and previous["endpoint"] == peer.endpoint
+            ):
+                if previous["rx_rate"] or previous["tx_rate"]:
+                    previous = self.peers[public_key] = _record(peer, 0.0, 0.0)
+                    changed.append(previous)
+                continue
+            rx_rate = tx_rate = 0.0
+            if previous is not None and elapsed > 0:
+                # counters restart from zero when the interface is recreated
+                rx_rate = max(peer.transfer_rx - previous["transfer_rx"], 0) / elapsed
+                tx_rate = max(peer.transfer_tx - previous["transfer_tx"], 0) / elapsed
+            record = self.peers[public_key] = _record(peer, rx_rate, tx_rate)
+            changed.append(record)
+        removed = [key for key in self.peers if key not in peers]
+        for public_key in removed:
+            del self.peers[public_key]
+        self.sampled_at = sampled_at
+        return {
+            "name": self.name,
+            "time": time.time(),
+            "full": first,
+            "peers": changed,
+            "removed": removed,
+        }
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        for queue in self._subscribers:
+            if queue.full():
+                # a slow subscriber skips its backlog and resyncs from the current state
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(event if "error" in event else self.snapshot())
+            else:
+                queue.put_nowait(event)
+
+    async def _sample(self) -> None:
+        while True:
+            try:
+                status = await self.cache.get(self.name)
+                if status.fetched_at != self.sampled_at:
+                    event = self.update(status.peers, status.fetched_at)
+                    if event["full"] or event["peers"] or event["removed"]:
+                        self.publish(event)
+            except Exception as e:
+                logger.warning("Sampling %s failed: %s", self.name, e)
+                self.publish({"name": self.name, "time": time.time(), "error": str(e)})
+            await asyncio.sleep(self.interval)
+
+
+class TrafficFeeds:
+    """Shares one ``InterfaceFeed`` per interface between all subscribers"""
+
+    def __init__(self, cache: StatusCache = status_cache):
+        self.cache = cache
+        self._feeds: Dict[str, InterfaceFeed] = {}
+
+    def feed(self, interface: str) -> InterfaceFeed:
+        feed = self._feeds.get(interface)
+        if feed is None:
+            feed = self._feeds[interface] = InterfaceFeed(interface, self.cache)
+        return feed
+
+    async def subscribe(
+        self, interface: str, heartbeat: Optional[float] = None
+    ) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """Yield traffic events for ``interface`` until the caller stops.
+
+        With ``heartbeat`` set, ``None`` is yielded whenever that many
+        seconds pass without an event, so idle streams can be kept alive.
+        """
+        feed = self.feed(interface)
+        queue = feed.subscribe()
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            feed.unsubscribe(queue)
+            if not feed:
+                self._feeds.pop(interface, None)
+
+
+traffic_feeds = TrafficFeeds()
@@ -0,0 +1,102 @@
+import asyncio
+import base64
+import logging
+import os
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+KEY_POOL_SIZE = int(os.getenv("WG_KEY_POOL_SIZE", "64"))
+
+logger = logging.getLogger(__name__)
+
+
+def _clamp(scalar: bytes) -> bytes:
+    k = bytearray(scalar)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    return bytes(k)
+
+
+def generate_private_key() -> str:
+    """Same as ``wg genkey``: a clamped random scalar, base64 encoded"""
+    return base64.b64encode(_clamp(os.urandom(32))).decode("ascii")
+
+
+def public_key(private_key: str) -> str:
+    """Same as ``wg pubkey``"""
+    raw = base64.b64decode(private_key)
+    if len(raw) != 32:
+        raise ValueError("WireGuard keys are 32 bytes")
+    # the X25519 of RFC 7748, in constant time
+    public = X25519PrivateKey.from_private_bytes(raw).public_key()
+    raw_public = public.public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return base64.b64encode(raw_public).decode("ascii")
+
+
+def generate_keypair() -> Dict[str, str]:
+    private_key = generate_private_key()
+    return {"private_key": private_key, "public_key": public_key(private_key)}
+
+
+def generate_keypairs(count: int) -> List[Dict[str, str]]:
+    return [generate_keypair() for _ in range(count)]
+
+
+class KeyPool:
+    """Key pairs generated ahead of time so provisioning does not wait on them.
+
+    ``take`` serves from the pool and falls back to generating inline when it
+    runs dry; ``refill`` tops the pool back up and is safe to call from a
+    background thread, and ``refill_soon`` runs it there at most once at a
+    time.
+    """
+
+    def __init__(self, size: int = KEY_POOL_SIZE):
+        self.size = size
+        self._keys: deque = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self.refill_task: Optional[asyncio.Future] = None
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def take(self, count: int = 1) -> List[Dict[str, str]]:
+        keys = []
+        with self._lock:
+            while self._keys and len(keys) < count:
+                keys.append(self._keys.popleft())
+        keys.extend(generate_keypairs(count - len(keys)))
+        return keys
+
+    def refill(self) -> None:
+        while len(self._keys) < self.size:
+            keypair = generate_keypair()
+            with self._lock:
+                self._keys.append(keypair)
+
+    def refill_soon(self) -> None:
+        """Start ``refill`` on the default executor unless one is running"""
+        with self._lock:
+            if self._refilling or len(self._keys) >= self.size:
+                return
+            self._refilling = True
+        loop = asyncio.get_running_loop()
+        self.refill_task = loop.run_in_executor(None, self._background_refill)
+
+    def _background_refill(self) -> None:
+        try:
+            self.refill()
+        except Exception:
+            logger.exception("Failed to refill the key pool")
+        finally:
+            with self._lock:
+                self._refilling = False
+
+
+key_pool = KeyPool()
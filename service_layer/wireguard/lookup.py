@@ -0,0 +1,182 @@
+import asyncio
+import ipaddress
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+from service_layer.wireguard.peers import PeerStatus
+from service_layer.wireguard.runner import runner
+from service_layer.wireguard.status import InterfaceStatus, StatusCache, status_cache
+
+PeerRef = Tuple[str, str]
+
+logger = logging.getLogger(__name__)
+
+
+def _endpoint_host(endpoint: str) -> str:
+    # "1.2.3.4:51820" and "[2001:db8::1]:51820", bare hosts are returned as is
+    if endpoint.startswith("["):
+        return endpoint[1 : endpoint.index("]")]
+    if endpoint.count(":") == 1:
+        return endpoint.rsplit(":", 1)[0]
+    return endpoint
+
+
+class PeerIndex:
+    """Which peers route an address and which peers connect from an endpoint.
+
+    Allowed IPs are kept in one hash table per prefix length, so a longest
+    prefix match is at most 33 (or 129) lookups whatever the peer count. The
+    index follows the status cache and only touches peers whose allowed IPs
+    or endpoint changed. Lookups answer from the index as it stands, a
+    background task started by ``watch`` refreshes it every status interval.
+    """
+
+    def __init__(self, cache: StatusCache = status_cache):
+        self.cache = cache
+        self._peers: Dict[PeerRef, PeerStatus] = {}
+        self._networks: Dict[PeerRef, List[Any]] = {}
+        # ip version -> prefix length -> network address -> peers
+        self._prefixes: Dict[int, Dict[int, Dict[int, Set[PeerRef]]]] = {4: {}, 6: {}}
+        self._lengths: Dict[int, List[int]] = {4: [], 6: []}
+        self._endpoints: Dict[str, Set[PeerRef]] = {}
+        self._interfaces: List[str] = []
+        self._interfaces_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.refreshed_at: Optional[float] = None
+        cache.add_listener(self.update)
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def update(
+        self,
+        interface: str,
+        status: InterfaceStatus,
+        changed: List[str],
+        removed: List[str],
+    ) -> None:
+        for public_key in removed:
+            self._remove((interface, public_key))
+        for public_key in changed:
+            ref = (interface, public_key)
+            peer = status.peers[public_key]
+            current = self._peers.get(ref)
+            if current is not None and (
+                current.allowed_ips == peer.allowed_ips
+                and current.endpoint == peer.endpoint
+            ):
+                self._peers[ref] = peer
+                continue
+            self._remove(ref)
+            self._add(ref, peer)
+
+    def _add(self, ref: PeerRef, peer: PeerStatus) -> None:
+        self._peers[ref] = peer
+        networks = []
+        for cidr in peer.allowed_ips.split(","):
+            if not cidr.strip():
+                continue
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+            networks.append(network)
+            by_length = self._prefixes[network.version]
+            if network.prefixlen not in by_length:
+                by_length[network.prefixlen] = {}
+                self._lengths[network.version] = sorted(by_length, reverse=True)
+            by_length[network.prefixlen].setdefault(
+                int(network.network_address), set()
+            ).add(ref)
+        self._networks[ref] = networks
+        if peer.endpoint:
+            for key in (peer.endpoint, _endpoint_host(peer.endpoint)):
+                self._endpoints.setdefault(key, set()).add(ref)
+
+    def _remove(self, ref: PeerRef) -> None:
+        peer = self._peers.pop(ref, None)
+        if peer is None:
+            return
+        for network in self._networks.pop(ref, ()):
+            by_length = self._prefixes[network.version]
+            table = by_length[network.prefixlen]
+            refs = table[int(network.network_address)]
+            refs.discard(ref)
+            if not refs:
+                del table[int(network.network_address)]
+            if not table:
+                del by_length[network.prefixlen]
+                self._lengths[network.version] = sorted(by_length, reverse=True)
+        if peer.endpoint:
+            for key in (peer.endpoint, _endpoint_host(peer.endpoint)):
+                refs = self._endpoints.get(key)
+                if refs is not None:
+                    refs.discard(ref)
+                    if not refs:
+                        del self._endpoints[key]
+
+    def lookup_ip(self, ip: str) -> List[Dict[str, Any]]:
+        """Peers routing ``ip``, longest matching prefix first"""
+        address = ipaddress.ip_address(ip)
+        value = int(address)
+        bits = address.max_prefixlen
+        by_length = self._prefixes[address.version]
+        matches = []
+        for length in self._lengths[address.version]:
+            shift = bits - length
+            network = value >> shift << shift
+            for ref in by_length[length].get(network, ()):
+                matches.append(
+                    self._describe(ref, f"{type(address)(network)}/{length}")
+                )
+        return matches
+
+    def lookup_endpoint(self, endpoint: str) -> List[Dict[str, Any]]:
+        """Peers connecting from ``endpoint``, either ``host`` or ``host:port``"""
+        refs = self._endpoints.get(endpoint) or self._endpoints.get(
+            _endpoint_host(endpoint), ()
+        )
+        return [self._describe(ref) for ref in sorted(refs)]
+
+    def _describe(self, ref: PeerRef, network: Optional[str] = None) -> Dict[str, Any]:
+        record = {"interface": ref[0], **self._peers[ref]._asdict()}
+        if network is not None:
+            record["match"] = network
+        return record
+
+    async def refresh(self) -> None:
+        """Bring the index up to date with every interface on the host"""
+        async with self._lock:
+            if time.monotonic() - self._interfaces_at >= self.cache.interval:
+                stdout, _ = await runner.run(["wg", "show", "interfaces"])
+                interfaces = stdout.split()
+                for gone in set(self._interfaces) - set(interfaces):
+                    for ref in [ref for ref in self._peers if ref[0] == gone]:
+                        self._remove(ref)
+                self._interfaces = interfaces
+                self._interfaces_at = time.monotonic()
+        # an interface that just went away is dropped on the next listing
+        await asyncio.gather(
+            *(self.cache.get(name) for name in self._interfaces), return_exceptions=True
+        )
+        self.refreshed_at = time.monotonic()
+
+    async def watch(self) -> None:
+        """Keep the index refreshed in the background.
+
+        Only waits for a refresh while the index was never loaded.
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._poll())
+        if self.refreshed_at is None:
+            await self.refresh()
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.cache.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the peer index")
+
+
+peer_index = PeerIndex()
@@ -0,0 +1,246 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# larger deltas go through syncconf instead of one very long wg set command line
+WG_SET_MAX_PEERS = int(os.getenv("WG_SET_MAX_PEERS", "500"))
+
+
+@dataclass(frozen=True)
+class Peer:
+    public_key: str
+    allowed_ips: Tuple[str, ...] = ()
+    endpoint: Optional[str] = None
+    persistent_keepalive: Optional[int] = None
+    preshared_key: Optional[str] = None
+
+
+def make_peer(
+    public_key: str,
+    allowed_ips: str,
+    endpoint: Optional[str] = None,
+    persistent_keepalive: Optional[int] = None,
+) -> Peer:
+    """Build a peer from the comma separated form used by ``wg set``"""
+    return Peer(
+        public_key=public_key,
+        allowed_ips=_split_ips(allowed_ips),
+        endpoint=endpoint or None,
+        persistent_keepalive=persistent_keepalive or None,
+    )
+
+
+def add_peer_command(
+    interface: str,
+    public_key: str,
+    allowed_ips: str,
+    endpoint: Optional[str] = None,
+    persistent_keepalive: Optional[int] = None,
+) -> List[str]:
+    command = ["wg", "set", interface, "peer", public_key, "allowed-ips", allowed_ips]
+
+    if endpoint:
+        command.extend(["endpoint", endpoint])
+
+    if persistent_keepalive:
+        command.extend(["persistent-keepalive", str(persistent_keepalive)])
+
+    return command
+
+
+def remove_peer_command(interface: str, public_key: str) -> List[str]:
+    return ["wg", "set", interface, "peer", public_key, "remove"]
+
+
+def _split_ips(allowed_ips: str) -> Tuple[str, ...]:
+    return tuple(sorted(ip.strip() for ip in allowed_ips.split(",") if ip.strip()))
+
+
+def _none(value: str) -> Optional[str]:
+    return None if value in ("(none)", "off", "") else value
+
+
+def parse_dump(stdout: str) -> Tuple[Optional[Dict[str, str]], Dict[str, Peer]]:
+    """Parse ``wg show <iface> dump`` into the interface and its peers.
+
+    The interface line has 4 fields and every peer line 8.
+    """
+    interface = None
+    peers: Dict[str, Peer] = {}
+    for line in stdout.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 4:
+            interface = {
+                "private_key": parts[0],
+                "public_key": parts[1],
+                "listen_port": parts[2],
+                "fwmark": parts[3],
+            }
+        elif len(parts) >= 8:
+            keepalive = _none(parts[7])
+            peers[parts[0]] = Peer(
+                public_key=parts[0],
+                allowed_ips=_split_ips(_none(parts[3]) or ""),
+                endpoint=_none(parts[2]),
+                persistent_keepalive=int(keepalive) if keepalive else None,
+                preshared_key=_none(parts[1]),
+            )
+    return interface, peers
+
+
+class PeerStatus(NamedTuple):
+    public_key: str
+    endpoint: Optional[str]
+    allowed_ips: str
+    latest_handshake: int
+    transfer_rx: int
+    transfer_tx: int
+    persistent_keepalive: Optional[int]
+
+
+def parse_status(stdout: str) -> Dict[str, PeerStatus]:
+    """Parse the peer lines of ``wg show <iface> dump`` with numeric counters"""
+    peers: Dict[str, PeerStatus] = {}
+    for line in stdout.splitlines():
+        parts = line.split("\t")
+        if len(parts) < 8:
+            continue
+        keepalive = _none(parts[7])
+        peers[parts[0]] = PeerStatus(
+            public_key=parts[0],
+            endpoint=_none(parts[2]),
+            allowed_ips=_none(parts[3]) or "",
+            latest_handshake=int(parts[4]),
+            transfer_rx=int(parts[5]),
+            transfer_tx=int(parts[6]),
+            persistent_keepalive=int(keepalive) if keepalive else None,
+        )
+    return peers
+
+
+def describe_interface(interface: str, stdout: str) -> Dict[str, Any]:
+    return {
+        "name": interface,
+        "peers": [peer._asdict() for peer in parse_status(stdout).values()],
+    }
+
+
+def render_config(interface: Dict[str, Any], peers: Iterable[Peer]) -> str:
+    """Render a ``wg setconf``/``wg syncconf`` configuration.
+
+    ``address`` and ``dns`` are only understood by ``wg-quick`` and are
+    rendered when the interface has them.
+    """
+    lines = ["[Interface]", f"PrivateKey = {interface['private_key']}"]
+    if _none(str(interface.get("listen_port") or "")):
+        lines.append(f"ListenPort = {interface['listen_port']}")
+    if _none(str(interface.get("fwmark") or "")):
+        lines.append(f"FwMark = {interface['fwmark']}")
+    if interface.get("address"):
+        lines.append(f"Address = {interface['address']}")
+    if interface.get("dns"):
+        lines.append(f"DNS = {interface['dns']}")
+    for peer in peers:
+        lines.extend(["", "[Peer]", f"PublicKey = {peer.public_key}"])
+        if peer.preshared_key:
+            lines.append(f"PresharedKey = {peer.preshared_key}")
+        if peer.allowed_ips:
+            lines.append(f"AllowedIPs = {', '.join(peer.allowed_ips)}")
+        if peer.endpoint:
+            lines.append(f"Endpoint = {peer.endpoint}")
+        if peer.persistent_keepalive:
+            lines.append(f"PersistentKeepalive = {peer.persistent_keepalive}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def config_file(interface: str, config: str) -> Iterator[str]:
+    """Write ``config`` to a temporary file for ``wg syncconf``"""
+    # mkstemp creates the file 0600, it holds the private key
+    fd, path = tempfile.mkstemp(prefix=f"{interface}-", suffix=".conf")
+    try:
+        with os.fdopen(fd, "w") as handle:
+            handle.write(config)
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def merge_peers(
+    live: Dict[str, Peer], upsert: Iterable[Peer], remove: Iterable[str]
+) -> Tuple[Dict[str, Peer], Dict[str, int]]:
+    """Apply a batch to the live peers and count what it changes.
+
+    Preshared keys of existing peers are kept unless the batch sets one.
+    """
+    desired = dict(live)
+    counts = {"added": 0, "updated": 0, "removed": 0}
+    for public_key in remove:
+        if desired.pop(public_key, None) is not None:
+            counts["removed"] += 1
+    for peer in upsert:
+        current = desired.get(peer.public_key)
+        if current is not None and peer.preshared_key is None:
+            peer = replace(peer, preshared_key=current.preshared_key)
+        if current is None:
+            counts["added"] += 1
+        elif current != peer:
+            counts["updated"] += 1
+        desired[peer.public_key] = peer
+    return desired, counts
+
+
+@dataclass
+class PeerPlan:
+    added: List[Peer] = field(default_factory=list)
+    changed: List[Peer] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.added) + len(self.changed) + len(self.removed)
+
+    def command(self, interface: str) -> List[str]:
+        """One ``wg set`` invocation applying the whole delta"""
+        command = ["wg", "set", interface]
+        for public_key in self.removed:
+            command.extend(["peer", public_key, "remove"])
+        for peer in self.added + self.changed:
+            command.extend(["peer", peer.public_key])
+            command.extend(["allowed-ips", ",".join(peer.allowed_ips)])
+            if peer.endpoint:
+                command.extend(["endpoint", peer.endpoint])
+            command.extend(
+                ["persistent-keepalive", str(peer.persistent_keepalive or "off")]
+            )
+        return command
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "added": [peer.public_key for peer in self.added],
+            "changed": [peer.public_key for peer in self.changed],
+            "removed": list(self.removed),
+        }
+
+
+def _differs(live: Peer, desired: Peer) -> bool:
+    # a live endpoint without a configured one is just where the peer roamed to
+    return (
+        live.allowed_ips != desired.allowed_ips
+        or live.persistent_keepalive != desired.persistent_keepalive
+        or (desired.endpoint is not None and live.endpoint != desired.endpoint)
+    )
+
+
+def plan_peers(live: Dict[str, Peer], desired: Dict[str, Peer]) -> PeerPlan:
+    """Work out the peers to add, change and remove, matched by public key"""
+    plan = PeerPlan()
+    for public_key, peer in desired.items():
+        current = live.get(public_key)
+        if current is None:
+            plan.added.append(peer)
+        elif _differs(current, peer):
+            plan.changed.append(peer)
+    plan.removed = [public_key for public_key in live if public_key not in desired]
+    return plan
@@ -0,0 +1,72 @@
+import asyncio
+import contextlib
+import os
+from typing import Dict, List, Optional, Tuple
+from service_layer.metrics import wg_command, wg_command_seconds
+
+WG_MAX_CONCURRENCY = int(os.getenv("WG_MAX_CONCURRENCY", "8"))
+WG_COMMAND_TIMEOUT = float(os.getenv("WG_COMMAND_TIMEOUT", "10"))
+
+
+class CommandError(Exception):
+    pass
+
+
+class CommandRunner:
+    """Runs ``wg`` commands as asyncio subprocesses.
+
+    At most ``max_concurrency`` commands run at once, each one is killed
+    after ``timeout`` seconds or when the awaiting request is cancelled, and
+    ``interface(name)`` serializes every operation on one interface so a
+    read-modify-write such as a peer batch never interleaves with another.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = WG_MAX_CONCURRENCY,
+        timeout: float = WG_COMMAND_TIMEOUT,
+    ):
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def interface(self, name: str) -> asyncio.Lock:
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        return lock
+
+    async def run(
+        self, command: List[str], timeout: Optional[float] = None
+    ) -> Tuple[str, str]:
+        """Run a command and return stdout and stderr"""
+        async with self._semaphore:
+            with wg_command_seconds.time(wg_command(command)):
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                try:
+                    stdout, stderr = await asyncio.wait_for(
+                        process.communicate(), timeout or self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    await _kill(process)
+                    raise CommandError(f"Command timed out: {' '.join(command[:3])}")
+                except asyncio.CancelledError:
+                    await _kill(process)
+                    raise
+        if process.returncode != 0:
+            raise CommandError(f"Command failed: {stderr.decode().strip()}")
+        return stdout.decode(), stderr.decode()
+
+
+async def _kill(process: asyncio.subprocess.Process) -> None:
+    # the command may exit on its own between the timeout and the kill
+    with contextlib.suppress(ProcessLookupError):
+        process.kill()
+    await process.wait()
+
+
+runner = CommandRunner()
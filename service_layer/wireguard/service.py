@@ -0,0 +1,65 @@
+"""Async counterparts of the CLI operations, used by the API.
+
+Every command goes through the shared runner; operations that change an
+interface hold its lock for their whole read-modify-write.
+"""
+
+from typing import Dict, Iterable, Optional, Tuple
+from service_layer.wireguard.peers import (
+    Peer,
+    add_peer_command,
+    config_file,
+    merge_peers,
+    parse_dump,
+    remove_peer_command,
+    render_config,
+)
+from service_layer.wireguard.runner import CommandError, runner
+from service_layer.wireguard.status import status_cache
+
+
+async def _dump(interface: str) -> Tuple[Optional[Dict[str, str]], Dict[str, Peer]]:
+    stdout, _ = await runner.run(["wg", "show", interface, "dump"])
+    return parse_dump(stdout)
+
+
+async def _syncconf(interface: str, config: str) -> None:
+    with config_file(interface, config) as path:
+        await runner.run(["wg", "syncconf", interface, path])
+
+
+async def add_peer(
+    interface: str,
+    public_key: str,
+    allowed_ips: str,
+    endpoint: Optional[str] = None,
+    persistent_keepalive: Optional[int] = None,
+) -> None:
+    async with runner.interface(interface):
+        await runner.run(
+            add_peer_command(
+                interface, public_key, allowed_ips, endpoint, persistent_keepalive
+            )
+        )
+        status_cache.invalidate(interface)
+
+
+async def remove_peer(interface: str, public_key: str) -> None:
+    async with runner.interface(interface):
+        await runner.run(remove_peer_command(interface, public_key))
+        status_cache.invalidate(interface)
+
+
+async def apply_peer_batch(
+    interface: str, upsert: Iterable[Peer] = (), remove: Iterable[str] = ()
+) -> Dict[str, int]:
+    async with runner.interface(interface):
+        interface_info, live = await _dump(interface)
+        if interface_info is None:
+            raise CommandError(f"Interface {interface} not found")
+
+        desired, counts = merge_peers(live, upsert, remove)
+        if any(counts.values()):
+            await _syncconf(interface, render_config(interface_info, desired.values()))
+            status_cache.invalidate(interface)
+        return counts
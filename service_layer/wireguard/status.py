@@ -0,0 +1,138 @@
+import asyncio
+import os
+import secrets
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from service_layer.wireguard.peers import PeerStatus, parse_status
+from service_layer.wireguard.runner import runner
+
+WG_STATUS_INTERVAL = float(os.getenv("WG_STATUS_INTERVAL", "2"))
+
+
+class InterfaceStatus:
+    """Last parsed dump of one interface and the revision each peer moved at"""
+
+    def __init__(self):
+        self.revision = 0
+        self.fetched_at = 0.0
+        self.peers: Dict[str, PeerStatus] = {}
+        self.changed: Dict[str, int] = {}
+        self.removed: Dict[str, int] = {}
+        self.lock = asyncio.Lock()
+
+    def update(self, peers: Dict[str, PeerStatus]) -> Tuple[List[str], List[str]]:
+        """Take a new dump and return the keys of changed and removed peers"""
+        revision = self.revision + 1
+        changed = [key for key, peer in peers.items() if self.peers.get(key) != peer]
+        removed = [key for key in self.peers if key not in peers]
+        for public_key in changed:
+            self.changed[public_key] = revision
+            self.removed.pop(public_key, None)
+        for public_key in removed:
+            del self.changed[public_key]
+            self.removed[public_key] = revision
+        self.peers = peers
+        self.fetched_at = time.monotonic()
+        if changed or removed:
+            self.revision = revision
+        return changed, removed
+
+
+StatusListener = Callable[[str, InterfaceStatus, List[str], List[str]], None]
+
+
+class StatusCache:
+    """Interface status shared by every request, refreshed at most once per
+    ``interval`` seconds.
+
+    Concurrent readers of a stale interface wait on the same ``wg show``
+    instead of each starting their own. Every refresh that moves a counter,
+    handshake or endpoint bumps the interface revision, so pollers can ask
+    for just the peers that changed since the revision they last saw.
+    Revisions are handed out as ``"<epoch>:<n>"`` tokens; the epoch is new
+    in every process, so a token from another worker or from before a
+    restart gets a full answer instead of a wrong delta.
+    """
+
+    def __init__(self, interval: float = WG_STATUS_INTERVAL):
+        self.interval = interval
+        self.epoch = secrets.token_hex(4)
+        self._interfaces: Dict[str, InterfaceStatus] = {}
+        self._listeners: List[StatusListener] = []
+
+    def add_listener(self, callback: StatusListener) -> None:
+        """Call ``callback(interface, status, changed, removed)`` after each refresh"""
+        self._listeners.append(callback)
+
+    async def get(self, interface: str) -> InterfaceStatus:
+        status = self._interfaces.get(interface)
+        if status is None:
+            status = self._interfaces[interface] = InterfaceStatus()
+        if self._fresh(status):
+            return status
+        async with status.lock:
+            if not self._fresh(status):
+                stdout, _ = await runner.run(["wg", "show", interface, "dump"])
+                changed, removed = status.update(parse_status(stdout))
+                for callback in self._listeners:
+                    callback(interface, status, changed, removed)
+        return status
+
+    def invalidate(self, interface: str) -> None:
+        status = self._interfaces.get(interface)
+        if status is not None:
+            status.fetched_at = 0.0
+
+    def _fresh(self, status: InterfaceStatus) -> bool:
+        return (
+            status.fetched_at > 0
+            and time.monotonic() - status.fetched_at < self.interval
+        )
+
+    async def query(
+        self,
+        interface: str,
+        since_handshake: Optional[int] = None,
+        public_key: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        since_revision: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        status = await self.get(interface)
+        result: Dict[str, Any] = {
+            "name": interface,
+            "revision": f"{self.epoch}:{status.revision}",
+        }
+
+        since = self._parse_revision(since_revision)
+        delta = since is not None and since <= status.revision
+        peers: List[PeerStatus] = []
+        for key, peer in status.peers.items():
+            if delta and status.changed[key] <= since:
+                continue
+            if public_key and not key.startswith(public_key):
+                continue
+            if since_handshake is not None and peer.latest_handshake < since_handshake:
+                continue
+            peers.append(peer)
+
+        result["total"] = len(peers)
+        end = None if limit is None else offset + limit
+        result["peers"] = [peer._asdict() for peer in peers[offset:end]]
+        if since_revision is not None:
+            result["full"] = not delta
+        if delta:
+            result["removed"] = [
+                key for key, revision in status.removed.items() if revision > since
+            ]
+        return result
+
+    def _parse_revision(self, token: Optional[str]) -> Optional[int]:
+        # None for a token this process did not hand out
+        epoch, _, revision = (token or "").partition(":")
+        if epoch != self.epoch or not revision.isdigit():
+            return None
+        return int(revision)
+
+
+status_cache = StatusCache()
@@ -0,0 +1,30 @@
+import pytest
+from service_layer.wireguard.addresses import AddressPool, AddressPoolExhausted
+
+
+def test_allocate_skips_reserved_and_claimed():
+    pool = AddressPool("10.0.0.1/24", reserved=["10.0.0.1"])
+    pool.claim("10.0.0.2")
+
+    assert pool.allocate() == "10.0.0.3"
+    assert pool.available == 256 - 5
+
+
+def test_released_addresses_are_reused_first():
+    pool = AddressPool("10.0.0.0/29")
+    first, second = pool.allocate(), pool.allocate()
+    pool.release(first)
+
+    assert pool.allocate() == first
+    assert pool.allocate() != second
+
+
+def test_exhausted_pool():
+    pool = AddressPool("10.0.0.0/30")
+    assert [pool.allocate(), pool.allocate()] == ["10.0.0.1", "10.0.0.2"]
+
+    with pytest.raises(AddressPoolExhausted):
+        pool.allocate()
+    pool.release("10.0.0.3")
+    with pytest.raises(AddressPoolExhausted):
+        pool.allocate()
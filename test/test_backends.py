@@ -0,0 +1,110 @@
+import asyncio
+import pytest
+from service_layer.etcd.backend import create_storage
+from service_layer.etcd.memory import MemoryStorage
+from service_layer.etcd.sqlite import SQLiteStorage
+from service_layer.etcd.storage import KeyValue
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        storage = MemoryStorage()
+    else:
+        storage = SQLiteStorage(str(tmp_path / "vpn.sqlite3"))
+    yield storage
+    storage.close()
+
+
+def test_put_get_and_prefix_range(storage):
+    async def main():
+        await storage.put("/a/2", b"two")
+        await storage.put("/a/1", b"one")
+        await storage.put("/b/1", b"other")
+        return (
+            await storage.get("/a/1"),
+            await storage.get("/a/3"),
+            await storage.get_prefix("/a/"),
+            await storage.get_prefix("/a/", keys_only=True),
+            await storage.range("/a/", b"/a0", limit=1),
+        )
+
+    value, missing, items, keys, page = asyncio.run(main())
+    assert value == b"one"
+    assert missing is None
+    assert [(item.key, item.value) for item in items] == [
+        ("/a/1", b"one"),
+        ("/a/2", b"two"),
+    ]
+    assert [item.value for item in keys] == [b"", b""]
+    assert [item.key for item in page] == ["/a/1"]
+
+
+def test_txn_compares_and_applies_atomically(storage):
+    transactions = storage.transactions
+
+    async def main():
+        created, _ = await storage.txn(
+            compare=[transactions.version("/k") == 0],
+            success=[transactions.put("/k", b"1"), transactions.put("/i", b"x")],
+        )
+        _, revision = await storage.get_with_revision("/k")
+        conflict, responses = await storage.txn(
+            compare=[transactions.version("/k") == 0],
+            success=[transactions.put("/k", b"2")],
+            failure=[transactions.get("/k")],
+        )
+        value_check, _ = await storage.txn(
+            compare=[transactions.value("/missing") == b""],
+            success=[transactions.put("/missing", b"y")],
+        )
+        swapped, deleted = await storage.txn(
+            compare=[transactions.mod("/k") == revision],
+            success=[transactions.delete("/k"), transactions.delete("/nope")],
+        )
+        return created, revision, conflict, responses, value_check, swapped, deleted
+
+    created, revision, conflict, responses, value_check, swapped, deleted = asyncio.run(
+        main()
+    )
+    assert created and not conflict and not value_check and swapped
+    # both puts of the first transaction share one revision
+    assert revision == 2
+    assert responses == [[KeyValue("/k", b"1", 2)]]
+    assert deleted == [1, 0]
+    _, revision = asyncio.run(storage.get_with_revision("/k"))
+    assert revision == 3
+
+
+def test_watch_receives_writes_under_its_prefix(storage):
+    events = []
+
+    async def main():
+        cancel = await storage.watch_prefix("/a/", events.append)
+        await storage.put("/a/1", b"one")
+        await storage.put("/b/1", b"other")
+        await storage.delete("/a/1")
+        cancel()
+        await storage.put("/a/2", b"two")
+
+    asyncio.run(main())
+    assert events == [[KeyValue("/a/1", b"one", 2)], [KeyValue("/a/1", None, 4)]]
+
+
+def test_sqlite_keeps_data_and_revision_across_restarts(tmp_path):
+    path = str(tmp_path / "vpn.sqlite3")
+    storage = SQLiteStorage(path)
+    asyncio.run(storage.put("/a/1", b"one"))
+    storage.close()
+
+    storage = SQLiteStorage(path)
+    try:
+        assert asyncio.run(storage.get_with_revision("/a/1")) == (b"one", 2)
+    finally:
+        storage.close()
+
+
+def test_create_storage_by_name():
+    assert isinstance(create_storage("memory"), MemoryStorage)
+    with pytest.raises(ValueError):
+        create_storage("lmdb")
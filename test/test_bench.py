@@ -0,0 +1,38 @@
+import asyncio
+import os
+from bench.run import find_regressions, percentile, run_benchmark
+
+
+def test_percentile_is_nearest_rank():
+    samples = [float(value) for value in range(1, 101)]
+    assert percentile(samples, 0.5) == 50.0
+    assert percentile(samples, 0.99) == 99.0
+    assert percentile([], 0.5) == 0.0
+
+
+def test_find_regressions_ignores_noise():
+    baseline = {"operations": {"me": {"p50_ms": 1.0, "p99_ms": 10.0}}}
+    report = {
+        "operations": {
+            "me": {"p50_ms": 1.3, "p99_ms": 15.0},
+            "config_get": {"p50_ms": 5.0, "p99_ms": 9.0},
+        }
+    }
+    assert find_regressions(report, baseline) == ["me p99: 10.00ms -> 15.00ms (+50%)"]
+
+
+def test_benchmark_runs_offline(monkeypatch):
+    monkeypatch.setenv("FAKE_WG_STATE", "/nonexistent")
+    monkeypatch.delenv("PYTHONPATH", raising=False)
+    path = os.environ["PATH"]
+    mix = {"me": 3, "config_get": 3, "config_list": 1, "peer_add": 1, "peer_remove": 1}
+    report = asyncio.run(
+        run_benchmark(requests=30, concurrency=4, mix=mix, users=1, configs=5)
+    )
+    operations = report["operations"]
+    assert sum(stats["count"] for stats in operations.values()) == 30
+    assert all(stats["errors"] == 0 for stats in operations.values())
+    assert operations["me"]["p50_ms"] <= operations["me"]["p99_ms"]
+    assert os.environ["PATH"] == path
+    assert os.environ["FAKE_WG_STATE"] == "/nonexistent"
+    assert "PYTHONPATH" not in os.environ
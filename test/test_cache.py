@@ -0,0 +1,83 @@
+import asyncio
+import pytest
+from service_layer.etcd.cache import WatchCache
+from service_layer.etcd.storage import KeyValue
+
+
+class FakeWatchStorage:
+    def __init__(self, items, revision=10):
+        self.items = items
+        self.revision = revision
+        self.callback = None
+        self.start_revision = None
+
+    async def snapshot(self, prefix):
+        return [KeyValue(k, v, 1) for k, v in self.items.items()], self.revision
+
+    async def watch_prefix(self, prefix, callback, start_revision=None):
+        self.callback = callback
+        self.start_revision = start_revision
+        return lambda: None
+
+
+@pytest.fixture
+def storage():
+    return FakeWatchStorage({"/vpn/users/alice": b"a", "/vpn/users/bob": b"b"})
+
+
+def start(cache):
+    asyncio.run(cache.start())
+    return cache
+
+
+def test_loads_prefix_and_watches_from_next_revision(storage):
+    cache = start(WatchCache(storage, "/vpn/users/"))
+
+    assert cache.get("/vpn/users/alice") == (True, b"a")
+    assert cache.get("/vpn/users/carol") == (False, None)
+    assert storage.start_revision == 11
+    assert cache.stats() == {"entries": 2, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_watch_events_update_and_delete(storage):
+    cache = start(WatchCache(storage, "/vpn/users/"))
+
+    storage.callback(
+        [
+            KeyValue("/vpn/users/alice", b"a2", 11),
+            KeyValue("/vpn/users/bob", None, 12),
+        ]
+    )
+
+    assert cache.get("/vpn/users/alice") == (True, b"a2")
+    assert cache.get("/vpn/users/bob") == (True, None)
+
+
+def test_stale_read_through_does_not_overwrite_newer_event(storage):
+    cache = start(WatchCache(storage, "/vpn/users/"))
+
+    storage.callback([KeyValue("/vpn/users/carol", None, 15)])
+    cache.store("/vpn/users/carol", b"old", 14)
+
+    assert cache.get("/vpn/users/carol") == (True, None)
+
+
+def test_lru_eviction(storage):
+    cache = start(WatchCache(storage, "/vpn/users/", max_entries=2))
+
+    cache.get("/vpn/users/alice")
+    cache.store("/vpn/users/carol", b"c", 11)
+
+    assert cache.get("/vpn/users/bob") == (False, None)
+    assert cache.get("/vpn/users/alice") == (True, b"a")
+    assert cache.evictions == 1
+
+
+def test_broken_watch_bypasses_cache(storage):
+    cache = start(WatchCache(storage, "/vpn/users/"))
+    cache._loop = None
+
+    storage.callback(None)
+
+    assert cache.live is False
+    assert cache.get("/vpn/users/alice") == (False, None)
@@ -1,33 +1,99 @@
+import asyncio
+import json
+import threading
 import pytest
+import typer
 from unittest.mock import patch
 from pathlib import Path
-from service_layer.wireguard import (
+from service_layer.wireguard.keys import KeyPool, public_key
+from service_layer.wireguard.cli import (
     generate_keys,
+    generate_keys_batch,
     create_interface,
     add_peer,
     remove_peer,
     get_interface_info,
     sync_config,
+    apply_peer_batch,
+    reconcile_interface,
+)
+from service_layer.wireguard.configs import config_renderer
+from service_layer.wireguard.peers import make_peer
+
+
+DUMP = (
+    "priv_key\tpub_key\t51820\toff\n"
+    "peer_a\tpsk_a\t1.2.3.4:51820\t10.0.0.2/32\t1620000000\t1000\t2000\t25\n"
+    "peer_b\t(none)\t(none)\t10.0.0.3/32\t0\t0\t0\toff\n"
 )
 
 
 @pytest.fixture
 def mock_run_command():
-    with patch("wireguard.cli.run_command") as mock:
+    with patch("service_layer.wireguard.cli.run_command") as mock:
         yield mock
 
 
 def test_generate_keys(mock_run_command):
-    mock_run_command.side_effect = [("private_key_123\n", ""), ("public_key_456\n", "")]
-
     result = generate_keys()
 
-    assert result == {"private_key": "private_key_123", "public_key": "public_key_456"}
-    assert mock_run_command.call_count == 2
+    assert len(result["private_key"]) == 44
+    assert result["public_key"] == public_key(result["private_key"])
+    mock_run_command.assert_not_called()
+
+
+def test_public_key_matches_rfc7748():
+    private_key = "dwdtCnMYpX08FsFyUbJmRd9ML4frwJkqsXf7pR25LCo="
+
+    assert public_key(private_key) == "hSDwCYkwp1R0i33ctD73Wg2/Og0mOBr066SpjqqbTmo="
+
+
+def test_refill_soon_runs_one_refill_at_a_time():
+    pool = KeyPool(size=4)
+    release = threading.Event()
+    calls = []
+
+    def refill():
+        calls.append(1)
+        release.wait(5)
+
+    pool.refill = refill
+
+    async def scenario():
+        for _ in range(5):
+            pool.refill_soon()
+        first = pool.refill_task
+        release.set()
+        await first
+        pool.refill_soon()
+        await pool.refill_task
 
+    asyncio.run(scenario())
+    assert len(calls) == 2
 
-def test_create_interface(mock_run_command):
-    with patch("pathlib.Path.write_text") as mock_write:
+
+def test_refill_soon_logs_failures(caplog):
+    pool = KeyPool(size=4)
+    pool.refill = lambda: 1 / 0
+
+    async def scenario():
+        pool.refill_soon()
+        await pool.refill_task
+
+    asyncio.run(scenario())
+    assert "Failed to refill the key pool" in caplog.text
+    assert pool._refilling is False
+
+
+def test_generate_keys_batch(mock_run_command):
+    keys = generate_keys_batch(3)
+
+    assert len({key["private_key"] for key in keys}) == 3
+    mock_run_command.assert_not_called()
+
+
+def test_create_interface(mock_run_command, tmp_path):
+    with patch.object(config_renderer, "config_dir", tmp_path):
         create_interface(
             name="wg0",
             private_key="private_key_123",
@@ -43,11 +109,28 @@ def test_create_interface(mock_run_command):
                 "ListenPort = 51820",
                 "Address = 10.0.0.1/24",
                 "DNS = 1.1.1.1",
+                "",
             ]
         )
 
-        mock_write.assert_called_once_with(expected_config)
-        mock_run_command.assert_called_once_with(["wg-quick", "up", "wg0"])
+        assert (tmp_path / "wg0.conf").read_text() == expected_config
+        assert (tmp_path / "wg0.conf").stat().st_mode & 0o777 == 0o600
+        mock_run_command.assert_not_called()
+
+
+def test_create_interface_keeps_an_existing_config(tmp_path):
+    (tmp_path / "wg0.conf").write_text("[Interface]\n\n[Peer]\nPublicKey = peer\n")
+
+    with patch.object(config_renderer, "config_dir", tmp_path):
+        with pytest.raises(typer.BadParameter):
+            create_interface(
+                name="wg0",
+                private_key="private_key_123",
+                listen_port=51820,
+                address="10.0.0.1/24",
+            )
+
+    assert "PublicKey = peer" in (tmp_path / "wg0.conf").read_text()
 
 
 def test_add_peer(mock_run_command):
@@ -85,10 +168,7 @@ def test_remove_peer(mock_run_command):
 
 
 def test_get_interface_info(mock_run_command):
-    mock_run_command.return_value = (
-        "public_key_1\t\t1.2.3.4:51820\t10.0.0.2/32\t1620000000\t1000\t2000\t25\n",
-        "",
-    )
+    mock_run_command.return_value = (DUMP, "")
 
     result = get_interface_info("wg0")
 
@@ -96,20 +176,28 @@ def test_get_interface_info(mock_run_command):
         "name": "wg0",
         "peers": [
             {
-                "public_key": "public_key_1",
-                "preshared_key": "",
+                "public_key": "peer_a",
                 "endpoint": "1.2.3.4:51820",
                 "allowed_ips": "10.0.0.2/32",
-                "latest_handshake": "1620000000",
-                "transfer_rx": "1000",
-                "transfer_tx": "2000",
-                "persistent_keepalive": "25",
-            }
+                "latest_handshake": 1620000000,
+                "transfer_rx": 1000,
+                "transfer_tx": 2000,
+                "persistent_keepalive": 25,
+            },
+            {
+                "public_key": "peer_b",
+                "endpoint": None,
+                "allowed_ips": "10.0.0.3/32",
+                "latest_handshake": 0,
+                "transfer_rx": 0,
+                "transfer_tx": 0,
+                "persistent_keepalive": None,
+            },
         ],
     }
 
 
-def test_sync_config(mock_run_command):
+def test_sync_config(mock_run_command, tmp_path):
     config = {
         "interfaces": [
             {
@@ -133,10 +221,179 @@ def test_sync_config(mock_run_command):
     config_file = Path("/tmp/wg-config.json")
     with patch("pathlib.Path.exists") as mock_exists, patch(
         "pathlib.Path.read_text"
-    ) as mock_read, patch("json.loads") as mock_loads:
+    ) as mock_read, patch("json.loads") as mock_loads, patch.object(
+        config_renderer, "config_dir", tmp_path
+    ):
 
         mock_exists.return_value = True
         mock_read.return_value = "{}"
         mock_loads.return_value = config
+        mock_run_command.return_value = (DUMP, "")
+
+        plans = sync_config(config_file)
+
+    written = (tmp_path / "wg0.conf").read_text()
+    assert "[Peer]\nPublicKey = public_key_456\n" in written
+    assert "AllowedIPs = 10.0.0.2/32" in written
+    assert plans == {
+        "wg0": {
+            "added": ["public_key_456"],
+            "changed": [],
+            "removed": ["peer_a", "peer_b"],
+        }
+    }
+    mock_run_command.assert_called_with(
+        [
+            "wg",
+            "set",
+            "wg0",
+            "peer",
+            "peer_a",
+            "remove",
+            "peer",
+            "peer_b",
+            "remove",
+            "peer",
+            "public_key_456",
+            "allowed-ips",
+            "10.0.0.2/32",
+            "endpoint",
+            "example.com:51820",
+            "persistent-keepalive",
+            "25",
+        ]
+    )
+
+
+def test_sync_config_adds_peers_provisioned_in_etcd(mock_run_command, tmp_path):
+    from query_sets.wireguard import WireGuardQuerySets
+    from service_layer.etcd.memory import MemoryStorage
+
+    query_set = WireGuardQuerySets(MemoryStorage())
+
+    async def provision():
+        await query_set.storage.put("/vpn/users/alice", b"{}")
+        for name in ("wg0", "wg1", "wg2"):
+            await query_set.register_interface(name, "10.0.0.1/24")
+            await query_set.provision_peer(name, "alice", "api_key")
+
+    asyncio.run(provision())
+    config = {
+        "interfaces": [
+            {
+                "name": "wg0",
+                "private_key": "private_key_123",
+                "listen_port": 51820,
+                "address": "10.0.0.1/24",
+                "peers": [{"public_key": "json_key", "allowed_ips": "10.0.0.9/32"}],
+            }
+        ]
+    }
+    config_file = tmp_path / "wg-config.json"
+    config_file.write_text(json.dumps(config))
+    (tmp_path / "wg1.conf").write_text("[Interface]\nPrivateKey = private_key_1\n")
+    mock_run_command.return_value = (DUMP, "")
+
+    with patch.object(config_renderer, "config_dir", tmp_path), patch(
+        "query_sets.wireguard.get_storage", return_value=query_set.storage
+    ):
+        plans = sync_config(config_file, etcd=True)
+
+    # wg2 has no config file here, it belongs to another host
+    assert sorted(plans) == ["wg0", "wg1"]
+    assert sorted(plans["wg0"]["added"]) == ["api_key", "json_key"]
+    assert plans["wg1"]["added"] == ["api_key"]
+    written = (tmp_path / "wg1.conf").read_text()
+    assert "PrivateKey = private_key_1" in written
+    assert "PublicKey = api_key\nAllowedIPs = 10.0.0.2/32" in written
+
+
+def test_sync_config_needs_a_source():
+    with pytest.raises(typer.BadParameter):
+        sync_config()
+
+
+def test_reconcile_interface_applies_only_the_delta(mock_run_command):
+    mock_run_command.return_value = (DUMP, "")
+    desired = {
+        "peer_a": make_peer("peer_a", "10.0.0.2/32", persistent_keepalive=25),
+        "peer_b": make_peer("peer_b", "10.0.0.9/32"),
+    }
+
+    plan = reconcile_interface("wg0", desired)
+
+    assert plan == {"added": [], "changed": ["peer_b"], "removed": []}
+    mock_run_command.assert_called_with(
+        [
+            "wg",
+            "set",
+            "wg0",
+            "peer",
+            "peer_b",
+            "allowed-ips",
+            "10.0.0.9/32",
+            "persistent-keepalive",
+            "off",
+        ]
+    )
+
+
+def test_reconcile_interface_dry_run(mock_run_command):
+    mock_run_command.return_value = (DUMP, "")
+
+    plan = reconcile_interface("wg0", {}, dry_run=True)
+
+    assert plan == {"added": [], "changed": [], "removed": ["peer_a", "peer_b"]}
+    mock_run_command.assert_called_once_with(["wg", "show", "wg0", "dump"])
+
+
+def test_apply_peer_batch(mock_run_command):
+    applied = {}
+
+    def run(command):
+        if command[1] == "syncconf":
+            applied["config"] = Path(command[3]).read_text()
+            return "", ""
+        return DUMP, ""
+
+    mock_run_command.side_effect = run
+
+    counts = apply_peer_batch(
+        "wg0",
+        upsert=[
+            make_peer("peer_a", "10.0.0.2/32, 10.0.1.0/24", "1.2.3.4:51820", 25),
+            make_peer("peer_c", "10.0.0.4/32"),
+        ],
+        remove=["peer_b"],
+    )
+
+    assert counts == {"added": 1, "updated": 1, "removed": 1}
+    assert mock_run_command.call_count == 2
+    assert applied["config"] == "\n".join(
+        [
+            "[Interface]",
+            "PrivateKey = priv_key",
+            "ListenPort = 51820",
+            "",
+            "[Peer]",
+            "PublicKey = peer_a",
+            "PresharedKey = psk_a",
+            "AllowedIPs = 10.0.0.2/32, 10.0.1.0/24",
+            "Endpoint = 1.2.3.4:51820",
+            "PersistentKeepalive = 25",
+            "",
+            "[Peer]",
+            "PublicKey = peer_c",
+            "AllowedIPs = 10.0.0.4/32",
+            "",
+        ]
+    )
+
+
+def test_apply_peer_batch_without_changes_skips_syncconf(mock_run_command):
+    mock_run_command.return_value = (DUMP, "")
+
+    counts = apply_peer_batch("wg0", remove=["unknown"])
 
-        sync_config(config_file)
+    assert counts == {"added": 0, "updated": 0, "removed": 0}
+    mock_run_command.assert_called_once_with(["wg", "show", "wg0", "dump"])
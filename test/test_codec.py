@@ -0,0 +1,81 @@
+import asyncio
+import json
+import orjson
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from etcd3.client import Transactions
+from service_layer.etcd import codec as codec_module
+from service_layer.etcd.codec import Codec, migrate_prefix
+from service_layer.etcd.storage import KeyValue
+
+VALUE = {"server": "vpn.example.com", "port": 51820, "tags": ["a", "b"], "ok": True}
+
+
+def test_orjson_round_trip_with_header():
+    codec = Codec("orjson")
+    data = codec.encode(VALUE)
+
+    assert data[0] == codec_module.ORJSON
+    assert codec.decode(data) == VALUE
+
+
+def test_legacy_json_still_reads():
+    codec = Codec("orjson")
+
+    assert codec.decode(json.dumps(VALUE).encode("utf-8")) == VALUE
+    assert codec.decode(b'{"x": NaN}')["x"] != 0
+
+
+def test_json_codec_writes_headerless_json():
+    assert json.loads(Codec("json").encode(VALUE)) == VALUE
+
+
+@pytest.mark.skipif(codec_module.zstandard is None, reason="zstandard not installed")
+def test_large_values_are_compressed():
+    codec = Codec("orjson", compress_min_bytes=64)
+    value = {"config": "x" * 10000}
+    data = codec.encode(value)
+
+    assert data[0] == codec_module.ZSTD
+    assert len(data) < 1000
+    assert codec.decode(data) == value
+
+
+def test_migrate_prefix_rewrites_legacy_values_in_chunks():
+    items = [
+        KeyValue(f"/vpn/configs/{i}", json.dumps({"n": i}).encode("utf-8"), i)
+        for i in range(5)
+    ]
+    items.append(KeyValue("/vpn/configs/9", Codec("orjson").encode({"n": 9}), 9))
+
+    async def fake_range(start, end, limit=None, keys_only=False):
+        return [item for item in items if item.key >= start][:limit]
+
+    storage = MagicMock()
+    storage.transactions = Transactions()
+    storage.range = AsyncMock(side_effect=fake_range)
+    storage.txn = AsyncMock(
+        side_effect=[(True, []), (False, []), (True, []), (False, [])]
+    )
+
+    counts = asyncio.run(migrate_prefix(storage, "/vpn/configs/", Codec("orjson"), 3))
+
+    assert counts == {"migrated": 4, "current": 1, "conflicts": 1}
+    first = storage.txn.await_args_list[0].kwargs
+    assert [op.key for op in first["success"]] == [
+        f"/vpn/configs/{i}" for i in range(3)
+    ]
+
+
+def test_raw_json_of_stored_values():
+    codec = Codec("orjson")
+    legacy = json.dumps(VALUE).encode("utf-8")
+
+    assert codec.raw_json(codec.encode(VALUE)) == orjson.dumps(VALUE)
+    assert orjson.loads(codec.raw_json(legacy)) == VALUE
+
+
+def test_raw_json_normalises_legacy_nan():
+    legacy = json.dumps({"a": float("nan"), "b": float("inf")}).encode("utf-8")
+
+    assert Codec("orjson").raw_json(legacy) == b'{"a":null,"b":null}'
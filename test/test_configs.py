@@ -0,0 +1,53 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+from service_layer.wireguard.configs import ConfigRenderer, write_atomic
+
+INTERFACE = {"private_key": "priv", "listen_port": 51820, "address": "10.0.0.1/24"}
+
+
+def test_write_atomic_skips_identical_content(tmp_path):
+    path = tmp_path / "wg0.conf"
+
+    assert write_atomic(path, "a\n") is True
+    with patch("os.replace") as replace:
+        assert write_atomic(path, "a\n") is False
+    replace.assert_not_called()
+    assert write_atomic(path, "b\n") is True
+    assert path.read_text() == "b\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["wg0.conf"]
+
+
+def test_unchanged_inputs_are_not_rendered(tmp_path):
+    renderer = ConfigRenderer(tmp_path)
+
+    assert renderer.write("wg0", INTERFACE) is True
+    assert renderer.write("wg0", dict(INTERFACE)) is False
+    assert renderer.write("wg0", {**INTERFACE, "dns": "1.1.1.1"}) is True
+    assert renderer.rendered == 2
+
+
+def test_sync_all_renders_peers_from_etcd(tmp_path):
+    renderer = ConfigRenderer(tmp_path)
+    renderer.write("wg0", INTERFACE)
+    query_set = MagicMock()
+    query_set.list_interfaces = AsyncMock(
+        return_value=[
+            {"name": "wg0", "address": "10.0.0.1/24", "listen_port": 51820},
+            {"name": "wg1", "address": "10.1.0.1/24", "listen_port": 51821},
+        ]
+    )
+    query_set.list_interface_peers = AsyncMock(
+        return_value=[
+            {"interface": "wg0", "public_key": "b", "address": "10.0.0.10"},
+            {"interface": "wg0", "public_key": "a", "address": "10.0.0.2"},
+        ]
+    )
+
+    results = asyncio.run(renderer.sync_all(query_set))
+
+    assert results == {"wg0": True}
+    config = (tmp_path / "wg0.conf").read_text()
+    assert config.index("PublicKey = a") < config.index("PublicKey = b")
+    assert "AllowedIPs = 10.0.0.10/32" in config
+    assert "PrivateKey = priv" in config
+    assert asyncio.run(renderer.sync_all(query_set)) == {"wg0": False}
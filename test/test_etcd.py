@@ -1,17 +1,34 @@
+import asyncio
 import pytest
-from etcd_client import EtcdClient
 from fastapi import HTTPException
+from query_sets.users import UsersQuerySets
+from query_sets.vpn_config import VpnConfigQuerySets
+from service_layer.etcd.memory import MemoryStorage
+from service_layer.etcd.sqlite import SQLiteStorage
 
 
-@pytest.fixture
-def etcd_client():
-    client = EtcdClient()
-    # Clean up any existing configs
-    client.client.delete_prefix("/vpn/configs/")
-    client.client.delete_prefix("/vpn/users/")
-    # Reset counter each call
-    client.client.put("/vpn/counter", b"0")
-    return client
+class Client:
+    """The old synchronous client surface, over the async query sets"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.configs = VpnConfigQuerySets(storage)
+        self.users = UsersQuerySets(storage)
+
+    def __getattr__(self, name):
+        query_set = self.configs if hasattr(self.configs, name) else self.users
+        method = getattr(query_set, name)
+        return lambda *args, **kwargs: asyncio.run(method(*args, **kwargs))
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def etcd_client(request, tmp_path):
+    if request.param == "memory":
+        storage = MemoryStorage()
+    else:
+        storage = SQLiteStorage(str(tmp_path / "vpn.sqlite3"))
+    yield Client(storage)
+    storage.close()
 
 
 def test_create_config(etcd_client):
@@ -74,6 +91,56 @@ def test_list_configs(etcd_client):
     assert stored_configs == configs
 
 
+def index_keys(etcd_client):
+    items = asyncio.run(etcd_client.storage.get_prefix("/vpn/config_index/", True))
+    return [item.key for item in items]
+
+
+def test_index_keys_follow_writes(etcd_client):
+    config_id = etcd_client.create_config({"owner": "alice", "protocol": "udp"})
+
+    assert index_keys(etcd_client) == [
+        f"/vpn/config_index/owner/alice/{config_id}",
+        f"/vpn/config_index/protocol/udp/{config_id}",
+    ]
+
+    etcd_client.update_config(config_id, {"owner": "bob", "protocol": "udp"})
+    assert index_keys(etcd_client) == [
+        f"/vpn/config_index/owner/bob/{config_id}",
+        f"/vpn/config_index/protocol/udp/{config_id}",
+    ]
+
+    etcd_client.delete_config(config_id)
+    assert index_keys(etcd_client) == []
+
+
+def test_list_configs_by_owner(etcd_client):
+    owners = ["alice", "bob", "alice", "alice", "bob"]
+    ids = [
+        etcd_client.create_config({"owner": owner, "server": f"vpn{i}.com"})
+        for i, owner in enumerate(owners)
+    ]
+    alice = [config_id for config_id, owner in zip(ids, owners) if owner == "alice"]
+
+    first = etcd_client.list_config_ids(2, where={"owner": "alice"})
+    rest = etcd_client.list_config_ids(2, first[-1], where={"owner": "alice"})
+    assert first + rest == alice
+
+    configs = etcd_client.list_configs(where={"owner": "bob", "server": "vpn4.com"})
+    assert configs == {ids[4]: {"owner": "bob", "server": "vpn4.com"}}
+
+
+def test_reindex_configs(etcd_client):
+    storage = etcd_client.storage
+    encoded = etcd_client.configs.codec.encode({"owner": "alice"})
+    asyncio.run(storage.put("/vpn/configs/7", encoded))
+    assert etcd_client.list_config_ids(where={"owner": "alice"}) == []
+
+    assert etcd_client.reindex_configs() == {"indexed": 1, "conflicts": 0}
+
+    assert etcd_client.list_config_ids(where={"owner": "alice"}) == [7]
+
+
 def test_create_user(etcd_client):
     username = "testuser"
     password = "testpass"
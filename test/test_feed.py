@@ -0,0 +1,82 @@
+import asyncio
+from service_layer.wireguard.feed import InterfaceFeed, TrafficFeeds
+from service_layer.wireguard.peers import PeerStatus
+from service_layer.wireguard.status import InterfaceStatus
+
+
+def peer(public_key, rx, tx, handshake=1620000000):
+    return PeerStatus(public_key, "1.2.3.4:51820", "10.0.0.2/32", handshake, rx, tx, 25)
+
+
+class FakeStatusCache:
+    def __init__(self, samples):
+        self.samples = samples
+        self.calls = 0
+
+    async def get(self, interface):
+        peers = self.samples[min(self.calls, len(self.samples) - 1)]
+        self.calls += 1
+        status = InterfaceStatus()
+        status.peers = peers
+        status.fetched_at = float(self.calls)
+        return status
+
+
+def test_update_computes_rates_and_deltas():
+    feed = InterfaceFeed("wg0", cache=None)
+
+    first = feed.update({"a": peer("a", 0, 0), "b": peer("b", 0, 0)}, 10.0)
+    second = feed.update({"a": peer("a", 2000, 500), "b": peer("b", 0, 0)}, 12.0)
+    third = feed.update({"a": peer("a", 2000, 500)}, 14.0)
+
+    assert first["full"] is True and len(first["peers"]) == 2
+    assert second["full"] is False
+    assert second["peers"] == [
+        {
+            "public_key": "a",
+            "endpoint": "1.2.3.4:51820",
+            "latest_handshake": 1620000000,
+            "transfer_rx": 2000,
+            "transfer_tx": 500,
+            "rx_rate": 1000.0,
+            "tx_rate": 250.0,
+        }
+    ]
+    assert [p["rx_rate"] for p in third["peers"]] == [0.0]
+    assert third["removed"] == ["b"]
+
+
+def test_subscribers_share_one_sampler():
+    cache = FakeStatusCache([{"a": peer("a", 0, 0)}, {"a": peer("a", 100, 100)}])
+    feeds = TrafficFeeds(cache)
+
+    async def listen(events):
+        stream = feeds.subscribe("wg0")
+        try:
+            return [await stream.__anext__() for _ in range(events)]
+        finally:
+            await stream.aclose()
+
+    async def scenario():
+        feeds.feed("wg0").interval = 0.01
+        return await asyncio.gather(*(listen(2) for _ in range(50)))
+
+    results = asyncio.run(scenario())
+
+    assert cache.calls <= 3
+    assert all(events == results[0] for events in results)
+    assert results[0][1]["peers"][0]["transfer_rx"] == 100
+    assert "wg0" not in feeds._feeds
+
+
+def test_slow_subscriber_gets_a_snapshot():
+    feed = InterfaceFeed("wg0", cache=None, queue_size=2)
+    queue = asyncio.Queue(2)
+    feed._subscribers.add(queue)
+
+    for step in range(5):
+        feed.publish(feed.update({"a": peer("a", step, step)}, float(step + 1)))
+
+    event = queue.get_nowait()
+    assert event["full"] is True
+    assert event["peers"][0]["transfer_rx"] == 4
@@ -0,0 +1,79 @@
+import asyncio
+from etcd3 import transactions
+from etcd3.client import Transactions
+from service_layer.etcd.id_allocator import IdAllocator
+from service_layer.etcd.storage import KeyValue
+
+
+class FakeCounterStorage:
+    """Just enough of EtcdStorage.txn to drive the allocator"""
+
+    def __init__(self):
+        self.data = {}
+        self.transactions = Transactions()
+        self.txn_count = 0
+
+    async def txn(self, compare, success=(), failure=()):
+        self.txn_count += 1
+        await asyncio.sleep(0)
+        ok = all(self._check(c) for c in compare)
+        responses = []
+        for op in success if ok else failure:
+            if isinstance(op, transactions.Put):
+                self.data[op.key] = op.value
+                responses.append(None)
+            else:
+                value = self.data.get(op.key)
+                responses.append([KeyValue(op.key, value, 1)] if value else [])
+        return ok, responses
+
+    def _check(self, compare):
+        value = self.data.get(compare.key)
+        if isinstance(compare, transactions.Version):
+            return (1 if value is not None else 0) == compare.value
+        return value == str(compare.value).encode("utf-8")
+
+
+def test_ids_are_served_from_a_leased_block():
+    storage = FakeCounterStorage()
+    allocator = IdAllocator(storage, "/vpn/counter", block_size=10)
+
+    async def main():
+        return [await allocator.next_id() for _ in range(25)]
+
+    assert asyncio.run(main()) == list(range(1, 26))
+    assert storage.txn_count == 3
+    assert storage.data["/vpn/counter"] == b"30"
+
+
+def test_existing_counter_is_continued():
+    storage = FakeCounterStorage()
+    storage.data["/vpn/counter"] = b"41"
+    allocator = IdAllocator(storage, "/vpn/counter", block_size=10)
+
+    assert asyncio.run(allocator.next_id()) == 42
+
+
+def test_workers_never_share_ids():
+    storage = FakeCounterStorage()
+    workers = [IdAllocator(storage, "/vpn/counter", block_size=7) for _ in range(3)]
+
+    async def take(allocator):
+        return [await allocator.next_id() for _ in range(20)]
+
+    async def main():
+        return await asyncio.gather(*(take(worker) for worker in workers))
+
+    ids = [i for chunk in asyncio.run(main()) for i in chunk]
+
+    assert len(ids) == len(set(ids)) == 60
+
+
+def test_next_ids_larger_than_block():
+    storage = FakeCounterStorage()
+    allocator = IdAllocator(storage, "/vpn/counter", block_size=10)
+
+    ids = asyncio.run(allocator.next_ids(25))
+
+    assert ids == list(range(1, 26))
+    assert storage.txn_count == 1
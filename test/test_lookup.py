@@ -0,0 +1,108 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, patch
+from service_layer.wireguard.lookup import PeerIndex
+from service_layer.wireguard.status import StatusCache
+
+DUMP = (
+    "priv_key\tpub_key\t51820\toff\n"
+    "peer_a\t(none)\t1.2.3.4:51820\t10.0.0.2/32,10.8.0.0/16\t0\t0\t0\toff\n"
+    "peer_b\t(none)\t1.2.3.4:40000\t10.0.0.3/32\t0\t0\t0\toff\n"
+    "peer_c\t(none)\t[2001:db8::1]:51820\t0.0.0.0/0,fd00::/64\t0\t0\t0\toff\n"
+)
+DUMP_MOVED = (
+    "priv_key\tpub_key\t51820\toff\n"
+    "peer_a\t(none)\t5.6.7.8:51820\t10.0.0.2/32\t10\t10\t10\toff\n"
+    "peer_b\t(none)\t1.2.3.4:40000\t10.0.0.3/32\t10\t10\t10\toff\n"
+)
+
+
+def indexed(*dumps):
+    cache = StatusCache(interval=60)
+    index = PeerIndex(cache)
+    run = AsyncMock(side_effect=[(dump, "") for dump in dumps])
+
+    async def scenario():
+        for _ in dumps:
+            cache.invalidate("wg0")
+            await cache.get("wg0")
+
+    with patch("service_layer.wireguard.status.runner.run", run):
+        asyncio.run(scenario())
+    return index
+
+
+def test_longest_prefix_first():
+    index = indexed(DUMP)
+
+    matches = index.lookup_ip("10.8.3.17")
+
+    assert [(m["public_key"], m["match"]) for m in matches] == [
+        ("peer_a", "10.8.0.0/16"),
+        ("peer_c", "0.0.0.0/0"),
+    ]
+    assert [m["public_key"] for m in index.lookup_ip("fd00::17")] == ["peer_c"]
+
+
+def test_endpoint_by_host_or_host_and_port():
+    index = indexed(DUMP)
+
+    assert [m["public_key"] for m in index.lookup_endpoint("1.2.3.4")] == [
+        "peer_a",
+        "peer_b",
+    ]
+    assert [m["public_key"] for m in index.lookup_endpoint("1.2.3.4:40000")] == [
+        "peer_b"
+    ]
+    assert [m["public_key"] for m in index.lookup_endpoint("2001:db8::1")] == ["peer_c"]
+
+
+def test_follows_peer_changes():
+    index = indexed(DUMP, DUMP_MOVED)
+
+    assert len(index) == 2
+    assert index.lookup_ip("10.8.3.17") == []
+    assert index.lookup_ip("8.8.8.8") == []
+    assert [m["public_key"] for m in index.lookup_endpoint("5.6.7.8")] == ["peer_a"]
+    assert index.lookup_ip("10.0.0.3")[0]["transfer_rx"] == 10
+
+
+def test_lookup_is_fast_at_100k_peers():
+    lines = ["priv_key\tpub_key\t51820\toff"]
+    for n in range(100000):
+        lines.append(
+            f"peer_{n}\t(none)\t1.{n >> 16}.{n >> 8 & 255}.{n & 255}:51820"
+            f"\t10.{n >> 16}.{n >> 8 & 255}.{n & 255}/32\t0\t0\t0\toff"
+        )
+    index = indexed("\n".join(lines) + "\n")
+
+    start = time.perf_counter()
+    for n in range(0, 100000, 100):
+        index.lookup_ip(f"10.{n >> 16}.{n >> 8 & 255}.{n & 255}")
+    elapsed = (time.perf_counter() - start) / 1000
+
+    assert len(index) == 100000
+    assert elapsed < 0.001
+
+
+def test_watch_refreshes_in_the_background():
+    index = PeerIndex(StatusCache(interval=0.05))
+    run = AsyncMock(
+        side_effect=lambda command: (
+            ("wg0\n", "") if command[2] == "interfaces" else (DUMP, "")
+        )
+    )
+
+    async def scenario():
+        await index.watch()
+        loaded_at = index.refreshed_at
+        await asyncio.sleep(0.2)
+        return loaded_at
+
+    with patch("service_layer.wireguard.lookup.runner.run", run), patch(
+        "service_layer.wireguard.status.runner.run", run
+    ):
+        loaded_at = asyncio.run(scenario())
+
+    assert len(index) == 3
+    assert index.refreshed_at > loaded_at
@@ -1,6 +1,10 @@
+import asyncio
+from types import SimpleNamespace
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import AsyncMock, MagicMock
+import orjson
 import pytest
+from dependencies import get_config_query_set
 from main import app
 
 client = TestClient(app)
@@ -8,42 +12,41 @@ client = TestClient(app)
 
 @pytest.fixture
 def mock_etcd():
-    with patch("routers.vpn_config.etcd_client") as mock_client:
-
-        configs = {}
-        counter = 0
-
-        def mock_create_config(config_data):
-            nonlocal counter
-            counter += 1
-            configs[counter] = config_data
-            return counter
-
-        def mock_get_config(config_id):
-            return configs.get(config_id)
-
-        def mock_update_config(config_id, config_data):
-            if config_id in configs:
-                configs[config_id] = config_data
-                return True
-            return False
-
-        def mock_delete_config(config_id):
-            if config_id in configs:
-                del configs[config_id]
-                return True
-            return False
-
-        def mock_list_configs():
-            return configs
-
-        mock_client.create_config = MagicMock(side_effect=mock_create_config)
-        mock_client.get_config = MagicMock(side_effect=mock_get_config)
-        mock_client.update_config = MagicMock(side_effect=mock_update_config)
-        mock_client.delete_config = MagicMock(side_effect=mock_delete_config)
-        mock_client.list_configs = MagicMock(side_effect=mock_list_configs)
-
-        yield mock_client
+    configs = {}
+    counter = 0
+
+    async def mock_create_config(config_data):
+        nonlocal counter
+        counter += 1
+        configs[counter] = config_data
+        return counter
+
+    async def mock_get_config_json(config_id):
+        if config_id not in configs:
+            return None
+        return orjson.dumps(configs[config_id])
+
+    async def mock_update_config(config_id, config_data):
+        if config_id in configs:
+            configs[config_id] = config_data
+            return True
+        return False
+
+    async def mock_delete_config(config_id):
+        if config_id in configs:
+            del configs[config_id]
+            return True
+        return False
+
+    mock_client = SimpleNamespace(
+        create_config=AsyncMock(side_effect=mock_create_config),
+        get_config_json=AsyncMock(side_effect=mock_get_config_json),
+        update_config=AsyncMock(side_effect=mock_update_config),
+        delete_config=AsyncMock(side_effect=mock_delete_config),
+    )
+    app.dependency_overrides[get_config_query_set] = lambda: mock_client
+    yield mock_client
+    app.dependency_overrides.clear()
 
 
 def test_create_vpn_config(mock_etcd):
@@ -56,7 +59,7 @@ def test_create_vpn_config(mock_etcd):
     response = client.get(f"/api/v1/config/{config_id}")
     assert response.status_code == 200
     assert response.json() == test_config
-    mock_etcd.get_config.assert_called_with(config_id)
+    mock_etcd.get_config_json.assert_called_with(config_id)
 
     updated_config = {"server": "new.vpn.com", "port": 443, "protocol": "tcp"}
     response = client.put(
@@ -76,3 +79,119 @@ def test_create_vpn_config(mock_etcd):
 
     get_response = client.get(f"/api/v1/config/{config_id}")
     assert get_response.status_code == 404
+
+
+def test_list_vpn_configs_by_owner(mock_etcd):
+    mock_etcd.list_configs_json = AsyncMock(return_value=[(3, b'{"owner":"alice"}')])
+
+    response = client.get("/api/v1/config/", params={"owner": "alice", "limit": 1})
+
+    assert response.json() == {"3": {"owner": "alice"}}
+    assert response.headers["X-Next-After"] == "3"
+    mock_etcd.list_configs_json.assert_awaited_once_with(1, None, {"owner": "alice"})
+
+
+def test_ready_before_startup():
+    # no lifespan ran, nothing was built or connected
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json() == {"ready": False, "checks": {}}
+
+
+def test_ready_after_warm_up():
+    app.state.services = SimpleNamespace(ready=True, checks={"storage": "ok"})
+    try:
+        response = client.get("/ready")
+    finally:
+        del app.state.services
+    assert response.status_code == 200
+    assert response.json() == {"ready": True, "checks": {"storage": "ok"}}
+
+
+def test_warm_up_retries_failed_checks(monkeypatch):
+    from dependencies import Services
+    import dependencies
+
+    monkeypatch.setattr(dependencies, "WARMUP_RETRY_DELAY", 0)
+    monkeypatch.setattr(dependencies.key_pool, "refill", lambda: None)
+    services = Services(storage=MagicMock())
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError("etcd is down")
+
+    services._checks = {"storage": flaky, "cache": AsyncMock()}
+    services.checks = dict.fromkeys(services._checks, "pending")
+    asyncio.run(services.warm_up())
+    assert services.ready
+    assert len(calls) == 3
+    services._checks["cache"].assert_awaited_once()
+
+
+def test_closed_services_release_their_storage():
+    import gc
+    import weakref
+    from dependencies import Services
+    from service_layer.etcd.memory import MemoryStorage
+
+    services = Services(MemoryStorage())
+    assert services.users.cache is services.caches[0]
+    assert services.configs.id_allocator is services.id_allocator
+    storage = weakref.ref(services.storage)
+    services.close()
+    del services
+    gc.collect()
+    assert storage() is None
+
+
+@pytest.fixture
+def configs_query_set():
+    from query_sets.vpn_config import VpnConfigQuerySets
+    from service_layer.etcd.memory import MemoryStorage
+
+    storage = MemoryStorage()
+    query_set = VpnConfigQuerySets(storage)
+    app.dependency_overrides[get_config_query_set] = lambda: query_set
+    yield
+    app.dependency_overrides.clear()
+    storage.close()
+
+
+def test_create_vpn_configs_batch(configs_query_set):
+    response = client.post(
+        "/api/v1/config/batch",
+        json=[{"config_data": {"server": f"vpn{i}.com"}} for i in range(3)],
+    )
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["created"] * 3
+    for i, result in enumerate(results):
+        stored = client.get(f"/api/v1/config/{result['config_id']}")
+        assert stored.json() == {"server": f"vpn{i}.com"}
+
+
+def test_create_vpn_configs_batch_size_limit(configs_query_set):
+    from routers.vpn_config import BATCH_MAX_ITEMS
+
+    configs = [{"config_data": {}}] * (BATCH_MAX_ITEMS + 1)
+    response = client.post("/api/v1/config/batch", json=configs)
+
+    assert response.status_code == 422
+
+
+def test_list_vpn_configs_modes_share_one_shape(configs_query_set):
+    for i in range(12):
+        client.post("/api/v1/config/", json={"config_data": {"server": f"vpn{i}"}})
+
+    full = client.get("/api/v1/config/", params={"limit": 5})
+    keys = client.get("/api/v1/config/", params={"limit": 5, "keys_only": True})
+    fields = client.get("/api/v1/config/", params={"limit": 5, "fields": "server"})
+
+    # pages are in key order, where "10" sorts before "2"
+    assert list(full.json()) == ["1", "10", "11", "12", "2"]
+    assert keys.json() == dict.fromkeys(full.json())
+    assert fields.json() == full.json()
+    assert {r.headers["X-Next-After"] for r in (full, keys, fields)} == {"2"}
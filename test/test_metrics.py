@@ -0,0 +1,72 @@
+import asyncio
+from fastapi.testclient import TestClient
+from main import app
+from service_layer.metrics import (
+    Histogram,
+    Registry,
+    request_seconds,
+    timed,
+    wg_command,
+)
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("op_seconds", "Op latency", ("op",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "get")
+    histogram.observe(0.5, "get")
+    histogram.observe(5, "get")
+    assert histogram.render() == [
+        "# HELP op_seconds Op latency",
+        "# TYPE op_seconds histogram",
+        'op_seconds_bucket{op="get",le="0.1"} 1',
+        'op_seconds_bucket{op="get",le="1.0"} 2',
+        'op_seconds_bucket{op="get",le="+Inf"} 3',
+        'op_seconds_sum{op="get"} 5.55',
+        'op_seconds_count{op="get"} 3',
+    ]
+
+
+def test_timed_labels_by_method_name_and_counts_failures():
+    histogram = Histogram("query_seconds", "Query latency", ("method",))
+
+    class QuerySet:
+        @timed(histogram)
+        async def get_user(self, username):
+            if username is None:
+                raise KeyError(username)
+            return username
+
+    assert asyncio.run(QuerySet().get_user("alice")) == "alice"
+    try:
+        asyncio.run(QuerySet().get_user(None))
+    except KeyError:
+        pass
+    assert histogram.count("get_user") == 2
+
+
+def test_registry_includes_collectors():
+    registry = Registry()
+    collector = lambda: [
+        ("cache_entries", "Entries", "gauge", [({"cache": "token"}, 3)])
+    ]
+    registry.add_collector(collector)
+    assert 'cache_entries{cache="token"} 3' in registry.render()
+    registry.remove_collector(collector)
+    assert "cache_entries" not in registry.render()
+
+
+def test_wg_command_label():
+    assert wg_command(["wg", "show", "wg0", "dump"]) == "show"
+    assert wg_command(["wg-quick", "up", "/etc/wireguard/wg0.conf"]) == "wg-quick up"
+
+
+def test_metrics_endpoint_reports_route_templates():
+    client = TestClient(app)
+    before = request_seconds.count("GET", "/ready", "503")
+    client.get("/ready")
+    assert request_seconds.count("GET", "/ready", "503") == before + 1
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'route="/ready",status="503"' in response.text
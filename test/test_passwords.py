@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import pytest
+from fastapi import HTTPException
+from service_layer import passwords
+from service_layer.passwords import PasswordHasher
+
+
+def test_hash_and_verify_run_off_the_event_loop(monkeypatch):
+    threads = []
+
+    def fake_hash(password):
+        threads.append(threading.get_ident())
+        return f"hashed-{password}"
+
+    monkeypatch.setattr(passwords.pwd_context, "hash", fake_hash)
+    hasher = PasswordHasher(workers=2, queue_limit=4)
+
+    async def main():
+        return threading.get_ident(), await hasher.hash("secret")
+
+    loop_thread, hashed = asyncio.run(main())
+
+    assert hashed == "hashed-secret"
+    assert threads and loop_thread not in threads
+
+
+def test_real_bcrypt_round_trip():
+    hasher = PasswordHasher(workers=1, queue_limit=1)
+
+    async def main():
+        hashed = await hasher.hash("secret")
+        return await hasher.verify("secret", hashed), await hasher.verify("x", hashed)
+
+    assert asyncio.run(main()) == (True, False)
+
+
+def test_full_queue_is_rejected_early():
+    hasher = PasswordHasher(workers=1, queue_limit=0)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(hasher.hash("secret"))
+
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "1"}
+
+
+def test_hash_many_ignores_queue_limit(monkeypatch):
+    monkeypatch.setattr(passwords.pwd_context, "hash", lambda p: p.upper())
+    hasher = PasswordHasher(workers=2, queue_limit=0)
+
+    assert asyncio.run(hasher.hash_many(["a", "b", "c"])) == ["A", "B", "C"]
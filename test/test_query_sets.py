@@ -0,0 +1,269 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from etcd3.client import Transactions
+from fastapi import HTTPException
+from query_sets.users import UsersQuerySets
+from query_sets.vpn_config import VpnConfigQuerySets
+from query_sets.wireguard import WireGuardQuerySets
+from service_layer.etcd.storage import KeyValue
+
+
+@pytest.fixture
+def storage():
+    storage = MagicMock()
+    storage.transactions = Transactions()
+    storage.txn = AsyncMock(return_value=(True, [None]))
+    storage.delete = AsyncMock(return_value=True)
+    storage.get = AsyncMock()
+    return storage
+
+
+def test_create_user_is_one_transaction(storage):
+    asyncio.run(UsersQuerySets(storage).create_user("alice", "secret"))
+
+    storage.txn.assert_awaited_once()
+    storage.get.assert_not_awaited()
+
+
+def test_create_duplicate_user(storage):
+    storage.txn.return_value = (False, [])
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(UsersQuerySets(storage).create_user("alice", "secret"))
+
+    assert exc_info.value.status_code == 400
+
+
+def config_storage(storage, config_data):
+    value = VpnConfigQuerySets(storage).codec.encode(config_data)
+    storage.get_with_revision = AsyncMock(return_value=(value, 5))
+    return value
+
+
+def test_update_config_moves_index_keys_in_one_transaction(storage):
+    value = config_storage(storage, {"owner": "alice", "protocol": "udp"})
+
+    updated = asyncio.run(
+        VpnConfigQuerySets(storage).update_config(
+            1, {"owner": "bob", "protocol": "udp"}
+        )
+    )
+
+    assert updated is True
+    storage.txn.assert_awaited_once()
+    (compare,) = storage.txn.await_args.kwargs["compare"]
+    assert compare.value == value
+    success = storage.txn.await_args.kwargs["success"]
+    assert [type(op).__name__ for op in success] == ["Put", "Delete", "Put"]
+    assert [op.key for op in success] == [
+        "/vpn/configs/1",
+        "/vpn/config_index/owner/alice/1",
+        "/vpn/config_index/owner/bob/1",
+    ]
+
+
+def test_update_config_retries_with_the_current_value(storage):
+    config_storage(storage, {"owner": "alice"})
+    newer = VpnConfigQuerySets(storage).codec.encode({"owner": "carol"})
+    storage.txn.side_effect = [
+        (False, [[KeyValue("/vpn/configs/1", newer, 6)]]),
+        (True, [None, 1, None]),
+    ]
+
+    assert asyncio.run(VpnConfigQuerySets(storage).update_config(1, {"owner": "bob"}))
+
+    retry = storage.txn.await_args_list[1].kwargs
+    assert retry["compare"][0].value == newer
+    assert retry["success"][1].key == "/vpn/config_index/owner/carol/1"
+
+
+@pytest.mark.parametrize("method", ["update_config", "delete_config"])
+def test_missing_config_is_checked_in_one_transaction(storage, method):
+    storage.get_with_revision = AsyncMock(return_value=(None, 5))
+    args = (1, {"a": 1}) if method == "update_config" else (1,)
+
+    assert asyncio.run(getattr(VpnConfigQuerySets(storage), method)(*args)) is False
+    storage.txn.assert_awaited_once()
+    assert storage.txn.await_args.kwargs["success"] == []
+
+
+def test_delete_config_removes_index_keys(storage):
+    config_storage(storage, {"owner": "alice", "server": "vpn.example.com"})
+
+    assert asyncio.run(VpnConfigQuerySets(storage).delete_config(1)) is True
+    storage.delete.assert_not_awaited()
+    success = storage.txn.await_args.kwargs["success"]
+    assert [op.key for op in success] == [
+        "/vpn/configs/1",
+        "/vpn/config_index/owner/alice/1",
+        "/vpn/config_index/server/vpn.example.com/1",
+    ]
+
+
+def test_create_configs_uses_one_lease_and_chunked_transactions(storage):
+    query_set = VpnConfigQuerySets(storage)
+    query_set.id_allocator = MagicMock()
+    query_set.id_allocator.next_ids = AsyncMock(return_value=list(range(1, 301)))
+
+    results = asyncio.run(query_set.create_configs([{"n": i} for i in range(300)]))
+
+    assert [r["config_id"] for r in results] == list(range(1, 301))
+    assert {r["status"] for r in results} == {"created"}
+    assert storage.txn.await_count == 3
+
+
+def test_create_configs_reports_the_ids_of_a_failed_chunk(storage):
+    query_set = VpnConfigQuerySets(storage)
+    query_set.id_allocator = MagicMock()
+    query_set.id_allocator.next_ids = AsyncMock(return_value=list(range(1, 201)))
+    storage.txn.side_effect = [(True, [None]), Exception("etcd unavailable")]
+
+    results = asyncio.run(query_set.create_configs([{"n": i} for i in range(200)]))
+
+    assert [r["config_id"] for r in results] == list(range(1, 201))
+    assert [r["status"] for r in results[:128]] == ["created"] * 128
+    assert results[128] == {
+        "config_id": 129,
+        "status": "failed",
+        "detail": "etcd unavailable",
+    }
+
+
+def test_create_configs_keeps_index_keys_with_their_config(storage):
+    query_set = VpnConfigQuerySets(storage)
+    query_set.id_allocator = MagicMock()
+    query_set.id_allocator.next_ids = AsyncMock(return_value=list(range(1, 101)))
+    configs = [{"owner": "alice", "server": "s", "protocol": "udp"}] * 100
+
+    asyncio.run(query_set.create_configs(configs))
+
+    sizes = [len(call.kwargs["success"]) for call in storage.txn.await_args_list]
+    assert sizes == [128, 128, 128, 16]
+
+
+def test_create_users_skips_taken_names(storage):
+    taken = [[], [MagicMock(key="/vpn/users/bob")]]
+    storage.txn.side_effect = [(False, taken), (True, [None])]
+    users = [
+        {"username": "alice", "password": "a"},
+        {"username": "bob", "password": "b"},
+        {"username": "alice", "password": "c"},
+    ]
+
+    results = asyncio.run(UsersQuerySets(storage).create_users(users))
+
+    assert results == [
+        {"username": "alice", "status": "created"},
+        {"username": "bob", "status": "exists"},
+        {"username": "alice", "status": "exists"},
+    ]
+    retry = storage.txn.await_args_list[1].kwargs["success"]
+    assert [op.key for op in retry] == ["/vpn/users/alice"]
+
+
+def test_iter_configs_pages_by_key(storage):
+    items = [
+        KeyValue(f"/vpn/configs/{i}", json.dumps({"server": i, "port": 1}).encode(), 1)
+        for i in range(1, 6)
+    ]
+
+    async def fake_range(start, end, limit=None, keys_only=False):
+        return [item for item in items if item.key > start][:limit]
+
+    storage.range = AsyncMock(side_effect=fake_range)
+    query_set = VpnConfigQuerySets(storage)
+
+    async def main():
+        return [c async for c in query_set.iter_configs(2, fields=["server"])]
+
+    configs = asyncio.run(main())
+
+    assert configs == [(i, {"server": i}) for i in range(1, 6)]
+    assert storage.range.await_count == 3
+    assert all(call.kwargs["limit"] == 2 for call in storage.range.await_args_list)
+
+
+def wireguard_storage(storage, claimed=()):
+    interface = {"name": "wg0", "address": "10.0.0.1/24", "public_key": "pub"}
+    storage.get.return_value = json.dumps(interface).encode()
+    storage.get_prefix = AsyncMock(
+        return_value=[
+            KeyValue(f"/vpn/wireguard/ips/wg0/{ip}", None, 1) for ip in claimed
+        ]
+    )
+    storage.txn.return_value = (True, [None, None, None])
+    return storage
+
+
+def test_provision_peer_claims_the_next_free_address(storage):
+    query_set = WireGuardQuerySets(wireguard_storage(storage, claimed=["10.0.0.2"]))
+
+    record = asyncio.run(query_set.provision_peer("wg0", "alice", "a/b+c="))
+
+    assert record["address"] == "10.0.0.3"
+    success = storage.txn.await_args.kwargs["success"]
+    assert [op.key for op in success] == [
+        "/vpn/wireguard/ips/wg0/10.0.0.3",
+        "/vpn/wireguard/peers/wg0/a_b-c=",
+        "/vpn/wireguard/users/alice/wg0/a_b-c=",
+    ]
+
+
+def test_provision_peer_skips_addresses_claimed_elsewhere(storage):
+    wireguard_storage(storage)
+    lost = [[MagicMock()], [], [MagicMock()]]
+    storage.txn.side_effect = [(False, lost), (True, [None, None, None])]
+
+    record = asyncio.run(
+        WireGuardQuerySets(storage).provision_peer("wg0", "alice", "k")
+    )
+
+    assert record["address"] == "10.0.0.3"
+
+
+def test_provision_peer_for_unknown_user(storage):
+    wireguard_storage(storage)
+    storage.txn.return_value = (False, [[], [], []])
+    query_set = WireGuardQuerySets(storage)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(query_set.provision_peer("wg0", "nobody", "k"))
+
+    assert exc_info.value.status_code == 404
+    assert query_set._pools["wg0"].available == 253
+
+
+def test_provision_peer_reuses_addresses_released_by_another_instance():
+    from service_layer.etcd.memory import MemoryStorage
+
+    storage = MemoryStorage()
+    first, second = WireGuardQuerySets(storage), WireGuardQuerySets(storage)
+
+    async def main():
+        await storage.put("/vpn/users/alice", b"{}")
+        await first.register_interface("wg0", "10.0.0.1/29")
+        for n in range(5):
+            await first.provision_peer("wg0", "alice", f"key{n}")
+        for n in range(5):
+            await second.release_peer("wg0", f"key{n}")
+        return await first.provision_peer("wg0", "alice", "key5")
+
+    record = asyncio.run(main())
+
+    assert record["address"] == "10.0.0.2"
+
+
+def test_list_configs_json_returns_stored_bytes(storage):
+    query_set = VpnConfigQuerySets(storage)
+    storage.range = AsyncMock(
+        return_value=[
+            KeyValue("/vpn/configs/1", query_set.codec.encode({"a": 1}), 1),
+            KeyValue("/vpn/configs/2", b'{"a": 2}', 1),
+        ]
+    )
+
+    items = asyncio.run(query_set.list_configs_json(2))
+
+    assert items == [(1, b'{"a":1}'), (2, b'{"a":2}')]
@@ -0,0 +1,96 @@
+import asyncio
+import time
+import pytest
+from service_layer.wireguard.runner import CommandError, CommandRunner
+
+
+def test_run_returns_output():
+    stdout, stderr = asyncio.run(CommandRunner().run(["echo", "hello"]))
+
+    assert stdout == "hello\n"
+    assert stderr == ""
+
+
+def test_failed_command_raises():
+    with pytest.raises(CommandError):
+        asyncio.run(CommandRunner().run(["false"]))
+
+
+def test_timeout_kills_command():
+    started = time.monotonic()
+
+    with pytest.raises(CommandError, match="timed out"):
+        asyncio.run(CommandRunner(timeout=0.2).run(["sleep", "5"]))
+
+    assert time.monotonic() - started < 2
+
+
+def test_commands_overlap_up_to_the_cap():
+    async def main(runner):
+        started = time.monotonic()
+        await asyncio.gather(*(runner.run(["sleep", "0.3"]) for _ in range(4)))
+        return time.monotonic() - started
+
+    assert asyncio.run(main(CommandRunner(max_concurrency=4))) < 0.6
+    assert asyncio.run(main(CommandRunner(max_concurrency=2))) >= 0.6
+
+
+def test_interface_lock_serializes_operations():
+    runner = CommandRunner()
+    order = []
+
+    async def operation(name):
+        async with runner.interface("wg0"):
+            order.append(f"{name} start")
+            await runner.run(["sleep", "0.1"])
+            order.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(operation("a"), operation("b"))
+
+    asyncio.run(main())
+
+    assert order == ["a start", "a end", "b start", "b end"]
+
+
+def test_cancel_kills_command():
+    async def main():
+        task = asyncio.ensure_future(CommandRunner().run(["sleep", "5"]))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    started = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - started < 2
+
+
+def test_service_goes_through_the_runner():
+    from unittest.mock import AsyncMock, patch
+    from service_layer.wireguard import service
+
+    with patch.object(service.runner, "run", AsyncMock(return_value=("", ""))) as run:
+        asyncio.run(service.remove_peer("wg0", "peer_a"))
+
+    assert run.await_args_list[-1].args[0] == [
+        "wg",
+        "set",
+        "wg0",
+        "peer",
+        "peer_a",
+        "remove",
+    ]
+
+
+def test_timeout_survives_a_command_that_already_exited(monkeypatch):
+    kill = asyncio.subprocess.Process.kill
+
+    def kill_exited(process):
+        kill(process)
+        raise ProcessLookupError
+
+    monkeypatch.setattr(asyncio.subprocess.Process, "kill", kill_exited)
+
+    with pytest.raises(CommandError, match="timed out"):
+        asyncio.run(CommandRunner(timeout=0.2).run(["sleep", "5"]))
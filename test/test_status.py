@@ -0,0 +1,104 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+from service_layer.wireguard.status import StatusCache
+
+DUMP = (
+    "priv_key\tpub_key\t51820\toff\n"
+    "peer_a\tpsk_a\t1.2.3.4:51820\t10.0.0.2/32\t1620000000\t1000\t2000\t25\n"
+    "peer_b\t(none)\t(none)\t10.0.0.3/32\t0\t0\t0\toff\n"
+)
+DUMP_MOVED = (
+    "priv_key\tpub_key\t51820\toff\n"
+    "peer_a\tpsk_a\t1.2.3.4:51820\t10.0.0.2/32\t1620000100\t5000\t6000\t25\n"
+)
+
+
+def run_dumps(*dumps):
+    return patch(
+        "service_layer.wireguard.status.runner.run",
+        AsyncMock(side_effect=[(dump, "") for dump in dumps]),
+    )
+
+
+def test_concurrent_readers_share_one_dump():
+    cache = StatusCache(interval=60)
+
+    async def scenario():
+        return await asyncio.gather(*(cache.query("wg0") for _ in range(10)))
+
+    with run_dumps(DUMP) as run:
+        results = asyncio.run(scenario())
+
+    assert run.await_count == 1
+    assert results[0]["peers"][0]["transfer_rx"] == 1000
+    assert all(result == results[0] for result in results)
+
+
+def test_filters_and_paging():
+    cache = StatusCache(interval=60)
+
+    async def scenario():
+        return (
+            await cache.query("wg0", since_handshake=1600000000),
+            await cache.query("wg0", public_key="peer_b"),
+            await cache.query("wg0", limit=1, offset=1),
+        )
+
+    with run_dumps(DUMP):
+        handshake, prefix, page = asyncio.run(scenario())
+
+    assert [peer["public_key"] for peer in handshake["peers"]] == ["peer_a"]
+    assert [peer["public_key"] for peer in prefix["peers"]] == ["peer_b"]
+    assert page["total"] == 2
+    assert [peer["public_key"] for peer in page["peers"]] == ["peer_b"]
+
+
+def test_changes_since_revision():
+    cache = StatusCache(interval=60)
+
+    async def scenario():
+        first = await cache.query("wg0")
+        unchanged = await cache.query("wg0", since_revision=first["revision"])
+        cache.invalidate("wg0")
+        moved = await cache.query("wg0", since_revision=first["revision"])
+        return first, unchanged, moved
+
+    with run_dumps(DUMP, DUMP_MOVED):
+        first, unchanged, moved = asyncio.run(scenario())
+
+    assert unchanged["peers"] == [] and unchanged["removed"] == []
+    epoch, _, revision = first["revision"].partition(":")
+    assert moved["revision"] == f"{epoch}:{int(revision) + 1}"
+    assert [peer["public_key"] for peer in moved["peers"]] == ["peer_a"]
+    assert moved["peers"][0]["transfer_tx"] == 6000
+    assert moved["removed"] == ["peer_b"]
+
+
+def test_unknown_revision_returns_everything():
+    cache = StatusCache(interval=60)
+
+    with run_dumps(DUMP):
+        result = asyncio.run(cache.query("wg0", since_revision=f"{cache.epoch}:99"))
+
+    assert result["full"] is True
+    assert len(result["peers"]) == 2
+
+
+def test_revision_from_a_restarted_cache_returns_everything():
+    old, restarted = StatusCache(interval=60), StatusCache(interval=60)
+
+    async def scenario():
+        seen = await old.query("wg0")
+        # the new process has moved past the old revision number meanwhile
+        for _ in range(3):
+            restarted.invalidate("wg0")
+            await restarted.query("wg0")
+        return seen, await restarted.query("wg0", since_revision=seen["revision"])
+
+    with run_dumps(DUMP, DUMP, DUMP_MOVED, DUMP):
+        seen, result = asyncio.run(scenario())
+
+    assert int(result["revision"].split(":")[1]) > int(seen["revision"].split(":")[1])
+    assert result["full"] is True
+    assert "removed" not in result
+    assert len(result["peers"]) == 2
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+import pytest
+from unittest.mock import AsyncMock
+from etcd3.exceptions import ConnectionFailedError, ConnectionTimeoutError
+from service_layer.etcd.storage import EtcdStorage, parse_endpoints, prefix_end
+
+
+@pytest.fixture
+def storage():
+    storage = EtcdStorage(pool_size=2, max_concurrency=4)
+    yield storage
+    storage.close()
+
+
+def test_calls_run_off_the_event_loop(storage):
+    async def main():
+        loop_thread = threading.get_ident()
+        threads = await asyncio.gather(
+            *(storage._run(lambda client: threading.get_ident()) for _ in range(4))
+        )
+        assert loop_thread not in threads
+
+    asyncio.run(main())
+
+
+def test_channels_are_used_round_robin(storage):
+    async def main():
+        return await asyncio.gather(
+            *(storage._run(lambda client: client) for _ in range(4))
+        )
+
+    clients = asyncio.run(main())
+
+    assert clients == storage._clients * 2
+
+
+def test_slow_call_does_not_stall_others(storage):
+    finished = []
+
+    def slow(client):
+        time.sleep(0.3)
+        finished.append("slow")
+
+    def fast(client):
+        finished.append("fast")
+
+    async def main():
+        await asyncio.gather(storage._run(slow), storage._run(fast))
+
+    asyncio.run(main())
+
+    assert finished == ["fast", "slow"]
+
+
+def test_prefix_end():
+    assert prefix_end("/vpn/users/") == b"/vpn/users0"
+
+
+def test_parse_endpoints():
+    assert parse_endpoints("etcd1:2379, http://etcd2:2380,etcd3") == [
+        ("etcd1", 2379),
+        ("etcd2", 2380),
+        ("etcd3", 2379),
+    ]
+    assert parse_endpoints("") == [("localhost", 2379)]
+
+
+@pytest.fixture
+def cluster():
+    storage = EtcdStorage(
+        endpoints=[("etcd1", 2379), ("etcd2", 2379), ("etcd3", 2379)], pool_size=1
+    )
+    yield storage
+    storage.close()
+
+
+def member_of(storage, client):
+    return next(m for m in storage.members if client in m.clients).endpoint[0]
+
+
+def test_reads_are_spread_over_members(cluster):
+    async def main():
+        return await asyncio.gather(
+            *(cluster._run(lambda client: client) for _ in range(6))
+        )
+
+    clients = asyncio.run(main())
+
+    assert [member_of(cluster, client) for client in clients] == [
+        "etcd1",
+        "etcd2",
+        "etcd3",
+    ] * 2
+
+
+def test_read_fails_over_to_another_member(cluster):
+    def read(client):
+        if member_of(cluster, client) == "etcd1":
+            raise ConnectionFailedError()
+        return member_of(cluster, client)
+
+    async def main():
+        return [await cluster._run(read) for _ in range(3)]
+
+    assert asyncio.run(main()) == ["etcd2", "etcd3", "etcd2"]
+    assert not cluster.members[0].healthy(cluster.cooldown)
+
+
+def test_writes_go_to_the_leader(cluster):
+    cluster._find_leader = AsyncMock(return_value=cluster.members[2])
+
+    async def main():
+        return [await cluster._run(lambda client: client, write=True) for _ in range(3)]
+
+    assert {member_of(cluster, client) for client in asyncio.run(main())} == {"etcd3"}
+    cluster._find_leader.assert_awaited_once()
+
+
+def test_timed_out_writes_are_not_retried(cluster):
+    cluster._find_leader = AsyncMock(return_value=cluster.members[0])
+    calls = []
+
+    def write(client):
+        calls.append(client)
+        raise ConnectionTimeoutError()
+
+    with pytest.raises(ConnectionTimeoutError):
+        asyncio.run(cluster._run(write, write=True))
+
+    assert len(calls) == 1
@@ -0,0 +1,72 @@
+import time
+from service_layer.token_cache import TokenCache
+
+
+def test_hit_until_expiry():
+    cache = TokenCache()
+    cache.put("token", time.time() + 60, "alice", {"username": "alice"})
+    cache.put("expired", time.time() - 1, "alice", {"username": "alice"})
+
+    assert cache.get("token") == {"username": "alice"}
+    assert cache.get("expired") is None
+    assert cache.get("unknown") is None
+    assert cache.stats()["hit_rate"] == 1 / 3
+
+
+def test_user_change_drops_their_tokens():
+    cache = TokenCache()
+    cache.put("a1", time.time() + 60, "alice", {})
+    cache.put("a2", time.time() + 60, "alice", {})
+    cache.put("b1", time.time() + 60, "bob", {})
+
+    cache.invalidate_user("alice")
+
+    assert cache.get("a1") is None
+    assert cache.get("a2") is None
+    assert cache.get("b1") == {}
+    assert cache.invalidations == 2
+
+
+def test_lost_watch_drops_everything():
+    cache = TokenCache()
+    cache.put("b1", time.time() + 60, "bob", {})
+
+    cache.invalidate_user(None)
+
+    assert cache.get("b1") is None
+
+
+def test_lru_eviction():
+    cache = TokenCache(max_entries=2)
+    for token in ["t1", "t2"]:
+        cache.put(token, time.time() + 60, token, {})
+    cache.get("t1")
+    cache.put("t3", time.time() + 60, "t3", {})
+
+    assert cache.get("t2") is None
+    assert cache.get("t1") == {}
+    assert cache.evictions == 1
+
+
+def test_put_skips_users_changed_during_the_lookup():
+    cache = TokenCache()
+    generation = cache.generation()
+    cache.invalidate_user("alice")
+
+    assert cache.put("a1", time.time() + 60, "alice", {}, generation) is False
+    assert cache.put("b1", time.time() + 60, "bob", {}, generation) is True
+    assert cache.get("a1") is None
+    assert cache.put("a1", time.time() + 60, "alice", {}, cache.generation())
+
+
+def test_put_after_a_lost_watch_or_evicted_change_is_skipped():
+    cache = TokenCache(max_entries=1)
+    generation = cache.generation()
+    cache.invalidate_user("alice")
+    cache.invalidate_user("bob")
+
+    # alice's change was evicted from the bounded log, so it counts as recent
+    assert cache.put("a1", time.time() + 60, "alice", {}, generation) is False
+    generation = cache.generation()
+    cache.invalidate_user(None)
+    assert cache.put("c1", time.time() + 60, "carol", {}, generation) is False
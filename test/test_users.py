@@ -1,8 +1,11 @@
 import pytest
+from types import SimpleNamespace
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import AsyncMock
+from dependencies import get_token_cache, get_users_query_set
 from main import app
-from etcd_client import pwd_context
+from service_layer.passwords import pwd_context
+from service_layer.token_cache import TokenCache
 from fastapi import HTTPException
 
 client = TestClient(app)
@@ -19,32 +22,37 @@ def test_user_data():
 
 @pytest.fixture
 def mock_etcd():
-    with patch("routers.users.etcd_client") as mock_client:
-        users = {}
-
-        def mock_create_user(username, password, vpn_config=None):
-            if username in users:
-                raise HTTPException(status_code=400, detail="User already exists")
-            users[username] = {
-                "username": username,
-                "password": pwd_context.hash(password),
-                "vpn_config": vpn_config,
-            }
-
-        def mock_get_user(username):
-            return users.get(username)
-
-        def mock_verify_password(username, password):
-            user = users.get(username)
-            if not user:
-                return False
-            return pwd_context.verify(password, user["password"])
-
-        mock_client.create_user = MagicMock(side_effect=mock_create_user)
-        mock_client.get_user = MagicMock(side_effect=mock_get_user)
-        mock_client.verify_password = MagicMock(side_effect=mock_verify_password)
-
-        yield mock_client
+    users = {}
+
+    async def mock_create_user(username, password, vpn_config=None):
+        if username in users:
+            raise HTTPException(status_code=400, detail="User already exists")
+        users[username] = {
+            "username": username,
+            "password": pwd_context.hash(password),
+            "vpn_config": vpn_config,
+        }
+
+    async def mock_get_user(username):
+        return users.get(username)
+
+    async def mock_verify_password(username, password):
+        user = users.get(username)
+        if not user:
+            return False
+        return pwd_context.verify(password, user["password"])
+
+    mock_client = SimpleNamespace(
+        create_user=AsyncMock(side_effect=mock_create_user),
+        get_user=AsyncMock(side_effect=mock_get_user),
+        verify_password=AsyncMock(side_effect=mock_verify_password),
+        cache=SimpleNamespace(live=False),
+    )
+    token_cache = TokenCache()
+    app.dependency_overrides[get_users_query_set] = lambda: mock_client
+    app.dependency_overrides[get_token_cache] = lambda: token_cache
+    yield mock_client
+    app.dependency_overrides.clear()
 
 
 def test_create_user_success(mock_etcd, test_user_data):
@@ -135,3 +143,48 @@ def test_get_current_user_invalid_token(mock_etcd):
 
     assert response.status_code == 401
     assert "Could not validate credentials" in response.json()["detail"]
+
+
+@pytest.fixture
+def users_query_set():
+    from query_sets.users import UsersQuerySets
+    from service_layer.etcd.memory import MemoryStorage
+
+    storage = MemoryStorage()
+    app.dependency_overrides[get_users_query_set] = lambda: UsersQuerySets(storage)
+    yield
+    app.dependency_overrides.clear()
+    storage.close()
+
+
+def test_create_users_batch_reports_each_user(users_query_set):
+    first = client.post(
+        "/api/v1/users/batch",
+        json=[
+            {"username": "alice", "password": "a"},
+            {"username": "bob", "password": "b"},
+        ],
+    )
+    second = client.post(
+        "/api/v1/users/batch",
+        json=[
+            {"username": "alice", "password": "other"},
+            {"username": "carol", "password": "c"},
+        ],
+    )
+
+    assert first.status_code == 200
+    assert [r["status"] for r in first.json()["results"]] == ["created", "created"]
+    assert second.json()["results"] == [
+        {"username": "alice", "status": "exists"},
+        {"username": "carol", "status": "created"},
+    ]
+
+
+def test_create_users_batch_size_limit(users_query_set):
+    from routers.users import BATCH_MAX_ITEMS
+
+    users = [{"username": f"u{i}", "password": "p"} for i in range(BATCH_MAX_ITEMS + 1)]
+    response = client.post("/api/v1/users/batch", json=users)
+
+    assert response.status_code == 422
@@ -0,0 +1,298 @@
+import asyncio
+import time
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock, patch
+from dependencies import get_wireguard_query_set
+from main import app
+from query_sets.wireguard import WireGuardQuerySets
+from service_layer.etcd.memory import MemoryStorage
+from service_layer.wireguard.feed import TrafficFeeds
+from service_layer.wireguard.lookup import PeerIndex
+from service_layer.wireguard.peers import PeerStatus
+from service_layer.wireguard.status import InterfaceStatus, StatusCache
+from service_layer.wireguard.configs import config_renderer, write_atomic
+from service_layer.wireguard.keys import generate_keypair
+
+client = TestClient(app)
+
+DUMP = (
+    "priv_key\tpub_key\t51820\toff\n"
+    "peer_a\t(none)\t1.2.3.4:51820\t10.0.0.2/32\t1620000000\t1000\t2000\t25\n"
+    "peer_b\t(none)\t(none)\t10.0.0.3/32\t0\t0\t0\toff\n"
+)
+
+
+def fake_wg(dump=DUMP):
+    """Patch the shared runner; ``show`` returns ``dump``, anything else succeeds"""
+    configs = []
+
+    async def run(command, timeout=None):
+        if command[1:3] == ["show", "interfaces"]:
+            return "wg0\n", ""
+        if command[1] == "syncconf":
+            with open(command[3]) as handle:
+                configs.append(handle.read())
+        return (dump if command[1] == "show" else ""), ""
+
+    mock = AsyncMock(side_effect=run)
+    mock.configs = configs
+    return patch("service_layer.wireguard.runner.runner.run", mock)
+
+
+@pytest.fixture
+def query_set(tmp_path):
+    storage = MemoryStorage()
+    query_set = WireGuardQuerySets(storage)
+    app.dependency_overrides[get_wireguard_query_set] = lambda: query_set
+    with patch.object(config_renderer, "config_dir", tmp_path):
+        yield query_set
+    app.dependency_overrides.clear()
+    storage.close()
+
+
+def test_create_interface_writes_the_config_once(query_set, tmp_path, capsys):
+    keypair = generate_keypair()
+    with patch(
+        "service_layer.wireguard.configs.write_atomic", wraps=write_atomic
+    ) as write:
+        response = client.post(
+            "/api/v1/wireguard/interface",
+            json={
+                "name": "wg0",
+                "private_key": keypair["private_key"],
+                "listen_port": 51820,
+                "address": "10.0.0.1/24",
+            },
+        )
+
+    assert response.status_code == 200
+    write.assert_called_once()
+    config = (tmp_path / "wg0.conf").read_text()
+    assert f"PrivateKey = {keypair['private_key']}" in config
+    assert capsys.readouterr().out == ""
+
+
+def test_peer_batch_applies_upserts_and_removals_in_one_syncconf(query_set):
+    with fake_wg() as run:
+        response = client.post(
+            "/api/v1/wireguard/interface/wg0/peers:batch",
+            json={
+                "upsert": [
+                    {"public_key": "peer_a", "allowed_ips": "10.0.0.9/32"},
+                    {"public_key": "peer_c", "allowed_ips": "10.0.0.4/32"},
+                ],
+                "remove": ["peer_b", "peer_unknown"],
+            },
+        )
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "message": "Peers updated successfully",
+        "added": 1,
+        "updated": 1,
+        "removed": 1,
+    }
+    commands = [call.args[0][:2] for call in run.await_args_list]
+    assert commands == [["wg", "show"], ["wg", "syncconf"]]
+    (config,) = run.configs
+    assert "PublicKey = peer_c" in config and "PublicKey = peer_b" not in config
+    assert "AllowedIPs = 10.0.0.9/32" in config
+
+
+class FakeStatusCache:
+    async def get(self, interface):
+        status = InterfaceStatus()
+        status.peers = {
+            "peer_a": PeerStatus(
+                "peer_a", "1.2.3.4:51820", "10.0.0.2/32", 1620000000, 1000, 2000, 25
+            )
+        }
+        status.fetched_at = 1.0
+        return status
+
+
+@pytest.fixture
+def feeds():
+    feeds = TrafficFeeds(FakeStatusCache())
+    with patch("routers.wireguard.traffic_feeds", feeds), patch(
+        "routers.wireguard.FEED_HEARTBEAT", 0.05
+    ):
+        yield feeds
+
+
+async def read_stream(path: str, chunks: int) -> list:
+    """GET ``path`` from the app, disconnect after ``chunks`` body chunks"""
+    body: list = []
+    enough = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await enough.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            body.append(message["body"])
+            if len(body) >= chunks:
+                enough.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    await asyncio.wait_for(app(scope, receive, send), 5)
+    return [chunk.decode() for chunk in body]
+
+
+def test_sse_feed_sends_a_snapshot_then_heartbeats(feeds):
+    chunks = asyncio.run(read_stream("/api/v1/wireguard/interface/wg0/traffic", 2))
+
+    first, heartbeat = chunks[:2]
+    assert first.startswith("data: ")
+    event = orjson.loads(first[len("data: ") :])
+    assert event["full"] is True
+    assert [peer["public_key"] for peer in event["peers"]] == ["peer_a"]
+    assert heartbeat == ": keepalive\n\n"
+    # the disconnect ended the subscription and with it the sampler
+    assert feeds._feeds == {}
+
+
+def test_websocket_feed_sends_a_snapshot_then_heartbeats(feeds):
+    with client.websocket_connect("/api/v1/wireguard/interface/wg0/traffic/ws") as ws:
+        event = ws.receive_json()
+        heartbeat = ws.receive_json()
+        assert len(feeds.feed("wg0")) == 1
+
+    assert event["full"] is True
+    assert [peer["public_key"] for peer in event["peers"]] == ["peer_a"]
+    assert heartbeat == {"name": "wg0", "keepalive": True}
+    deadline = time.monotonic() + 2
+    while feeds._feeds and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert feeds._feeds == {}
+
+
+def create_interface(name="wg0"):
+    response = client.post(
+        "/api/v1/wireguard/interface",
+        json={"name": name, "listen_port": 51820, "address": "10.0.0.1/24"},
+    )
+    assert response.status_code == 200
+
+
+def create_user(query_set, username):
+    key = f"/vpn/users/{username}"
+    value = query_set.codec.encode({"username": username})
+    asyncio.run(query_set.storage.put(key, value))
+
+
+def test_provision_and_release_a_peer(query_set, tmp_path):
+    create_interface()
+    create_user(query_set, "alice")
+
+    with fake_wg() as run:
+        response = client.post(
+            "/api/v1/wireguard/interface/wg0/provision",
+            json={"username": "alice", "public_key": "pk_alice"},
+        )
+        assert response.status_code == 200
+        assert response.json()["address"] == "10.0.0.2"
+        assert "private_key" not in response.json()
+        config = (tmp_path / "wg0.conf").read_text()
+        assert "[Peer]\nPublicKey = pk_alice\nAllowedIPs = 10.0.0.2/32" in config
+
+        response = client.delete("/api/v1/wireguard/interface/wg0/peer/pk_alice")
+
+    assert response.status_code == 200
+    assert "[Peer]" not in (tmp_path / "wg0.conf").read_text()
+    commands = [call.args[0] for call in run.await_args_list]
+    assert commands[0][:5] == ["wg", "set", "wg0", "peer", "pk_alice"]
+    assert commands[-1] == ["wg", "set", "wg0", "peer", "pk_alice", "remove"]
+
+
+def test_provision_for_an_unknown_user(query_set):
+    create_interface()
+
+    with fake_wg() as run:
+        response = client.post(
+            "/api/v1/wireguard/interface/wg0/provision",
+            json={"username": "nobody", "public_key": "pk"},
+        )
+
+    assert response.status_code == 404
+    run.assert_not_awaited()
+
+
+def test_provision_a_duplicate_key(query_set):
+    create_interface()
+    create_user(query_set, "alice")
+    request = {"username": "alice", "public_key": "pk_alice"}
+
+    with fake_wg():
+        first = client.post("/api/v1/wireguard/interface/wg0/provision", json=request)
+        second = client.post("/api/v1/wireguard/interface/wg0/provision", json=request)
+
+    assert first.status_code == 200
+    assert second.status_code == 409
+
+
+@pytest.fixture
+def peer_index():
+    peer_index = PeerIndex(StatusCache(interval=60))
+    with patch("routers.wireguard.peer_index", peer_index), fake_wg():
+        yield peer_index
+
+
+def test_lookup_by_ip(peer_index):
+    response = client.get("/api/v1/wireguard/lookup", params={"ip": "10.0.0.3"})
+
+    assert response.status_code == 200
+    (match,) = response.json()
+    assert match["interface"] == "wg0"
+    assert match["public_key"] == "peer_b"
+    assert match["match"] == "10.0.0.3/32"
+
+
+def test_lookup_answers_from_the_index_without_running_wg(peer_index):
+    client.get("/api/v1/wireguard/lookup", params={"ip": "10.0.0.3"})
+    # stale enough that a refresh would run wg again
+    peer_index._interfaces_at = 0.0
+    peer_index.cache.invalidate("wg0")
+
+    with patch(
+        "service_layer.wireguard.runner.runner.run", side_effect=AssertionError
+    ) as run:
+        response = client.get("/api/v1/wireguard/lookup", params={"ip": "10.0.0.3"})
+
+    assert response.status_code == 200
+    assert [peer["public_key"] for peer in response.json()] == ["peer_b"]
+    run.assert_not_called()
+
+
+def test_lookup_by_endpoint(peer_index):
+    response = client.get("/api/v1/wireguard/lookup", params={"endpoint": "1.2.3.4"})
+
+    assert response.status_code == 200
+    assert [peer["public_key"] for peer in response.json()] == ["peer_a"]
+
+
+def test_lookup_with_a_bad_ip(peer_index):
+    response = client.get("/api/v1/wireguard/lookup", params={"ip": "not-an-ip"})
+
+    assert response.status_code == 400